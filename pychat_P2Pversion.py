@@ -1,107 +1,25 @@
 import sys
 import os
-import socket
-import threading
 import json
+import time
+import threading
 import datetime
+import collections
+import concurrent.futures
 import sqlite3
-import random
+from collections import namedtuple
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
+from pychat_core import (ChatCore, ExportCancelled, HISTORY_PAGE_SIZE, SIZE_BUCKETS,
+                         format_snapshot, format_ts, get_local_ip, now_us)
 
-# 获取本机IP地址
-def get_local_ip():
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except:
-        return "127.0.0.1"
-
-# 数据库管理类
-class ChatDatabase:
-    def __init__(self):
-        self.db_name = "chat_history.db"
-        self.init_db()
-    
-    def init_db(self):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS connections
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT,
-                      ip TEXT,
-                      port INTEGER,
-                      last_active TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS messages
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      connection_id INTEGER,
-                      sender TEXT,
-                      message TEXT,
-                      timestamp TEXT,
-                      file_path TEXT)''')
-        conn.commit()
-        conn.close()
-    
-    def add_connection(self, name, ip, port):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("INSERT INTO connections (name, ip, port, last_active) VALUES (?, ?, ?, ?)",
-                 (name, ip, port, datetime.datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
-        return c.lastrowid
-    
-    def get_connections(self):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("SELECT id, name, ip, port, last_active FROM connections ORDER BY last_active DESC")
-        connections = c.fetchall()
-        conn.close()
-        return connections
-    
-    def get_connection_by_id(self, conn_id):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("SELECT id, name, ip, port, last_active FROM connections WHERE id = ?", (conn_id,))
-        connection = c.fetchone()
-        conn.close()
-        return connection
-    
-    def save_message(self, connection_id, sender, message, file_path=None):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        timestamp = datetime.datetime.now().isoformat()
-        c.execute("INSERT INTO messages (connection_id, sender, message, timestamp, file_path) VALUES (?, ?, ?, ?, ?)",
-                 (connection_id, sender, message, timestamp, file_path))
-        c.execute("UPDATE connections SET last_active = ? WHERE id = ?", (timestamp, connection_id))
-        conn.commit()
-        conn.close()
-    
-    def get_messages(self, connection_id):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("SELECT sender, message, timestamp, file_path FROM messages WHERE connection_id = ? ORDER BY timestamp", (connection_id,))
-        messages = c.fetchall()
-        conn.close()
-        return messages
-    
-    def export_chat(self, connection_id, file_path):
-        messages = self.get_messages(connection_id)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write("聊天记录导出\n")
-            f.write("=" * 50 + "\n")
-            for msg in messages:
-                sender, message, timestamp, file_path = msg
-                dt = datetime.datetime.fromisoformat(timestamp)
-                time_str = dt.strftime("%Y-%m-%d %H:%M:%S")
-                if file_path:
-                    f.write(f"[{time_str}] {sender}: [文件] {os.path.basename(file_path)}\n")
-                else:
-                    f.write(f"[{time_str}] {sender}: {message}\n")
+# 界面参数
+HISTORY_PREFETCH = 200                  # 滚动条距顶部(底部)小于该像素数时加载更早(更新)的一页
+SEARCH_DELAY = 200                      # 搜索框停止输入多久后开始查询(毫秒)
+CONTACT_MATCH_LIMIT = 5                 # 搜索结果顶部最多列出的匹配联系人数
+LAYOUT_CACHE_SIZE = 2000                # 聊天气泡缓存布局的最多消息数, 超出时淘汰最久未用的
+EVENT_FRAME_INTERVAL = 16               # GUI线程合并处理网络事件的间隔(毫秒), 约一帧
 
 # Metro风格按钮
 class MetroButton(QPushButton):
@@ -129,22 +47,430 @@ class MetroButton(QPushButton):
             self.setIcon(icon)
             self.setIconSize(QSize(24, 24))
 
-# 连接列表项
-class ConnectionItem(QListWidgetItem):
-    def __init__(self, conn_id, name, ip, port, last_active, parent=None):
+# 连接列表模型: 行就是 ContactStore 的顺序, 联系人和群组(ID为负)共用列表; 只通知变化的行
+class ContactListModel(QAbstractListModel):
+    ContactRole = Qt.UserRole + 1
+    
+    def __init__(self, store, parent=None):
         super().__init__(parent)
-        self.conn_id = conn_id
-        self.name = name
-        self.ip = ip
-        self.port = port
-        self.last_active = last_active
-        
-        dt = datetime.datetime.fromisoformat(last_active)
-        time_str = dt.strftime("%m-%d %H:%M")
-        self.setText(f"{name}\n{ip}:{port}  {time_str}")
-        self.setSizeHint(QSize(200, 60))
-        self.setFont(QFont("Segoe UI", 10))
-        self.setBackground(QColor(240, 240, 240))
+        self.store = store
+        self.unread = set()
+        self.font = QFont("Segoe UI", 10)
+        self.unread_font = QFont(self.font)
+        self.unread_font.setBold(True)
+        self.background = QColor(240, 240, 240)
+        store.observer = self
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.store)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        contact = self.store.order[index.row()]
+        if role == Qt.DisplayRole:
+            if contact.ip is None:
+                return f"{contact.name}\n群组 · {contact.members} 人  {contact.active_text}"
+            return f"{contact.name}\n{contact.ip}:{contact.port}  {contact.active_text}"
+        if role == self.ContactRole:
+            return contact
+        if role == Qt.FontRole:
+            return self.unread_font if contact.id in self.unread else self.font
+        if role == Qt.SizeHintRole:
+            return QSize(200, 60)
+        if role == Qt.BackgroundRole:
+            return self.background
+        return None
+    
+    def index_of(self, contact_id):
+        row = self.store.row(contact_id)
+        return QModelIndex() if row is None else self.index(row)
+    
+    def set_unread(self, contact_id, unread):
+        if unread == (contact_id in self.unread):
+            return
+        if unread:
+            self.unread.add(contact_id)
+        else:
+            self.unread.discard(contact_id)
+        row = self.store.row(contact_id)
+        if row is not None:
+            self.changed(row)
+    
+    # ContactStore 的回调
+    def inserting(self, row):
+        self.beginInsertRows(QModelIndex(), row, row)
+    
+    def inserted(self):
+        self.endInsertRows()
+    
+    def moving(self, old_row, new_row):
+        # beginMoveRows 的目标位置是移动前的行号, 向下移动时要越过自己
+        self.beginMoveRows(QModelIndex(), old_row, old_row, QModelIndex(), new_row + 1 if new_row > old_row else new_row)
+    
+    def moved(self):
+        self.endMoveRows()
+    
+    def changed(self, row):
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+# 聊天记录中的一条: 普通消息或居中显示的系统提示
+ChatEntry = namedtuple('ChatEntry', 'id sender text ts system')
+
+def chat_entry(sender, message, ts, file_path=None, message_id=None):
+    text = f"[文件] {os.path.basename(file_path)}" if file_path else message
+    if sender not in ("我", "对方"):
+        # 群组消息的发送者记录为成员名称
+        text = f"{sender}: {text}"
+    return ChatEntry(message_id, sender, text, ts, False)
+
+def history_entries(rows):
+    return [chat_entry(sender, message, ts, file_path, message_id)
+            for message_id, sender, message, ts, file_path in rows]
+
+# 聊天记录模型: 只保存纯数据, 绘制交给 BubbleDelegate
+class MessageModel(QAbstractListModel):
+    EntryRole = Qt.UserRole + 1
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+        self.highlight_id = None   # 从搜索结果跳转到的消息
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+    
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        if role == self.EntryRole:
+            return entry
+        if role == Qt.DisplayRole:
+            return entry.text
+        return None
+    
+    def append(self, entry):
+        row = len(self.entries)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.entries.append(entry)
+        self.endInsertRows()
+    
+    def extend(self, entries):
+        if not entries:
+            return
+        row = len(self.entries)
+        self.beginInsertRows(QModelIndex(), row, row + len(entries) - 1)
+        self.entries.extend(entries)
+        self.endInsertRows()
+    
+    def prepend(self, entries):
+        if not entries:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(entries) - 1)
+        self.entries[:0] = entries
+        self.endInsertRows()
+    
+    def reset(self, entries=(), highlight_id=None):
+        self.beginResetModel()
+        self.entries = list(entries)
+        self.highlight_id = highlight_id
+        self.endResetModel()
+    
+    def row_of(self, message_id):
+        for row, entry in enumerate(self.entries):
+            if entry.id == message_id:
+                return row
+        return None
+
+# 气泡样式的消息绘制, 每条消息的布局尺寸按视口宽度缓存, 只有可见行会被绘制
+class BubbleDelegate(QStyledItemDelegate):
+    MARGIN = 10         # 气泡与视口边缘的距离
+    INDENT = 100        # 气泡另一侧留出的空白
+    PADDING = 8         # 气泡内边距
+    RADIUS = 10
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.font = QFont("Segoe UI", 10)
+        self.time_font = QFont("Segoe UI", 8)
+        self.system_font = QFont("Segoe UI", 9)
+        self.system_font.setItalic(True)
+        self.metrics = QFontMetrics(self.font)
+        self.time_metrics = QFontMetrics(self.time_font)
+        self.system_metrics = QFontMetrics(self.system_font)
+        self._width = None
+        self._layouts = collections.OrderedDict()
+    
+    def _layout(self, entry, width):
+        """返回 (文本区域大小, 行高), 同一视口宽度下只计算一次; 最多缓存 LAYOUT_CACHE_SIZE 条"""
+        if width != self._width:
+            self._width = width
+            self._layouts.clear()
+        # 已保存的消息按ID缓存, 尚未分配ID的新消息和系统提示按内容缓存
+        key = entry if entry.id is None else entry.id
+        layout = self._layouts.get(key)
+        if layout is not None:
+            self._layouts.move_to_end(key)
+        else:
+            if entry.system:
+                rect = self.system_metrics.boundingRect(QRect(0, 0, width - 2 * self.MARGIN, 0),
+                                                        Qt.AlignCenter | Qt.TextWordWrap, entry.text)
+                layout = (rect.size(), rect.height() + 2 * self.MARGIN)
+            else:
+                text_width = max(width - self.MARGIN - self.INDENT - 2 * self.PADDING, 40)
+                rect = self.metrics.boundingRect(QRect(0, 0, text_width, 0), Qt.TextWordWrap, entry.text)
+                size = QSize(max(rect.width(), self.time_metrics.horizontalAdvance("00-00 00:00")), rect.height())
+                layout = (size, size.height() + self.time_metrics.height() + 2 * self.PADDING + self.MARGIN + 4)
+            self._layouts[key] = layout
+            if len(self._layouts) > LAYOUT_CACHE_SIZE:
+                self._layouts.popitem(last=False)
+        return layout
+    
+    def sizeHint(self, option, index):
+        entry = index.data(MessageModel.EntryRole)
+        _, height = self._layout(entry, option.rect.width())
+        return QSize(option.rect.width(), height)
+    
+    def paint(self, painter, option, index):
+        entry = index.data(MessageModel.EntryRole)
+        rect = option.rect
+        size, _ = self._layout(entry, rect.width())
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        if entry.id is not None and entry.id == index.model().highlight_id:
+            painter.fillRect(rect, QColor(255, 244, 196))
+        if entry.system:
+            painter.setFont(self.system_font)
+            painter.setPen(QColor(96, 96, 96))
+            painter.drawText(rect.adjusted(self.MARGIN, 0, -self.MARGIN, 0),
+                             Qt.AlignCenter | Qt.TextWordWrap, entry.text)
+            painter.restore()
+            return
+        mine = entry.sender == "我"
+        bubble = QRect(0, rect.top() + self.MARGIN // 2,
+                       size.width() + 2 * self.PADDING,
+                       size.height() + self.time_metrics.height() + 2 * self.PADDING + 4)
+        if mine:
+            bubble.moveRight(rect.right() - self.MARGIN)
+            background, foreground = QColor(0, 120, 215), QColor(Qt.white)
+        else:
+            bubble.moveLeft(rect.left() + self.MARGIN)
+            background, foreground = QColor(224, 224, 224), QColor(Qt.black)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(background)
+        painter.drawRoundedRect(bubble, self.RADIUS, self.RADIUS)
+        inner = bubble.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        painter.setPen(foreground)
+        painter.setFont(self.font)
+        painter.drawText(QRect(inner.topLeft(), size), Qt.TextWordWrap, entry.text)
+        painter.setFont(self.time_font)
+        painter.drawText(inner, (Qt.AlignRight if mine else Qt.AlignLeft) | Qt.AlignBottom,
+                         self.time_text(entry.ts))
+        painter.restore()
+    
+    @staticmethod
+    def time_text(ts):
+        # 当天的消息只显示时间, 更早的加上日期
+        if datetime.date.fromtimestamp(ts / 1_000_000) == datetime.date.today():
+            return format_ts(ts, "%H:%M")
+        return format_ts(ts, "%m-%d %H:%M")
+
+# 网络事件桥接: 网络线程把事件放入队列, GUI线程每帧取出一次并批量处理
+class EventBridge(QObject):
+    """post() 可以在任意线程调用; 只有队列由空变为非空时才通过排队信号唤醒GUI线程,
+    GUI线程在 EVENT_FRAME_INTERVAL 毫秒后把这段时间内积累的事件一次交给 handler(events)。
+    """
+    wake = pyqtSignal()
+    
+    def __init__(self, handler, interval=EVENT_FRAME_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.handler = handler
+        self.events = collections.deque()   # deque 的 append/popleft 是线程安全的
+        self._scheduled = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self._drain)
+        self.wake.connect(self._schedule)
+    
+    def post(self, kind, data):
+        self.events.append((kind, data))
+        if not self._scheduled:
+            self._scheduled = True
+            self.wake.emit()
+    
+    def _schedule(self):
+        if not self.timer.isActive():
+            self.timer.start()
+    
+    def _drain(self):
+        # 先清除标记再取事件, 取的过程中到达的事件会再触发一次唤醒, 不会被遗漏
+        self._scheduled = False
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        if events:
+            self.handler(events)
+
+# 在后台线程读取聊天记录页和执行搜索, 结果经信号交回GUI线程
+class HistoryLoader(QObject):
+    page_loaded = pyqtSignal(int, object, bool, object)   # 联系人ID, 请求的锚点消息ID, 是否更早的一页, 消息行
+    search_done = pyqtSignal(int, object)                 # 搜索序号, 结果行
+    
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pychat-history")
+        self.search_serial = 0
+    
+    def request(self, connection_id, anchor_id, older=True, limit=HISTORY_PAGE_SIZE):
+        self.executor.submit(self._load, connection_id, anchor_id, older, limit)
+    
+    def _load(self, connection_id, anchor_id, older, limit):
+        start = time.perf_counter()
+        try:
+            if older:
+                rows = self.db.get_messages_before(connection_id, anchor_id, limit)
+            else:
+                # 读取操作不等待写入队列, 在后台线程等待刚保存的新消息提交
+                self.db.flush()
+                rows = self.db.get_messages_after(connection_id, anchor_id, limit)
+        except sqlite3.Error:
+            rows = []
+        self.record('stage.db_read', start)
+        self.page_loaded.emit(connection_id, anchor_id, older, rows)
+    
+    def search(self, query, **filters):
+        """提交一次搜索并返回其序号; 排队期间被更新的搜索取代的查询不再执行"""
+        self.search_serial += 1
+        self.executor.submit(self._search, self.search_serial, query, filters)
+        return self.search_serial
+    
+    def _search(self, serial, query, filters):
+        if serial != self.search_serial:
+            return
+        start = time.perf_counter()
+        try:
+            self.db.flush()
+            rows = self.db.search(query, **filters)
+        except sqlite3.Error:
+            rows = []
+        self.record('stage.db_search', start)
+        self.search_done.emit(serial, rows)
+    
+    def record(self, name, start):
+        metrics = self.db.metrics
+        if metrics is not None:
+            metrics.observe(name, (time.perf_counter() - start) * 1000)
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# 在后台线程执行导出, 进度和结果经信号交回GUI线程
+class ExportTask(QObject):
+    progress = pyqtSignal(int, int)    # 已导出条数, 总条数
+    finished = pyqtSignal(int)         # 导出的消息条数
+    failed = pyqtSignal(str)           # 错误信息, 取消时为空字符串
+    
+    def __init__(self, db, connection_id, file_path, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.connection_id = connection_id
+        self.file_path = file_path
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="pychat-export", daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def _run(self):
+        try:
+            count = self.db.export_chat(self.connection_id, self.file_path,
+                                        progress=self.progress.emit, cancel=self.cancelled)
+        except ExportCancelled:
+            self.failed.emit("")
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.finished.emit(count)
+
+# 诊断面板: 每秒刷新会话计数器和性能指标, 可以开关指标记录和保存JSON快照
+class DiagnosticsDialog(QDialog):
+    def __init__(self, core, parent=None):
+        super().__init__(parent)
+        self.core = core
+        self.setWindowTitle("诊断")
+        self.resize(760, 480)
+        layout = QVBoxLayout(self)
+        
+        self.metrics_check = QCheckBox("记录性能指标")
+        self.metrics_check.setChecked(core.metrics is not None)
+        self.metrics_check.toggled.connect(self.set_metrics_enabled)
+        layout.addWidget(self.metrics_check)
+        
+        # TLS在启动时加载证书, 开关在下次启动时生效
+        self.tls_check = QCheckBox("使用TLS加密连接 (重启后生效, 对方也需开启)")
+        self.tls_check.setChecked(core.db.get_setting('tls') == '1')
+        self.tls_check.toggled.connect(core.set_tls_enabled)
+        layout.addWidget(self.tls_check)
+        if core.tls is not None:
+            fingerprint = QLabel(f"本机证书指纹: {core.tls.fingerprint}")
+            fingerprint.setTextInteractionFlags(Qt.TextSelectableByMouse)
+            layout.addWidget(fingerprint)
+        
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout.addWidget(self.text)
+        
+        buttons = QDialogButtonBox(QDialogButtonBox.Close)
+        save_btn = buttons.addButton("保存快照", QDialogButtonBox.ActionRole)
+        save_btn.clicked.connect(self.save_snapshot)
+        buttons.rejected.connect(self.close)
+        layout.addWidget(buttons)
+        
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+    
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super().showEvent(event)
+    
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+    
+    def set_metrics_enabled(self, enabled):
+        if enabled:
+            self.core.enable_metrics()
+        else:
+            self.core.disable_metrics()
+        self.refresh()
+    
+    def refresh(self):
+        scroll_bar = self.text.verticalScrollBar()
+        position = scroll_bar.value()
+        self.text.setPlainText(format_snapshot(self.core.snapshot()))
+        scroll_bar.setValue(position)
+    
+    def save_snapshot(self):
+        default_name = f"pychat_metrics_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        file_path, _ = QFileDialog.getSaveFileName(self, "保存指标快照", default_name, "JSON (*.json)")
+        if not file_path:
+            return
+        try:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump(self.core.snapshot(), f, ensure_ascii=False, indent=2, default=str)
+        except OSError as e:
+            QMessageBox.critical(self, "保存失败", f"保存失败: {e}")
 
 # 主窗口类
 class ChatWindow(QMainWindow):
@@ -153,8 +479,10 @@ class ChatWindow(QMainWindow):
         self.setWindowTitle("MetroChat - P2P 聊天")
         self.setGeometry(100, 100, 1000, 700)
         
-        # 初始化数据库
-        self.db = ChatDatabase()
+        # 网络与数据库由无界面的 ChatCore 负责, 网络事件经 EventBridge 交回GUI线程
+        self.bridge = EventBridge(self.on_network_events, parent=self)
+        self.core = ChatCore(self.bridge.post)
+        self.db = self.core.db
         
         # 设置Metro风格
         self.setStyleSheet("""
@@ -166,12 +494,12 @@ class ChatWindow(QMainWindow):
                 background-color: #E0E0E0;
                 width: 1px;
             }
-            QListWidget {
+            QListWidget, QListView#contactList {
                 background-color: white;
                 border: none;
                 font-size: 12px;
             }
-            QListWidget::item:selected {
+            QListWidget::item:selected, QListView#contactList::item:selected {
                 background-color: #E5F1FB;
                 color: black;
                 border-left: 3px solid #0078D7;
@@ -213,10 +541,51 @@ class ChatWindow(QMainWindow):
         title_label.setAlignment(Qt.AlignCenter)
         left_layout.addWidget(title_label)
         
+        # 搜索框, 有输入时用搜索结果替换连接列表
+        search_panel = QWidget()
+        search_layout = QVBoxLayout(search_panel)
+        search_layout.setContentsMargins(8, 8, 8, 8)
+        search_layout.setSpacing(4)
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText("搜索聊天记录...")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_box.textChanged.connect(self.on_search_text_changed)
+        search_layout.addWidget(self.search_box)
+        filter_layout = QHBoxLayout()
+        self.search_scope = QComboBox()
+        self.search_scope.addItems(["全部联系人", "当前联系人"])
+        self.search_scope.currentIndexChanged.connect(self.schedule_search)
+        filter_layout.addWidget(self.search_scope)
+        self.search_range = QComboBox()
+        self.search_range.addItem("全部时间", None)
+        self.search_range.addItem("最近7天", 7)
+        self.search_range.addItem("最近30天", 30)
+        self.search_range.currentIndexChanged.connect(self.schedule_search)
+        filter_layout.addWidget(self.search_range)
+        search_layout.addLayout(filter_layout)
+        left_layout.addWidget(search_panel)
+        
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY)
+        self.search_timer.timeout.connect(self.run_search)
+        
+        self.search_results = QListWidget()
+        self.search_results.setStyleSheet("border: none;")
+        self.search_results.setWordWrap(True)
+        self.search_results.itemClicked.connect(self.on_search_result_selected)
+        self.search_results.setVisible(False)
+        left_layout.addWidget(self.search_results, 1)
+        
         # 连接列表
-        self.connection_list = QListWidget()
+        self.contact_model = ContactListModel(self.core.contacts, self)
+        self.connection_list = QListView()
+        self.connection_list.setObjectName("contactList")
+        self.connection_list.setModel(self.contact_model)
+        self.connection_list.setUniformItemSizes(True)
+        self.connection_list.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.connection_list.setStyleSheet("border: none;")
-        self.connection_list.itemClicked.connect(self.on_connection_selected)
+        self.connection_list.clicked.connect(self.on_connection_selected)
         left_layout.addWidget(self.connection_list, 1)
         
         # 底部按钮区域
@@ -233,10 +602,18 @@ class ChatWindow(QMainWindow):
         self.connect_btn.clicked.connect(self.connect_to_selected)
         button_layout.addWidget(self.connect_btn)
         
+        new_group_btn = MetroButton("  新建群组", QIcon.fromTheme("system-users"))
+        new_group_btn.clicked.connect(self.show_new_group_dialog)
+        button_layout.addWidget(new_group_btn)
+        
         export_btn = MetroButton("  导出聊天记录", QIcon.fromTheme("document-save"))
         export_btn.clicked.connect(self.export_chat_history)
         button_layout.addWidget(export_btn)
         
+        diagnostics_btn = MetroButton("  诊断", QIcon.fromTheme("utilities-system-monitor"))
+        diagnostics_btn.clicked.connect(self.show_diagnostics)
+        button_layout.addWidget(diagnostics_btn)
+        
         left_layout.addWidget(button_panel)
         
         # 右侧聊天面板
@@ -265,9 +642,17 @@ class ChatWindow(QMainWindow):
         right_layout.addWidget(status_bar)
         
         # 聊天显示区域
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setStyleSheet("border: 1px solid #E0E0E0; border-radius: 4px;")
+        self.chat_model = MessageModel(self)
+        self.chat_display = QListView()
+        self.chat_display.setModel(self.chat_model)
+        self.chat_display.setItemDelegate(BubbleDelegate(self.chat_display))
+        self.chat_display.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.chat_display.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.chat_display.setResizeMode(QListView.Adjust)
+        self.chat_display.setSelectionMode(QAbstractItemView.NoSelection)
+        self.chat_display.setFocusPolicy(Qt.NoFocus)
+        self.chat_display.setStyleSheet("QListView { border: 1px solid #E0E0E0; border-radius: 4px; background: white; }")
+        self.chat_display.verticalScrollBar().valueChanged.connect(self.on_history_scrolled)
         right_layout.addWidget(self.chat_display, 1)
         
         # 消息输入区域
@@ -326,6 +711,12 @@ class ChatWindow(QMainWindow):
         self.file_info_label.setVisible(False)
         input_layout.addWidget(self.file_info_label)
         
+        # 文件传输进度
+        self.transfer_label = QLabel()
+        self.transfer_label.setStyleSheet("color: #0078D7; font-size: 12px;")
+        self.transfer_label.setVisible(False)
+        input_layout.addWidget(self.transfer_label)
+        
         right_layout.addWidget(input_panel)
         
         # 添加左右面板到主布局
@@ -333,185 +724,280 @@ class ChatWindow(QMainWindow):
         main_layout.addWidget(right_panel, 1)
         
         # 初始化网络变量
-        self.server_socket = None
-        self.client_socket = None
-        self.connection_thread = None
-        self.listening = False
+        self.batching = False      # 正在批量处理网络事件, 新消息先放入 pending_entries
+        self.pending_entries = []
+        self.certificate_prompts = set()   # 正在询问是否信任新证书的联系人
         self.current_file = None
         self.current_connection = None
         
+        # 聊天记录分页状态: 已加载的最早一条消息ID, 是否还有更早的记录, 是否正在加载
+        self.history = HistoryLoader(self.db, self)
+        self.history.page_loaded.connect(self.on_history_page)
+        self.history.search_done.connect(self.on_search_done)
+        self.history_oldest = None
+        self.history_newest = None
+        self.history_more = False
+        self.history_newer = False   # 跳转到中间位置后, 当前页之后还有未加载的消息
+        self.history_loading = False
+        self.search_pending = None
+        self.contact_match_count = 0
+        self.export_task = None
+        self.export_dialog = None
+        self.diagnostics = None
+        
         # 获取并显示本机信息
         self.local_ip = get_local_ip()
         self.ip_label.setText(f"本机IP: {self.local_ip}")
         
-        # 自动选择并监听端口
-        self.listen_port = self.find_available_port()
-        self.start_listening(self.listen_port)
+        # 监听上次使用的端口(被占用时随机选择), 并开始局域网发现
+        self.listen_port = self.start_listening()
         self.port_label.setText(f"监听端口: {self.listen_port}")
         self.status_label.setText("状态: 正在监听")
-        
-        # 加载连接列表
-        self.load_connections()
-    
-    def find_available_port(self):
-        """自动寻找可用端口"""
-        for _ in range(10):
-            try:
-                port = random.randint(10000, 20000)
-                test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                test_socket.bind(('', port))
-                test_socket.close()
-                return port
-            except:
-                continue
-        return 9090
     
-    def load_connections(self):
-        self.connection_list.clear()
-        connections = self.db.get_connections()
-        for conn in connections:
-            conn_id, name, ip, port, last_active = conn
-            item = ConnectionItem(conn_id, name, ip, port, last_active)
-            self.connection_list.addItem(item)
-    
-    def start_listening(self, port):
+    def start_listening(self, port=None):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(('0.0.0.0', port))
-            self.server_socket.listen(5)
-            self.listening = True
-            
-            # 启动监听线程
-            self.connection_thread = threading.Thread(target=self.accept_connections, daemon=True)
-            self.connection_thread.start()
-            
+            port = self.core.start(port)
             self.show_system_message(f"正在监听端口 {port}...")
         except Exception as e:
             self.status_label.setText("状态: 监听失败")
             self.show_system_message(f"监听失败: {str(e)}")
+            return None
+        try:
+            self.core.start_discovery()
+        except OSError as e:
+            self.show_system_message(f"局域网发现不可用: {e}")
+        return port
     
-    def accept_connections(self):
-        while self.listening:
-            try:
-                client_socket, addr = self.server_socket.accept()
-                ip, port = addr
-                
-                # 更新状态
-                self.status_label.setText(f"状态: 已连接 {ip}:{port}")
-                
-                # 检查是否已有该连接
-                existing = False
-                conn_id = None
-                for i in range(self.connection_list.count()):
-                    item = self.connection_list.item(i)
-                    if item.ip == ip:
-                        conn_id = item.conn_id
-                        existing = True
-                        break
-                
-                if not existing:
-                    # 创建新连接
-                    conn_id = self.db.add_connection(f"{ip}:{port}", ip, port)
-                    item = ConnectionItem(conn_id, f"{ip}:{port}", ip, port, datetime.datetime.now().isoformat())
-                    self.connection_list.addItem(item)
-                
-                self.current_connection = conn_id
-                self.client_socket = client_socket
-                self.show_system_message(f"{ip}:{port} 已连接到本机")
-                
-                # 启动接收线程
-                threading.Thread(target=self.receive_messages, args=(client_socket,), daemon=True).start()
-            except:
-                if self.listening:
-                    self.status_label.setText("状态: 监听已停止")
-                break
+    def on_network_events(self, events):
+        """处理一帧内积累的网络事件: 传输进度只保留每个传输的最后一次, 新消息合并成一次插入和滚动"""
+        metrics = self.core.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+            metrics.observe('gui.event_batch', len(events), SIZE_BUCKETS)
+        latest = {}
+        for i, (kind, data) in enumerate(events):
+            if kind == 'transfer_progress':
+                latest[data['transfer_id']] = i
+        self.batching = True
+        try:
+            for i, (kind, data) in enumerate(events):
+                if kind == 'transfer_progress' and latest[data['transfer_id']] != i:
+                    continue
+                self.on_network_event(kind, data)
+        finally:
+            self.batching = False
+            self.flush_entries()
+        if metrics is not None:
+            metrics.observe('stage.render', (time.perf_counter() - start) * 1000)
+    
+    def flush_entries(self):
+        if self.pending_entries:
+            self.chat_model.extend(self.pending_entries)
+            self.pending_entries = []
+            self.chat_display.scrollToBottom()
+    
+    def on_network_event(self, kind, data):
+        """在GUI线程中处理网络引擎发出的事件: 先由核心更新会话绑定和聊天记录, 再更新界面"""
+        data = self.core.handle_event(kind, data)
+        if kind == 'connected':
+            self.on_session_connected(data)
+        elif kind == 'connect_failed':
+            self.status_label.setText("状态: 连接失败")
+            self.show_system_message(f"连接失败: {data['error']}")
+            if data.get('fingerprint') and data['contact'] not in (None, *self.certificate_prompts):
+                # 模态对话框有自己的事件循环, 在本批事件处理完之后再弹出, 同一联系人只询问一次
+                self.certificate_prompts.add(data['contact'])
+                QTimer.singleShot(0, lambda: self.confirm_new_certificate(data))
+        elif kind == 'message' and not (data.get('duplicate') or data.get('out_of_order')):
+            self.handle_control_message(data.get('conversation', data['contact']), data['message'],
+                                        data.get('resumed', False), data.get('sender', "对方"))
+        elif kind == 'transfer_progress':
+            self.show_transfer_progress(data)
+        elif kind == 'transfer_done':
+            self.transfer_label.setVisible(False)
+            stats = f"{data['throughput'] / (1024 * 1024):.1f} MB/s"
+            if data['compression_ratio'] > 1.01:
+                stats += f", 压缩比 {data['compression_ratio']:.1f}:1"
+            if data['deduplicated']:
+                stats = "已有相同内容, 未传输数据"
+            if data['outgoing']:
+                self.show_system_message(f"文件发送完成: {data['file_name']} ({stats})")
+            else:
+                self.show_system_message(f"文件已保存到: {data['path']} ({stats})")
+        elif kind == 'transfer_failed':
+            self.transfer_label.setVisible(False)
+            self.show_system_message(f"文件传输中断: {data['file_name']} ({data['error']})")
+        elif kind == 'disconnected':
+            if data['unbound'] and data['contact'] == self.current_connection:
+                reason = f": {data['error']}" if data['error'] else ""
+                suffix = ", 正在自动重连" if data['reconnecting'] else ""
+                self.show_system_message(f"连接已断开{reason}{suffix}")
+            self.update_status()
+        elif kind == 'synced' and data['added']:
+            # 同步补齐的记录可能插在已显示的消息之间, 重新加载当前联系人的最后一页
+            if data['contact'] == self.current_connection:
+                self.select_contact(data['contact'])
+            else:
+                self.mark_unread(data['contact'])
+        elif kind == 'reconnecting':
+            self.status_label.setText(f"状态: {data['delay']:.0f} 秒后重连 {data['ip']}:{data['port']}"
+                                      f" (第 {data['attempt']} 次)")
+        elif kind == 'error':
+            self.show_system_message(data['error'])
+    
+    def on_session_connected(self, data):
+        conn_id, ip, port, outgoing = data['contact'], data['ip'], data['port'], data['outgoing']
+        self.update_status()
+        secure = f" ({data['tls']}{', 会话复用' if data['resumed'] else ''})" if data['tls'] else ""
+        if outgoing:
+            self.show_system_message(f"已连接到 {ip}:{port}{secure}")
+        else:
+            self.show_system_message(f"{ip}:{port} 已连接到本机{secure}")
+        
+        # 没有正在查看的联系人时切换到新会话, 否则不打断当前聊天
+        if self.current_connection is None or (outgoing and conn_id == self.current_connection):
+            self.select_contact(conn_id)
+        for file_path in data['resumed_files']:
+            self.show_system_message(f"继续发送文件: {os.path.basename(file_path)}")
+    
+    def confirm_new_certificate(self, data):
+        """对端出示的证书与首次连接时记录的不同: 对方重新安装过时可以信任新证书并重新连接"""
+        answer = QMessageBox.warning(
+            self, "证书不一致",
+            f"{data['ip']}:{data['port']} 出示的证书与首次连接时记录的不同, 可能有人冒充对方。\n"
+            f"新证书指纹: {data['fingerprint']}\n\n确认对方重新安装过后才应信任新证书。是否信任并重新连接?",
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        self.certificate_prompts.discard(data['contact'])
+        if answer == QMessageBox.Yes:
+            self.core.forget_certificate(data['contact'])
+            self.core.connect(data['contact'])
+    
+    def update_status(self):
+        count = len(self.core.contact_sessions)
+        if count:
+            self.status_label.setText(f"状态: 已连接 {count} 个会话")
+        else:
+            self.status_label.setText("状态: 正在监听")
     
     def connect_to_selected(self):
         """连接到选中的联系人"""
-        selected_item = self.connection_list.currentItem()
-        if not selected_item:
+        selected = self.connection_list.currentIndex()
+        if not selected.isValid():
             QMessageBox.warning(self, "未选择连接", "请先在连接列表中选择一个连接")
             return
             
+        # 群组: 连接所有尚未连接的成员
+        conn_id = selected.data(ContactListModel.ContactRole).id
+        if conn_id < 0:
+            self.select_contact(conn_id)
+            members = self.db.get_group_members(-conn_id)
+            for member in members:
+                self.core.connect(member[0])
+            self.show_system_message(f"正在连接群组的 {len(members)} 位成员")
+            return
+        
         # 获取连接信息
-        conn_id = selected_item.conn_id
-        connection = self.db.get_connection_by_id(conn_id)
-        if not connection:
+        contact = self.core.contacts.get(conn_id)
+        if contact is None:
             QMessageBox.warning(self, "连接错误", "无法获取连接信息")
             return
             
-        _, name, ip, port, _ = connection
+        ip, port = contact.ip, contact.port
+        self.select_contact(conn_id)
         
-        # 关闭现有连接（如果有）
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
-            self.client_socket = None
-        
-        try:
-            # 创建新的socket连接
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((ip, port))
-            
-            # 更新状态
-            self.status_label.setText(f"状态: 已连接到 {ip}:{port}")
+        # 已有会话时直接使用, 其他联系人的会话保持不变
+        if self.core.connect(conn_id) is not None:
             self.show_system_message(f"已连接到 {ip}:{port}")
-            
-            # 设置当前连接
-            self.current_connection = conn_id
-            
-            # 启动接收线程
-            threading.Thread(target=self.receive_messages, args=(self.client_socket,), daemon=True).start()
-            
-            # 加载聊天记录
-            self.chat_display.clear()
-            messages = self.db.get_messages(self.current_connection)
-            for msg in messages:
-                sender, message, timestamp, file_path = msg
-                self.show_message(sender, message, file_path)
-                
-        except Exception as e:
-            self.status_label.setText("状态: 连接失败")
-            self.show_system_message(f"连接失败: {str(e)}")
+            return
+        
+        # 连接在网络线程中建立, 结果通过 connected/connect_failed 事件返回
+        self.status_label.setText(f"状态: 正在连接 {ip}:{port}")
     
-    def receive_messages(self, sock):
-        while True:
-            try:
-                data = sock.recv(4096).decode('utf-8')
-                if not data:
-                    self.status_label.setText("状态: 连接已断开")
-                    break
-                
-                # 解析消息
-                try:
-                    message = json.loads(data)
-                    if message['type'] == 'text':
-                        self.db.save_message(self.current_connection, "对方", message['content'])
-                        self.show_message("对方", message['content'])
-                    elif message['type'] == 'file':
-                        file_name = message['file_name']
-                        file_size = int(message['file_size'])
-                        self.db.save_message(self.current_connection, "对方", f"[文件] {file_name}", file_name)
-                        self.show_message("对方", f"[文件] {file_name}")
-                except json.JSONDecodeError:
-                    self.show_system_message(f"收到消息: {data}")
-            except Exception as e:
-                self.show_system_message(f"接收错误: {str(e)}")
-                self.status_label.setText("状态: 连接错误")
-                break
+    def handle_control_message(self, conn_id, message, resumed=False, sender="对方"):
+        if conn_id is None:
+            return
+        if message['type'] in ('text', 'group_text'):
+            if conn_id == self.current_connection:
+                self.show_message(sender, message['content'])
+            else:
+                self.mark_unread(conn_id)
+        elif message['type'] == 'file':
+            file_name = message['file_name']
+            if resumed:
+                self.show_system_message(f"继续接收文件: {file_name}")
+                return
+            if conn_id == self.current_connection:
+                self.show_message(sender, f"[文件] {file_name}")
+            else:
+                self.mark_unread(conn_id)
+    
+    def mark_unread(self, conn_id):
+        self.contact_model.set_unread(conn_id, True)
+    
+    def show_transfer_progress(self, data):
+        direction = "发送" if data['outgoing'] else "接收"
+        percent = data['done'] * 100 / data['size'] if data['size'] else 100
+        rate = data['throughput'] / (1024 * 1024)
+        text = f"{direction} {data['file_name']}: {percent:.0f}%  {rate:.1f} MB/s  ({data['streams']} 条连接)"
+        if data['compression_ratio'] > 1.01:
+            text += f"  压缩比 {data['compression_ratio']:.1f}:1"
+        self.transfer_label.setText(text)
+        self.transfer_label.setVisible(True)
+    
+    def show_new_group_dialog(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("新建群组")
+        dialog.resize(300, 400)
+        
+        layout = QVBoxLayout(dialog)
+        name_edit = QLineEdit()
+        name_edit.setPlaceholderText("群组名称")
+        layout.addWidget(name_edit)
+        
+        # 勾选要加入群组的联系人
+        member_list = QListWidget()
+        for contact in self.core.contacts:
+            if contact.ip is None:
+                continue
+            item = QListWidgetItem(f"{contact.name} ({contact.ip}:{contact.port})")
+            item.setData(Qt.UserRole, contact.id)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Unchecked)
+            member_list.addItem(item)
+        layout.addWidget(member_list)
+        
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        button_box.accepted.connect(dialog.accept)
+        button_box.rejected.connect(dialog.reject)
+        layout.addWidget(button_box)
+        
+        if dialog.exec_() == QDialog.Accepted:
+            name = name_edit.text().strip()
+            members = [member_list.item(i).data(Qt.UserRole) for i in range(member_list.count())
+                       if member_list.item(i).checkState() == Qt.Checked]
+            if not name or not members:
+                QMessageBox.warning(self, "输入错误", "请填写群组名称并至少选择一位成员")
+                return
+            group_id = self.core.create_group(name, members)
+            self.select_contact(-group_id)
     
     def show_new_connection_dialog(self):
         dialog = QDialog(self)
         dialog.setWindowTitle("新建连接")
-        dialog.setFixedSize(300, 200)
+        dialog.setFixedSize(300, 230)
         
         layout = QVBoxLayout(dialog)
         
         form_layout = QFormLayout()
         
+        # 局域网中发现的对端, 选中后填入下面的字段
+        peer_combo = QComboBox()
+        peers = self.core.discovered_peers()
+        peer_combo.addItem("手动输入" if peers else "未发现局域网用户", None)
+        for peer in peers:
+            peer_combo.addItem(f"{peer['name']} ({peer['ip']}:{peer['port']})", peer)
+        form_layout.addRow("局域网:", peer_combo)
+        
         name_edit = QLineEdit()
         name_edit.setPlaceholderText("连接名称")
         form_layout.addRow("名称:", name_edit)
@@ -524,6 +1010,14 @@ class ChatWindow(QMainWindow):
         port_edit.setPlaceholderText("端口号")
         form_layout.addRow("端口号:", port_edit)
         
+        def fill_peer(index):
+            peer = peer_combo.itemData(index)
+            if peer is not None:
+                name_edit.setText(peer['name'])
+                ip_edit.setText(peer['ip'])
+                port_edit.setText(str(peer['port']))
+        peer_combo.currentIndexChanged.connect(fill_peer)
+        
         # 添加提示信息
         info_label = QLabel(f"您的信息:\nIP: {self.local_ip}\n端口: {self.listen_port}")
         info_label.setStyleSheet("font-size: 12px; color: #0078D7;")
@@ -551,22 +1045,146 @@ class ChatWindow(QMainWindow):
                 QMessageBox.warning(self, "输入错误", "端口号必须是数字")
                 return
                 
-            # 添加到数据库
-            conn_id = self.db.add_connection(name, ip, port)
-            
-            # 添加到连接列表
-            item = ConnectionItem(conn_id, name, ip, port, datetime.datetime.now().isoformat())
-            self.connection_list.addItem(item)
+            # 添加到数据库和连接列表, 已存在的 (ip, port) 只更新名称
+            peer = peer_combo.currentData()
+            peer_id = peer['peer_id'] if peer is not None and (peer['ip'], peer['port']) == (ip, port) else None
+            self.core.add_contact(name, ip, port, peer_id)
     
-    def on_connection_selected(self, item):
-        self.current_connection = item.conn_id
-        self.chat_display.clear()
+    def on_connection_selected(self, index):
+        self.select_contact(index.data(ContactListModel.ContactRole).id)
+    
+    def select_contact(self, conn_id, message_id=None):
+        """切换到联系人; 指定 message_id 时显示该消息附近的一页并高亮它"""
+        self.current_connection = conn_id
+        index = self.contact_model.index_of(conn_id)
+        if index.isValid():
+            self.connection_list.setCurrentIndex(index)
+        self.contact_model.set_unread(conn_id, False)
+        self.history_more = self.history_newer = False
+        self.history_loading = False
+        self.pending_entries = []
+        self.chat_model.reset()
         
-        # 加载聊天记录
-        messages = self.db.get_messages(self.current_connection)
-        for msg in messages:
-            sender, message, timestamp, file_path = msg
-            self.show_message(sender, message, file_path)
+        # 只加载一页, 其余记录在滚动到顶部或底部时由后台线程读取
+        if message_id is None:
+            # 结尾可能带有写入队列中尚未提交的消息(id 为 None), 不计入页大小
+            rows = self.db.get_messages_before(conn_id)
+            self.history_more = sum(row[0] is not None for row in rows) == HISTORY_PAGE_SIZE
+        else:
+            rows = self.db.get_messages_around(conn_id, message_id)
+            self.history_more = True
+            self.history_newer = True
+        self.history_oldest = rows[0][0] if rows else None
+        self.history_newest = rows[-1][0] if rows else None
+        self.chat_model.reset(history_entries(rows), message_id)
+        row = self.chat_model.row_of(message_id) if message_id is not None else None
+        if row is None:
+            self.chat_display.scrollToBottom()
+        else:
+            self.chat_display.scrollTo(self.chat_model.index(row), QAbstractItemView.PositionAtCenter)
+        self.request_history()
+    
+    def request_history(self):
+        """滚动条接近顶部或底部(或内容不足一屏)时请求相邻的一页"""
+        if self.history_loading or self.history_oldest is None:
+            return
+        scroll_bar = self.chat_display.verticalScrollBar()
+        if self.history_more and scroll_bar.value() <= HISTORY_PREFETCH:
+            self.history_loading = True
+            self.history.request(self.current_connection, self.history_oldest, True)
+        elif self.history_newer and scroll_bar.maximum() - scroll_bar.value() <= HISTORY_PREFETCH:
+            self.history_loading = True
+            self.history.request(self.current_connection, self.history_newest, False)
+    
+    def on_history_scrolled(self, value):
+        self.request_history()
+    
+    def on_history_page(self, conn_id, anchor_id, older, rows):
+        # 切换联系人后到达的旧请求结果直接丢弃
+        if conn_id != self.current_connection:
+            return
+        if anchor_id != (self.history_oldest if older else self.history_newest):
+            return
+        metrics = self.core.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        self.history_loading = False
+        if older:
+            self.history_more = len(rows) == HISTORY_PAGE_SIZE
+            if rows:
+                self.history_oldest = rows[0][0]
+                self.prepend_messages(rows)
+        else:
+            self.history_newer = len(rows) == HISTORY_PAGE_SIZE
+            if rows:
+                self.history_newest = rows[-1][0]
+                self.chat_model.extend(history_entries(rows))
+        if metrics is not None:
+            metrics.observe('stage.render', (time.perf_counter() - start) * 1000)
+        self.request_history()
+    
+    def prepend_messages(self, rows):
+        # 在开头插入一页旧消息, 并保持当前可见内容不动
+        scroll_bar = self.chat_display.verticalScrollBar()
+        from_bottom = scroll_bar.maximum() - scroll_bar.value()
+        self.chat_model.prepend(history_entries(rows))
+        self.chat_display.doItemsLayout()
+        scroll_bar.setValue(scroll_bar.maximum() - from_bottom)
+    
+    def on_search_text_changed(self, text):
+        searching = bool(text.strip())
+        self.search_results.setVisible(searching)
+        self.connection_list.setVisible(not searching)
+        self.show_contact_matches(text.strip())
+        self.schedule_search()
+    
+    def show_contact_matches(self, text):
+        # 联系人在内存中过滤, 不等待消息搜索, 随输入立即更新
+        self.search_results.clear()
+        matches = self.core.contacts.search(text, CONTACT_MATCH_LIMIT) if text else []
+        for contact in matches:
+            kind = "群组" if contact.ip is None else f"{contact.ip}:{contact.port}"
+            item = QListWidgetItem(f"{contact.name}\n{kind}  {contact.active_text}")
+            item.setData(Qt.UserRole, (contact.id,))
+            item.setFont(self.contact_model.unread_font)
+            self.search_results.addItem(item)
+        self.contact_match_count = len(matches)
+    
+    def schedule_search(self):
+        self.search_timer.start()
+    
+    def run_search(self):
+        query = self.search_box.text().strip()
+        if not query:
+            self.search_pending = None
+            return
+        filters = {}
+        if self.search_scope.currentIndex() == 1 and self.current_connection:
+            filters['connection_id'] = self.current_connection
+        days = self.search_range.currentData()
+        if days:
+            filters['since'] = now_us() - days * 86400 * 1_000_000
+        self.search_pending = self.history.search(query, **filters)
+    
+    def on_search_done(self, serial, rows):
+        if serial != self.search_pending:
+            return
+        # 保留顶部的联系人匹配, 只替换消息结果
+        while self.search_results.count() > self.contact_match_count:
+            self.search_results.takeItem(self.contact_match_count)
+        if not rows:
+            self.search_results.addItem("没有找到匹配的消息")
+            return
+        for message_id, conn_id, sender, ts, snippet in rows:
+            contact = self.core.contacts.get(conn_id)
+            item = QListWidgetItem(f"{contact.name if contact else '?'} · {sender}  {format_ts(ts, '%Y-%m-%d %H:%M')}\n{snippet}")
+            item.setData(Qt.UserRole, (conn_id, message_id))
+            self.search_results.addItem(item)
+    
+    def on_search_result_selected(self, item):
+        target = item.data(Qt.UserRole)
+        if target:
+            self.select_contact(*target)
     
     def attach_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "选择文件", "", "所有文件 (*.*)")
@@ -582,39 +1200,40 @@ class ChatWindow(QMainWindow):
             QMessageBox.warning(self, "未选择连接", "请先选择一个连接")
             return
             
-        if not self.client_socket:
-            QMessageBox.warning(self, "未连接", "没有活动连接，请先连接")
+        online = self.current_connection in self.core.contact_sessions
+        
+        # 群组: 发给在线的成员, 历史只保存一份
+        if self.current_connection < 0:
+            group_id = -self.current_connection
+            if self.current_file:
+                sent, total = self.core.send_group_file(group_id, self.current_file)
+                self.show_message("我", f"[文件] {os.path.basename(self.current_file)}")
+                self.current_file = None
+                self.file_info_label.setVisible(False)
+            else:
+                message = self.message_input.toPlainText().strip()
+                if not message:
+                    return
+                sent, total = self.core.send_group_text(group_id, message)
+                self.show_message("我", message)
+                self.message_input.clear()
+            if sent < total:
+                self.show_system_message(f"已发给 {sent}/{total} 位在线成员")
             return
-            
+        
         # 处理文件发送
         if self.current_file:
+            if not online:
+                QMessageBox.warning(self, "未连接", "没有活动连接，请先连接")
+                return
             file_name = os.path.basename(self.current_file)
-            file_size = os.path.getsize(self.current_file)
             
-            # 发送文件信息
-            file_info = {
-                'type': 'file',
-                'file_name': file_name,
-                'file_size': file_size
-            }
-            try:
-                self.client_socket.sendall(json.dumps(file_info).encode('utf-8'))
-                self.db.save_message(self.current_connection, "我", f"[文件] {file_name}", self.current_file)
-                self.show_message("我", f"[文件] {file_name}")
-                
-                # 分块发送文件内容
-                with open(self.current_file, 'rb') as f:
-                    while True:
-                        data = f.read(4096)
-                        if not data:
-                            break
-                        self.client_socket.sendall(data)
-                
-                self.current_file = None
-                self.file_info_label.setVisible(False)
-                self.show_system_message("文件发送完成")
-            except Exception as e:
-                self.show_system_message(f"文件发送失败: {str(e)}")
+            # 文件内容在网络线程中发送, 进度通过 transfer_* 事件返回
+            self.core.send_file(self.current_connection, self.current_file)
+            self.show_message("我", f"[文件] {file_name}")
+            
+            self.current_file = None
+            self.file_info_label.setVisible(False)
             return
         
         # 处理文本消息
@@ -622,98 +1241,104 @@ class ChatWindow(QMainWindow):
         if not message:
             return
             
-        try:
-            # 发送消息
-            msg_data = {
-                'type': 'text',
-                'content': message
-            }
-            self.client_socket.sendall(json.dumps(msg_data).encode('utf-8'))
-            
-            # 保存到数据库
-            self.db.save_message(self.current_connection, "我", message)
-            
-            # 显示消息
-            self.show_message("我", message)
-            
-            # 清空输入框
-            self.message_input.clear()
-        except Exception as e:
-            self.show_system_message(f"发送失败: {str(e)}")
-    
-    def show_message(self, sender, message, file_path=None):
-        # 添加时间戳
-        timestamp = datetime.datetime.now().strftime("%H:%M")
-        
-        # 格式化消息
-        if sender == "我":
-            text = f'<div style="margin: 10px 20px 10px 100px;">'
-            text += f'<div style="background-color: #0078D7; color: white; border-radius: 10px; padding: 8px 12px; float: right; max-width: 70%;">'
-            if file_path:
-                file_name = os.path.basename(file_path)
-                text += f'<div style="font-weight: bold;">[文件] {file_name}</div>'
-            else:
-                text += message
-            text += f'<div style="font-size: 10px; text-align: right; opacity: 0.8; margin-top: 5px;">{timestamp}</div>'
-            text += '</div>'
-            text += '<div style="clear: both;"></div>'
-            text += '</div>'
-        else:
-            text = f'<div style="margin: 10px 100px 10px 20px;">'
-            text += f'<div style="background-color: #E0E0E0; color: black; border-radius: 10px; padding: 8px 12px; float: left; max-width: 70%;">'
-            if file_path:
-                file_name = os.path.basename(file_path)
-                text += f'<div style="font-weight: bold;">[文件] {file_name}</div>'
-            else:
-                text += message
-            text += f'<div style="font-size: 10px; text-align: left; opacity: 0.8; margin-top: 5px;">{timestamp}</div>'
-            text += '</div>'
-            text += '<div style="clear: both;"></div>'
-            text += '</div>'
+        # 保存到数据库后发送, 不在线时留在发件箱中
+        self.core.send_text(self.current_connection, message)
         
-        self.chat_display.append(text)
+        # 显示消息
+        self.show_message("我", message)
+        if not online:
+            self.show_system_message("对方不在线, 消息将在连接后发送")
         
-        # 滚动到底部
-        scroll_bar = self.chat_display.verticalScrollBar()
-        scroll_bar.setValue(scroll_bar.maximum())
+        # 清空输入框
+        self.message_input.clear()
+    
+    def show_message(self, sender, message, file_path=None, ts=None):
+        # 正在查看中间的历史时新消息不追加到末尾, 自己发出消息时回到最新位置
+        if self.history_newer:
+            if sender == "我":
+                self.select_contact(self.current_connection)
+            return
+        self.add_entry(chat_entry(sender, message, now_us() if ts is None else ts, file_path))
     
     def show_system_message(self, message):
-        text = f'<div style="text-align: center; color: #606060; margin: 10px;">'
-        text += f'<div style="font-size: 12px; font-style: italic;">{message}</div>'
-        text += '</div>'
-        
-        self.chat_display.append(text)
-        
-        # 滚动到底部
-        scroll_bar = self.chat_display.verticalScrollBar()
-        scroll_bar.setValue(scroll_bar.maximum())
+        self.add_entry(ChatEntry(None, None, message, now_us(), True))
+    
+    def add_entry(self, entry):
+        if self.batching:
+            self.pending_entries.append(entry)
+            return
+        self.chat_model.append(entry)
+        self.chat_display.scrollToBottom()
     
     def export_chat_history(self):
-        if not self.current_connection:
-            QMessageBox.warning(self, "未选择连接", "请先选择一个连接")
+        if self.export_task is not None:
+            QMessageBox.information(self, "正在导出", "上一次导出尚未完成")
             return
+        connection_id = None
+        if self.current_connection:
+            scope, ok = QInputDialog.getItem(self, "导出聊天记录", "导出范围:", ["当前联系人", "全部联系人"], 0, False)
+            if not ok:
+                return
+            if scope == "当前联系人":
+                connection_id = self.current_connection
             
         file_path, _ = QFileDialog.getSaveFileName(
-            self, "导出聊天记录", "", "文本文件 (*.txt);;所有文件 (*)"
+            self, "导出聊天记录", "",
+            "文本文件 (*.txt);;JSON Lines (*.jsonl);;CSV 文件 (*.csv);;"
+            "gzip 压缩 (*.txt.gz *.jsonl.gz *.csv.gz);;所有文件 (*)"
         )
+        if not file_path:
+            return
         
-        if file_path:
-            try:
-                self.db.export_chat(self.current_connection, file_path)
-                QMessageBox.information(self, "导出成功", f"聊天记录已导出到: {file_path}")
-            except Exception as e:
-                QMessageBox.critical(self, "导出失败", f"导出失败: {str(e)}")
+        # 导出在后台线程中进行, 进度对话框可以取消
+        self.export_dialog = QProgressDialog("正在导出聊天记录...", "取消", 0, 0, self)
+        self.export_dialog.setWindowTitle("导出聊天记录")
+        self.export_dialog.setMinimumDuration(300)
+        self.export_task = ExportTask(self.db, connection_id, file_path, self)
+        self.export_task.progress.connect(self.on_export_progress)
+        self.export_task.finished.connect(self.on_export_finished)
+        self.export_task.failed.connect(self.on_export_failed)
+        self.export_dialog.canceled.connect(self.export_task.cancel)
+        self.export_task.start()
+    
+    def on_export_progress(self, done, total):
+        if self.export_dialog is not None:
+            self.export_dialog.setMaximum(total)
+            self.export_dialog.setValue(done)
+    
+    def end_export(self):
+        path = self.export_task.file_path
+        self.export_task = None
+        self.export_dialog.canceled.disconnect()
+        self.export_dialog.close()
+        self.export_dialog = None
+        return path
+    
+    def on_export_finished(self, count):
+        path = self.end_export()
+        QMessageBox.information(self, "导出成功", f"已导出 {count} 条聊天记录到: {path}")
+    
+    def on_export_failed(self, error):
+        self.end_export()
+        if error:
+            QMessageBox.critical(self, "导出失败", f"导出失败: {error}")
+        else:
+            self.show_system_message("导出已取消")
+    
+    def show_diagnostics(self):
+        if self.diagnostics is None:
+            self.diagnostics = DiagnosticsDialog(self.core, self)
+        self.diagnostics.show()
+        self.diagnostics.raise_()
+        self.diagnostics.activateWindow()
     
     def closeEvent(self, event):
         # 关闭时清理资源
-        self.listening = False
-        try:
-            if self.server_socket:
-                self.server_socket.close()
-            if self.client_socket:
-                self.client_socket.close()
-        except:
-            pass
+        if self.export_task is not None:
+            self.export_task.cancel()
+            self.export_task.thread.join()
+        self.history.close()
+        self.core.stop()
         event.accept()
 
 if __name__ == "__main__":
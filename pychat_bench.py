@@ -0,0 +1,471 @@
+# PyChat 性能基准: 全部在本机回环地址上运行, 结果输出为JSON, 可以与保存的基线比较
+#
+#   python pychat_bench.py --output bench.json
+#   python pychat_bench.py --quick --baseline bench.json      # 与基线比较, 有退化时返回码为1
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import sqlite3
+import platform
+import tempfile
+import argparse
+import threading
+import queue
+from pychat_core import CONNECT_TIMEOUT, ChatCore, ChatDatabase, NetworkEngine, TLSConfig, find_available_port, now_us
+
+# 每项指标: 名称 -> {'value': 数值, 'unit': 单位, 'better': 'higher' 或 'lower'}
+def metric(value, unit, better):
+    return {'value': round(value, 4), 'unit': unit, 'better': better}
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+# 一对通过回环地址互联的网络引擎, 事件在网络线程中直接回调
+class EnginePair:
+    def __init__(self, workdir, **options):
+        self.handlers = {'a': None, 'b': None}
+        self.connected = {'a': threading.Event(), 'b': threading.Event()}
+        self.disconnected = threading.Event()
+        self.a = NetworkEngine(lambda kind, data: self._event('a', kind, data), **options)
+        self.b = NetworkEngine(lambda kind, data: self._event('b', kind, data),
+                               download_dir=os.path.join(workdir, 'received'), **options)
+        self.b.start(find_available_port())
+        self.a.start(find_available_port())
+        self.session = self.a.connect('127.0.0.1', self.b.listen_port).result(CONNECT_TIMEOUT)
+        # 双方都收到 hello 后才算连接完成, 此时压缩算法已经协商好
+        if self.session is None or not all(event.wait(CONNECT_TIMEOUT) for event in self.connected.values()):
+            raise RuntimeError("回环连接建立失败")
+
+    def _event(self, side, kind, data):
+        if kind == 'connected':
+            self.connected[side].set()
+        elif kind == 'disconnected' and side == 'a':
+            self.disconnected.set()
+        handler = self.handlers[side]
+        if handler is not None:
+            handler(kind, data)
+
+    def reconnect(self):
+        """断开后重新连接, 返回发起连接到完成TCP连接(和TLS握手)的时间(毫秒)"""
+        self.disconnected.clear()
+        self.a.close(self.session).result(CONNECT_TIMEOUT)
+        if not self.disconnected.wait(CONNECT_TIMEOUT):
+            raise RuntimeError("回环连接未断开")
+        self.connected['a'].clear()
+        start = time.perf_counter()
+        self.session = self.a.connect('127.0.0.1', self.b.listen_port).result(CONNECT_TIMEOUT)
+        elapsed = (time.perf_counter() - start) * 1000
+        if self.session is None or not self.connected['a'].wait(CONNECT_TIMEOUT):
+            raise RuntimeError("回环连接建立失败")
+        return elapsed
+
+    def close(self):
+        self.a.stop()
+        self.b.stop()
+
+def bench_messages(workdir, count):
+    """消息往返延迟(逐条发送等待回显)和单向吞吐量(连续发送)"""
+    pair = EnginePair(workdir)
+    try:
+        # b 收到 echo 后立即回显
+        def echo(kind, data):
+            if kind == 'message' and data['message']['type'] == 'echo':
+                pair.b.send_message(data['session'], {'type': 'echo_reply', 'seq': data['message']['seq']})
+        pair.handlers['b'] = echo
+        pong = threading.Event()
+        pair.handlers['a'] = lambda kind, data: kind == 'message' and pong.set()
+        samples = []
+        for seq in range(count):
+            pong.clear()
+            start = time.perf_counter()
+            pair.a.send_message(pair.session, {'type': 'echo', 'seq': seq, 'content': 'x' * 64})
+            if not pong.wait(5):
+                raise RuntimeError("消息回显超时")
+            samples.append((time.perf_counter() - start) * 1000)
+
+        received = [0]
+        done = threading.Event()
+        def receive(kind, data):
+            if kind == 'message':
+                received[0] += 1
+                if received[0] == count * 10:
+                    done.set()
+        pair.handlers['b'] = receive
+        start = time.perf_counter()
+        for seq in range(count * 10):
+            pair.a.send_message(pair.session, {'type': 'text', 'content': f"benchmark message {seq}"})
+        if not done.wait(60):
+            raise RuntimeError("消息接收超时")
+        elapsed = time.perf_counter() - start
+    finally:
+        pair.close()
+    return {
+        'message.rtt_p50': metric(percentile(samples, 50), 'ms', 'lower'),
+        'message.rtt_p90': metric(percentile(samples, 90), 'ms', 'lower'),
+        'message.rtt_p99': metric(percentile(samples, 99), 'ms', 'lower'),
+        'message.throughput': metric(count * 10 / elapsed, 'msg/s', 'higher'),
+    }
+
+# 一个 ChatCore 和处理其事件的线程; ChatCore 只能在一个线程中使用, 其他线程的调用也交给这个线程执行
+class CoreNode:
+    def __init__(self, workdir, name):
+        self.handler = None
+        self.events = queue.Queue()
+        self.core = ChatCore(lambda kind, data: self.events.put((kind, data)),
+                             db_name=os.path.join(workdir, f'{name}.db'), download_dir=os.path.join(workdir, 'received'),
+                             tls=False)
+        self.core.start(find_available_port())
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            kind, data = self.events.get()
+            if kind is None:
+                if data is None:
+                    return
+                data()
+                continue
+            data = self.core.handle_event(kind, data)
+            if self.handler is not None:
+                self.handler(kind, data)
+
+    def call(self, function, *args):
+        self.events.put((None, lambda: function(*args)))
+
+    def close(self):
+        self.events.put((None, None))
+        self.thread.join()
+        self.core.stop()
+
+def bench_delivery(workdir, count):
+    """经过 ChatCore 的文本消息: 发件箱、写入队列落盘、对端存储后确认的完整路径
+
+    测量对端收到(receive)和本端收到存储确认(ack)的延迟, 以及连续发送时全部确认的吞吐量。
+    """
+    a, b = CoreNode(workdir, 'delivery-a'), CoreNode(workdir, 'delivery-b')
+    try:
+        connected = threading.Event()
+        a.handler = lambda kind, data: kind == 'connected' and connected.set()
+        contact = a.core.add_contact('b', '127.0.0.1', b.core.listen_port)
+        a.call(a.core.connect, contact)
+        if not connected.wait(CONNECT_TIMEOUT):
+            raise RuntimeError("回环连接建立失败")
+        received, delivered = {}, {}    # 序号 -> 对端收到的时间 / 本端收到确认的时间
+        acked = [0]
+        progress = threading.Condition()
+        def on_b(kind, data):
+            if kind == 'message' and data['message']['type'] == 'text' and not data.get('duplicate'):
+                with progress:
+                    received[data['message']['seq']] = time.perf_counter()
+        def on_a(kind, data):
+            if data.get('delivered', 0) > acked[0]:
+                with progress:
+                    now = time.perf_counter()
+                    for seq in range(acked[0] + 1, data['delivered'] + 1):
+                        delivered[seq] = now
+                    acked[0] = data['delivered']
+                    progress.notify_all()
+        def wait_acked(seq, timeout):
+            with progress:
+                if not progress.wait_for(lambda: acked[0] >= seq, timeout):
+                    raise RuntimeError("消息确认超时")
+        b.handler, a.handler = on_b, on_a
+        # 对端的 sync 到达后才开始发送发件箱, 先发一条等它确认
+        a.call(a.core.send_text, contact, "warm up")
+        wait_acked(1, CONNECT_TIMEOUT)
+        receive, ack = [], []
+        for seq in range(2, count + 2):
+            start = time.perf_counter()
+            a.call(a.core.send_text, contact, f"delivery message {seq}")
+            wait_acked(seq, 5)
+            receive.append((received[seq] - start) * 1000)
+            ack.append((delivered[seq] - start) * 1000)
+        start = time.perf_counter()
+        for i in range(count * 10):
+            a.call(a.core.send_text, contact, f"delivery burst {i}")
+        wait_acked(count * 11 + 1, 60)
+        elapsed = time.perf_counter() - start
+    finally:
+        a.close()
+        b.close()
+    return {
+        'delivery.receive_p50': metric(percentile(receive, 50), 'ms', 'lower'),
+        'delivery.ack_p50': metric(percentile(ack, 50), 'ms', 'lower'),
+        'delivery.ack_p99': metric(percentile(ack, 99), 'ms', 'lower'),
+        'delivery.throughput': metric(count * 10 / elapsed, 'msg/s', 'higher'),
+    }
+
+def bench_fanout(workdir, peers, count):
+    """一条消息发给多个对端: 每条消息只编码一次, 测量全部对端收齐的速度"""
+    received = [0]
+    done = threading.Event()
+    total = peers * count
+    lock = threading.Lock()
+    def receive(kind, data):
+        if kind == 'message':
+            with lock:
+                received[0] += 1
+                if received[0] == total:
+                    done.set()
+    connected = threading.Semaphore(0)
+    hub = NetworkEngine(lambda kind, data: kind == 'connected' and connected.release())
+    hub.start(find_available_port())
+    members = []
+    try:
+        for _ in range(peers):
+            member = NetworkEngine(receive, download_dir=os.path.join(workdir, 'received'))
+            member.start(find_available_port())
+            members.append(member)
+        sessions = [hub.connect('127.0.0.1', member.listen_port).result(CONNECT_TIMEOUT) for member in members]
+        for _ in range(peers):
+            if not connected.acquire(timeout=CONNECT_TIMEOUT):
+                raise RuntimeError("回环连接建立失败")
+        start = time.perf_counter()
+        for seq in range(count):
+            hub.broadcast(sessions, {'type': 'group_text', 'group': 'bench', 'content': f"fan-out message {seq}"})
+        if not done.wait(60):
+            raise RuntimeError("消息接收超时")
+        elapsed = time.perf_counter() - start
+    finally:
+        hub.stop()
+        for member in members:
+            member.stop()
+    return {f'fanout.{peers}': metric(count / elapsed, 'msg/s', 'higher')}
+
+def write_payload(path, size, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+def transfer_throughput(workdir, path, size, **options):
+    """在新建的一对引擎之间发送文件, 返回吞吐量(MB/s)"""
+    pair = EnginePair(workdir, **options)
+    try:
+        finished = threading.Event()
+        pair.handlers['b'] = lambda kind, data: kind in ('transfer_done', 'transfer_failed') and finished.set()
+        start = time.perf_counter()
+        pair.a.send_file(pair.session, path).result(300)
+        if not finished.wait(60):
+            raise RuntimeError("接收端未完成传输")
+        elapsed = time.perf_counter() - start
+    finally:
+        pair.close()
+        shutil.rmtree(os.path.join(workdir, 'received'), ignore_errors=True)
+    return size / elapsed / (1024 * 1024)
+
+def bench_transfers(workdir, sizes):
+    """不同大小的文件传输吞吐量; 数据为随机字节, 压缩会被自动跳过"""
+    results = {}
+    for size in sizes:
+        path = os.path.join(workdir, f"payload-{size}.bin")
+        write_payload(path, size)
+        try:
+            throughput = transfer_throughput(workdir, path, size)
+        finally:
+            os.remove(path)
+        results[f'transfer.{size // (1024 * 1024)}MB'] = metric(throughput, 'MB/s', 'higher')
+    return results
+
+def bench_tls(workdir, count, size):
+    """TLS与明文的对比: 建立连接的耗时(完整握手和会话复用)和大文件吞吐量; 无法生成证书时跳过"""
+    try:
+        tls = TLSConfig(os.path.join(workdir, 'identity.pem'), "pychat-bench")
+    except OSError:
+        return {}
+    results = {}
+    for name, options, forget in (('plain', {}, False), ('full', {'tls': tls}, True), ('resumed', {'tls': tls}, False)):
+        pair = EnginePair(workdir, **options)
+        try:
+            samples = []
+            for _ in range(count):
+                if forget:
+                    tls.client.sessions.clear()
+                samples.append(pair.reconnect())
+        finally:
+            pair.close()
+        results[f'tls.connect_{name}_p50'] = metric(percentile(samples, 50), 'ms', 'lower')
+    path = os.path.join(workdir, f"payload-{size}.bin")
+    write_payload(path, size)
+    try:
+        # 数据为随机字节, 两者都不压缩; 明文使用 sendfile, TLS在用户态加密
+        plain = transfer_throughput(workdir, path, size)
+        secure = transfer_throughput(workdir, path, size, tls=tls)
+    finally:
+        os.remove(path)
+    label = size // (1024 * 1024)
+    results[f'tls.transfer_plain.{label}MB'] = metric(plain, 'MB/s', 'higher')
+    results[f'tls.transfer.{label}MB'] = metric(secure, 'MB/s', 'higher')
+    return results
+
+def build_history(db_path, rows, contacts=10):
+    """用 insert_messages 批量写入合成的聊天记录, 绕过写入队列以便快速生成大数据库"""
+    db = ChatDatabase(db_path)
+    ids = [db.add_connection(f"peer{i}", '10.0.0.1', 20000 + i) for i in range(contacts)]
+    base = now_us() - rows * 1000
+    batch = []
+    for i in range(rows):
+        batch.append((ids[i % contacts], "我" if i % 2 else "对方", f"synthetic message {i} lorem ipsum", base + i * 1000, None))
+        if len(batch) == 50000:
+            db.insert_messages(batch)
+            batch = []
+    if batch:
+        db.insert_messages(batch)
+    return db, ids[0]
+
+def bench_database(workdir, row_counts, inserts):
+    results = {}
+    db = ChatDatabase(os.path.join(workdir, 'insert.db'))
+    conn_id = db.add_connection("peer", '10.0.0.1', 20000)
+    start = time.perf_counter()
+    for i in range(inserts):
+        db.save_message(conn_id, "我", f"insert benchmark {i}")
+    db.flush()
+    results['db.save_message'] = metric(inserts / (time.perf_counter() - start), 'msg/s', 'higher')
+    db.close()
+
+    for rows in row_counts:
+        label = f"{rows // 1000}k" if rows < 1_000_000 else f"{rows // 1_000_000}M"
+        db, conn_id = build_history(os.path.join(workdir, f'history-{label}.db'), rows)
+        try:
+            # 最新一页, 以及从最新一页开始向前翻100页
+            samples = []
+            for _ in range(50):
+                start = time.perf_counter()
+                db.get_messages_before(conn_id)
+                samples.append((time.perf_counter() - start) * 1000)
+            results[f'db.newest_page.{label}'] = metric(percentile(samples, 50), 'ms', 'lower')
+            samples = []
+            before = None
+            for _ in range(100):
+                start = time.perf_counter()
+                page = db.get_messages_before(conn_id, before)
+                samples.append((time.perf_counter() - start) * 1000)
+                if not page:
+                    break
+                before = page[0][0]
+            results[f'db.older_page.{label}'] = metric(percentile(samples, 50), 'ms', 'lower')
+            start = time.perf_counter()
+            db.search("message 4242")
+            results[f'db.search.{label}'] = metric((time.perf_counter() - start) * 1000, 'ms', 'lower')
+        finally:
+            db.close()
+    return results
+
+def bench_render(counts):
+    """把N条消息放入聊天视图并完成布局和一次绘制的时间, 没有安装PyQt5时跳过"""
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtWidgets import QApplication
+        import pychat_P2Pversion as gui
+    except ImportError:
+        return {}
+    app = QApplication.instance() or QApplication([])
+    results = {}
+    for count in counts:
+        model = gui.MessageModel()
+        view = gui.QListView()
+        view.setModel(model)
+        view.setItemDelegate(gui.BubbleDelegate(view))
+        view.setVerticalScrollMode(gui.QAbstractItemView.ScrollPerPixel)
+        view.setResizeMode(gui.QListView.Adjust)
+        view.resize(700, 500)
+        view.show()
+        app.processEvents()
+        base = now_us()
+        entries = [gui.ChatEntry(i, "我" if i % 2 else "对方", f"render benchmark message {i}", base + i, False)
+                   for i in range(count)]
+        start = time.perf_counter()
+        model.extend(entries)
+        view.scrollToBottom()
+        view.viewport().repaint()
+        app.processEvents()
+        results[f'render.{count}'] = metric((time.perf_counter() - start) * 1000, 'ms', 'lower')
+        view.close()
+    return results
+
+def compare(results, baseline, tolerance):
+    """返回退化的指标列表: (名称, 基线值, 当前值, 变化比例)"""
+    regressions = []
+    for name, current in results.items():
+        old = baseline.get('results', {}).get(name)
+        if not old or not old['value']:
+            continue
+        change = (current['value'] - old['value']) / old['value']
+        if current['better'] == 'lower' and change > tolerance or current['better'] == 'higher' and change < -tolerance:
+            regressions.append((name, old['value'], current['value'], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PyChat 回环性能基准")
+    parser.add_argument('--quick', action='store_true', help="使用较小的规模, 用于快速检查")
+    parser.add_argument('--only', action='append',
+                        choices=['messages', 'delivery', 'fanout', 'transfers', 'tls', 'database', 'render'],
+                        help="只运行指定的基准, 可以重复指定")
+    parser.add_argument('--output', help="把结果写入JSON文件")
+    parser.add_argument('--baseline', help="与之前保存的结果比较")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="允许的退化比例, 默认 0.1 (10%%)")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        messages, sizes, rows, inserts, renders = 200, [1 << 20, 16 << 20], [10_000], 20_000, [1000]
+        fanout, handshakes, tls_size = 10, 20, 16 << 20
+    else:
+        messages, sizes, rows, inserts, renders = 1000, [1 << 20, 16 << 20, 128 << 20], [10_000, 1_000_000], 100_000, [1000, 10_000]
+        fanout, handshakes, tls_size = 50, 100, 128 << 20
+    selected = args.only or ['messages', 'delivery', 'fanout', 'transfers', 'tls', 'database', 'render']
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="pychat-bench-")
+    try:
+        if 'messages' in selected:
+            results.update(bench_messages(workdir, messages))
+        if 'delivery' in selected:
+            results.update(bench_delivery(workdir, messages))
+        if 'fanout' in selected:
+            results.update(bench_fanout(workdir, fanout, messages))
+        if 'transfers' in selected:
+            results.update(bench_transfers(workdir, sizes))
+        if 'tls' in selected:
+            results.update(bench_tls(workdir, handshakes, tls_size))
+        if 'database' in selected:
+            results.update(bench_database(workdir, rows, inserts))
+        if 'render' in selected:
+            results.update(bench_render(renders))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {'time': now_us(), 'python': platform.python_version(), 'platform': platform.platform(),
+                 'sqlite': sqlite3.sqlite_version, 'cpus': os.cpu_count(), 'quick': args.quick},
+        'results': results,
+    }
+    for name, entry in results.items():
+        print(f"{name:28} {entry['value']:>12.3f} {entry['unit']}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old, new, change in regressions:
+            print(f"退化: {name} {old} -> {new} ({change:+.1%})")
+        if regressions:
+            return 1
+        print("没有超出容差的退化")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3790 @@
+# PyChat 核心: 线路协议、网络引擎和聊天记录数据库, 不依赖Qt, 可以在无界面的进程中使用
+
+import sys
+import os
+import socket
+import threading
+import json
+import datetime
+import sqlite3
+import random
+import asyncio
+import mmap
+import time
+import re
+import hashlib
+import secrets
+import collections
+import struct
+import itertools
+import csv
+import gzip
+import zlib
+import lzma
+import bz2
+import argparse
+import queue
+import bisect
+import concurrent.futures
+import ssl
+import subprocess
+from collections import namedtuple
+
+# 获取本机IP地址
+def get_local_ip():
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except:
+        return "127.0.0.1"
+
+# 线路协议: 定长帧头 + 负载
+# 帧头: 魔数(2) 版本(1) 帧类型(1) 标志(1) 保留(1) 通道号(4) 负载长度(4), 网络字节序
+PROTOCOL_MAGIC = b'PC'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBBxII')
+
+FRAME_CONTROL = 1   # 控制帧, 负载为UTF-8编码的JSON
+FRAME_DATA = 2      # 二进制负载帧, 通道号为文件传输ID
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_BUFFER_SIZE = 256 * 1024
+MIN_RECV_SPACE = 64 * 1024
+FILE_CHUNK_SIZE = 4 * 1024 * 1024   # 每个数据帧用 sendfile 发送的字节数
+CONNECT_TIMEOUT = 10
+DOWNLOAD_DIR = "received_files"
+PROGRESS_INTERVAL = 0.2             # 传输进度事件的最小间隔(秒)
+SEGMENT_SIZE = 8 * 1024 * 1024      # 分段校验与断点续传的粒度
+TRANSFER_STREAMS = 4                # 大文件最多并行使用的TCP连接数
+SEGMENT_RETRIES = 3
+ACCEPT_TIMEOUT = 30
+MANIFEST_INTERVAL = 1.0             # 传输清单落盘的最小间隔(秒), 崩溃时最多重传这段时间内校验的分段
+PARTIAL_DIR = ".partial"            # 下载目录中存放未完成文件及其传输清单的子目录
+CONTENT_HASH_SIZE = 32              # 文件内容标识的字节数
+DIGEST_CACHE_SIZE = 64              # 发送端缓存分段校验值的文件数, 同一文件发给多个联系人时只读一遍
+COMPRESS_THRESHOLD = 512            # 负载不小于该字节数时才尝试压缩
+COMPRESS_MAX_RATIO = 0.9            # 压缩后大于原大小的该比例时视为不可压缩, 原样发送
+COMPRESS_SAMPLE = 64 * 1024         # 文件数据块先压缩这么多字节试探是否值得压缩
+FLAG_CODEC_MASK = 0x03              # 帧标志的低两位: 负载使用的压缩算法编号, 0 为未压缩
+HEARTBEAT_INTERVAL = 5.0            # 向每个会话发送 ping 的间隔(秒)
+HEARTBEAT_TIMEOUT = 15.0            # 这么久没有收到对端任何数据时视为半开连接并断开(秒)
+RTT_ALPHA = 0.125                   # 平滑往返时间的权重, 与TCP的SRTT相同
+RECONNECT_BASE = 1.0                # 第一次自动重连前的等待时间(秒), 之后每次翻倍
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_ATTEMPTS = 10
+TLS_IDENTITY_DAYS = 3650            # 本机自签名证书的有效期(天)
+TLS_SESSION_CACHE = 256             # 发起连接的一方缓存的TLS会话数, 重新连接时跳过完整握手
+TLS_CHUNK_SIZE = 256 * 1024         # TLS连接上每个数据帧的字节数: 加密在事件循环中进行, 较小的块不会长时间阻塞其他连接
+
+# 可协商的压缩算法: 名称 -> (帧标志中的编号, 压缩函数(data, level), 解压器工厂)
+COMPRESSION_CODECS = {
+    'zlib': (1, zlib.compress, zlib.decompressobj),
+    'lzma': (2, lambda data, level: lzma.compress(data, preset=level), lzma.LZMADecompressor),
+    'bz2': (3, bz2.compress, bz2.BZ2Decompressor),
+}
+CODEC_DECOMPRESSORS = {flag: factory for flag, _, factory in COMPRESSION_CODECS.values()}
+COMPRESSION_PREFERENCE = (('zlib', 6), ('bz2', 9), ('lzma', 6))   # 本端发送时按此顺序选用对端支持的算法
+
+Frame = namedtuple('Frame', 'ftype flags channel payload')
+
+class ProtocolError(Exception):
+    """对端发送的数据不符合线路协议"""
+
+def frame_header(ftype, length, channel=0, flags=0):
+    return FRAME_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, ftype, flags, channel, length)
+
+def encode_control(message, codec=None):
+    """把控制消息编码为一个完整的帧, 指定 codec 时按其设置压缩负载"""
+    payload = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    flags = 0
+    if codec is not None:
+        flags, payload = codec.compress(payload)
+    return frame_header(FRAME_CONTROL, len(payload), flags=flags) + payload
+
+def decode_control(payload):
+    return json.loads(str(payload, 'utf-8'))
+
+# 协商得到的压缩设置
+class FrameCodec:
+    """对单个帧负载进行压缩; 负载小于阈值或压缩后没有明显变小时原样返回"""
+    def __init__(self, name, level, threshold=COMPRESS_THRESHOLD):
+        self.name = name
+        self.level = level
+        self.threshold = threshold
+        self.flag, self._compress, _ = COMPRESSION_CODECS[name]
+
+    def compress(self, payload):
+        """返回 (帧标志, 负载)"""
+        if len(payload) < self.threshold:
+            return 0, payload
+        data = self._compress(payload, self.level)
+        if len(data) > len(payload) * COMPRESS_MAX_RATIO:
+            return 0, payload
+        return self.flag, data
+
+def negotiate_codec(preference, offered):
+    """从对端 hello 中声明支持的算法里按本端偏好选出发送时使用的算法, 没有共同算法时返回None"""
+    supported = {entry[0] for entry in offered or () if entry and entry[0] in COMPRESSION_CODECS}
+    for name, level in preference:
+        if name in supported:
+            return FrameCodec(name, level)
+    return None
+
+def decompress_payload(flags, payload, limit):
+    """解压一个帧的负载, 解压结果超过 limit 字节或数据不完整时视为协议错误"""
+    factory = CODEC_DECOMPRESSORS.get(flags & FLAG_CODEC_MASK)
+    if factory is None:
+        raise ProtocolError(f"不支持的压缩算法: {flags & FLAG_CODEC_MASK}")
+    decompressor = factory()
+    try:
+        data = decompressor.decompress(payload, limit + 1)
+    except (zlib.error, lzma.LZMAError, OSError) as e:
+        raise ProtocolError(f"解压失败: {e}")
+    if len(data) > limit:
+        raise ProtocolError("解压后的数据过大")
+    if not decompressor.eof:
+        raise ProtocolError("压缩数据不完整")
+    return data
+
+# 从源文件读取一个数据块并尝试压缩, 在线程池中执行; 开头的样本压缩不动时整块原样返回
+def read_compressed(f, codec, offset, count):
+    """读取文件的一块数据并尝试压缩, 返回 (帧标志, 负载); codec 为None时原样返回"""
+    f.seek(offset)
+    data = f.read(count)
+    if len(data) != count:
+        raise OSError("文件在发送过程中被修改")
+    if codec is None or not codec.compress(data[:COMPRESS_SAMPLE])[0]:
+        return 0, data
+    return codec.compress(data)
+
+# 增量帧解码器
+class FrameDecoder:
+    """把字节流切分成帧
+
+    数据通过 recv_into 直接写入可复用的 bytearray, 一次 recv 可以解析出多个帧。
+    frames() 产出的负载是指向内部缓冲区的 memoryview, 只在迭代到下一个帧之前有效,
+    需要保留的数据要由调用方自行复制。
+
+    通过 attach_sink() 为某个通道挂接接收端后, 该通道数据帧的负载不再经过内部缓冲区,
+    而是直接接收到 sink 提供的缓冲区中 (例如文件的内存映射), 帧完成时产出 payload 为 None 的帧。
+    """
+    def __init__(self, capacity=RECV_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self._buf = bytearray(capacity)
+        self._start = 0     # 未解析数据的起点
+        self._end = 0       # 已接收数据的终点
+        self.max_frame_size = max_frame_size
+        self._sinks = {}
+        self._direct = None         # 正在直接接收的帧: (通道号, 标志, sink)
+        self._direct_remaining = 0
+        self._direct_done = None
+
+    def attach_sink(self, channel, sink):
+        self._sinks[channel] = sink
+
+    def detach_sink(self, channel):
+        self._sinks.pop(channel, None)
+
+    def _missing(self):
+        """当前不完整的帧还缺多少字节"""
+        pending = self._end - self._start
+        if pending < FRAME_HEADER.size:
+            return FRAME_HEADER.size - pending
+        length = FRAME_HEADER.unpack_from(self._buf, self._start)[5]
+        return max(FRAME_HEADER.size + length - pending, 0)
+
+    def _reserve(self, size):
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buf):
+            # 容量不足以放下整个帧时按倍数扩容
+            buf = bytearray(max(len(self._buf) * 2, pending + size))
+            buf[:pending] = memoryview(self._buf)[self._start:self._end]
+            self._buf = buf
+        elif pending:
+            # 只把剩余的半个帧搬到缓冲区开头
+            self._buf[:pending] = self._buf[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def get_buffer(self, sizehint=-1):
+        """返回可供 recv_into 写入的空闲缓冲区"""
+        if self._direct is not None:
+            return self._direct[2].get_buffer(self._direct_remaining)
+        self._reserve(max(sizehint, self._missing(), MIN_RECV_SPACE))
+        return memoryview(self._buf)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        if self._direct is not None:
+            self._direct[2].advance(nbytes)
+            self._direct_remaining -= nbytes
+            if not self._direct_remaining:
+                self._direct_done, self._direct = self._direct, None
+        else:
+            self._end += nbytes
+
+    def recv_into(self, sock):
+        """从阻塞socket读取一次, 返回读取的字节数, 0表示对端已关闭"""
+        with self.get_buffer() as view:
+            nbytes = sock.recv_into(view)
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def feed(self, data):
+        view = memoryview(data)
+        if self._direct is not None:
+            take = min(len(view), self._direct_remaining)
+            with self._direct[2].get_buffer(take) as target:
+                target[:take] = view[:take]
+            self.buffer_updated(take)
+            view = view[take:]
+        if view:
+            with self.get_buffer(len(view)) as target:
+                target[:len(view)] = view
+            self.buffer_updated(len(view))
+
+    def frames(self):
+        """依次产出缓冲区中所有完整的帧"""
+        if self._direct_done is not None:
+            channel, flags, _ = self._direct_done
+            self._direct_done = None
+            yield Frame(FRAME_DATA, flags, channel, None)
+        header_size = FRAME_HEADER.size
+        while self._direct is None and self._end - self._start >= header_size:
+            magic, version, ftype, flags, channel, length = FRAME_HEADER.unpack_from(self._buf, self._start)
+            if magic != PROTOCOL_MAGIC:
+                raise ProtocolError("无效的帧头")
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"不支持的协议版本: {version}")
+            if length > self.max_frame_size:
+                raise ProtocolError(f"帧过大: {length} 字节")
+            begin = self._start + header_size
+            sink = self._sinks.get(channel) if ftype == FRAME_DATA and not flags else None
+            if sink is not None:
+                if length > sink.remaining():
+                    raise ProtocolError(f"数据帧超出文件大小: {length} 字节")
+                # 已在缓冲区中的部分写入 sink, 其余部分直接接收到 sink 中
+                take = min(length, self._end - begin)
+                with sink.get_buffer(take) as target:
+                    target[:take] = memoryview(self._buf)[begin:begin + take]
+                sink.advance(take)
+                self._start = begin + take
+                if take < length:
+                    self._direct = (channel, flags, sink)
+                    self._direct_remaining = length - take
+                    break
+                yield Frame(ftype, flags, channel, None)
+                continue
+            if begin + length > self._end:
+                break
+            self._start = begin + length
+            with memoryview(self._buf)[begin:begin + length] as payload:
+                yield Frame(ftype, flags, channel, payload)
+        if self._start == self._end:
+            self._start = self._end = 0
+
+# 为文件预分配磁盘空间
+def preallocate(fd, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+# 在目录中为收到的文件选择不重名的保存路径
+def unique_path(directory, file_name):
+    file_name = os.path.basename(file_name.replace('\\', '/')) or "unnamed"
+    base, ext = os.path.splitext(file_name)
+    path = os.path.join(directory, file_name)
+    for i in itertools.count(1):
+        if not os.path.exists(path):
+            return path
+        path = os.path.join(directory, f"{base} ({i}){ext}")
+
+def segment_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# 计算源文件中一个分段的校验值, 在线程池中执行
+def file_segment_digest(path, offset, length):
+    digest = hashlib.blake2b(digest_size=16)
+    buf = bytearray(min(length, 1024 * 1024))
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            n = f.readinto(view[:min(length, len(buf))])
+            if not n:
+                raise OSError("文件在发送过程中被修改")
+            digest.update(view[:n])
+            length -= n
+    return digest.hexdigest()
+
+# 依次计算整个文件各分段的校验值, 在线程池中执行
+def file_digests(path, size, segment_size):
+    return [file_segment_digest(path, offset, min(segment_size, size - offset))
+            for offset in range(0, size, segment_size)]
+
+# 文件内容标识: 对各分段的BLAKE2校验值再做一次BLAKE2。接收端用逐段校验通过的值计算,
+# 数据到达时就已得到, 不需要再读一遍文件; 分段大小不同时同一内容的标识也不同
+def content_hash(size, segment_size, digests):
+    digest = hashlib.blake2b(f"{size}:{segment_size}".encode('ascii'), digest_size=CONTENT_HASH_SIZE)
+    for segment in digests:
+        digest.update(bytes.fromhex(segment))
+    return digest.hexdigest()
+
+# 文件标识: 同一个文件重新发送时得到相同的ID, 接收端据此找到未完成的传输清单
+def file_identity(path, size):
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{size}|{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+# 接收中的文件: 预分配并内存映射的 .part 文件, 以及记录已校验分段的持久化清单
+class IncomingFile:
+    def __init__(self, directory, message, token):
+        self.file_id = message['file_id']
+        if not re.fullmatch(r'[0-9a-f]{32}', self.file_id):
+            raise ProtocolError("无效的文件标识")
+        self.token = token
+        self.size = int(message['file_size'])
+        self.segment_size = int(message['segment_size'])
+        if self.size < 0 or self.segment_size <= 0:
+            raise ProtocolError("无效的文件大小")
+        self.segments = -(-self.size // self.segment_size)
+        self.links = set()      # 正在为该文件传输数据的连接
+        self.busy = 0           # 正在校验的分段数
+        self._mmap = None
+        self._lock = threading.Lock()
+        self._saved = 0.0
+        self._dirty = False
+
+        partial_dir = os.path.join(directory, PARTIAL_DIR)
+        os.makedirs(partial_dir, exist_ok=True)
+        self.part_path = os.path.join(partial_dir, self.file_id + '.part')
+        self.manifest_path = os.path.join(partial_dir, self.file_id + '.json')
+        manifest = self._load_manifest()
+        self.digests = {int(index): digest for index, digest in manifest.get('digests', {}).items()}
+        self.verified = set(manifest.get('verified', [])) | set(self.digests)
+        self.resumed = bool(self.verified)
+        target = manifest.get('target') or unique_path(directory, message['file_name'])
+        self.transfer = Transfer(message['transfer_id'], message['file_name'], self.size, False, target)
+        self.transfer.done = self.transfer.skipped = sum(self.bounds(i)[1] for i in self.verified)
+
+        with open(self.part_path, 'r+b' if self.resumed else 'w+b') as f:
+            if self.size:
+                if not self.resumed:
+                    preallocate(f.fileno(), self.size)
+                self._mmap = mmap.mmap(f.fileno(), self.size)
+        self.save_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('size') != self.size or manifest.get('segment_size') != self.segment_size:
+            return {}
+        if not os.path.exists(self.part_path) or os.path.getsize(self.part_path) != self.size:
+            return {}
+        return manifest
+
+    def save_manifest(self):
+        self._saved = time.monotonic()
+        self._dirty = False
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'file_id': self.file_id, 'file_name': self.transfer.file_name,
+                       'target': self.transfer.path, 'size': self.size,
+                       'segment_size': self.segment_size, 'verified': sorted(self.verified),
+                       'digests': {str(index): digest for index, digest in self.digests.items()}}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def bounds(self, index):
+        offset = index * self.segment_size
+        return offset, min(self.segment_size, self.size - offset)
+
+    def missing(self):
+        return [i for i in range(self.segments) if i not in self.verified]
+
+    def complete(self):
+        return len(self.verified) == self.segments
+
+    def segment_sink(self, index, digest):
+        if not 0 <= index < self.segments:
+            raise ProtocolError(f"无效的分段序号: {index}")
+        offset, length = self.bounds(index)
+        return SegmentSink(self, index, digest, offset, length)
+
+    def verify(self, index, digest):
+        """校验一个已写入的分段并记入清单, 在线程池中执行"""
+        offset, length = self.bounds(index)
+        with memoryview(self._mmap)[offset:offset + length] as view:
+            if segment_digest(view) != digest:
+                return False
+        with self._lock:
+            self.verified.add(index)
+            self.digests[index] = digest
+            self._dirty = True
+            if time.monotonic() - self._saved >= MANIFEST_INTERVAL:
+                self.save_manifest()
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._dirty:
+                self.save_manifest()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def content_hash(self):
+        """由已校验分段的校验值得到的内容标识; 旧版本清单没有记录校验值时为None"""
+        if len(self.digests) != self.segments:
+            return None
+        return content_hash(self.size, self.segment_size, (self.digests[i] for i in range(self.segments)))
+
+    def finalize(self):
+        """全部分段校验通过后把 .part 文件移动到下载目录"""
+        self._dirty = False
+        self.transfer.content_hash = self.content_hash()
+        self.close()
+        target = self.transfer.path
+        if os.path.exists(target):
+            target = self.transfer.path = unique_path(os.path.dirname(target), os.path.basename(target))
+        os.replace(self.part_path, target)
+        os.remove(self.manifest_path)
+        return target
+
+# 分段写入游标: 数据帧的负载直接接收到 .part 文件映射区中该分段的位置
+class SegmentSink:
+    def __init__(self, incoming, index, digest, offset, length):
+        self.incoming = incoming
+        self.index = index
+        self.digest = digest
+        self.offset = offset
+        self.end = offset + length
+
+    def remaining(self):
+        return self.end - self.offset
+
+    def get_buffer(self, limit):
+        return memoryview(self.incoming._mmap)[self.offset:self.offset + limit]
+
+    def advance(self, nbytes):
+        self.offset += nbytes
+        self.incoming.transfer.done += nbytes
+
+    def write(self, data):
+        with self.get_buffer(len(data)) as target:
+            target[:] = data
+        self.advance(len(data))
+
+# 一次文件传输的进度与吞吐量
+class Transfer:
+    def __init__(self, transfer_id, file_name, size, outgoing, path=None):
+        self.transfer_id = transfer_id
+        self.file_name = file_name
+        self.size = size
+        self.outgoing = outgoing
+        self.path = path
+        self.done = 0
+        self.skipped = 0        # 断点续传时无需重新传输的字节数
+        self.streams = 1
+        self.session_id = None
+        self.accepted = None    # 发送端: 等待接收端的 file_accept
+        self.acks = {}          # 发送端: 分段序号 -> 等待 segment_ack 的 Future
+        self.compress = True    # 发送端: 数据块仍值得尝试压缩
+        self.digests = None     # 发送端: 各分段的校验值
+        self.content_hash = None
+        self.deduplicated = False   # 接收端已有相同内容的文件, 没有传输数据
+        self.saved = 0          # 压缩节省的线路字节数
+        self.started = time.monotonic()
+        self._reported = 0.0
+
+    def throughput(self):
+        """本次传输的平均吞吐量, 字节/秒"""
+        elapsed = time.monotonic() - self.started
+        return (self.done - self.skipped) / elapsed if elapsed > 0 else 0.0
+
+    def compression_ratio(self):
+        """实际传输的原始字节数与线路上字节数之比, 未压缩时为 1.0"""
+        sent = self.done - self.skipped
+        return sent / (sent - self.saved) if sent > self.saved else 1.0
+
+    def should_report(self):
+        now = time.monotonic()
+        if now - self._reported < PROGRESS_INTERVAL:
+            return False
+        self._reported = now
+        return True
+
+    def info(self):
+        return {'transfer_id': self.transfer_id, 'file_name': self.file_name, 'path': self.path,
+                'outgoing': self.outgoing, 'done': min(self.done, self.size), 'size': self.size,
+                'skipped': self.skipped, 'streams': self.streams, 'throughput': self.throughput(),
+                'compression_ratio': self.compression_ratio(), 'content_hash': self.content_hash,
+                'deduplicated': self.deduplicated}
+
+def backoff_delay(attempt, base=RECONNECT_BASE, cap=RECONNECT_MAX_DELAY):
+    """第 attempt 次重连前的等待时间: 指数增长到上限后在 [一半, 全部] 之间随机抖动, 避免对端恢复时所有客户端同时重连"""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _ignore_result(task):
+    if not task.cancelled():
+        task.exception()
+
+# TLS: 每个安装一个自签名证书, 发起连接的一方首次连接联系人时记住其证书指纹(TOFU), 之后指纹不同时拒绝连接
+def create_identity(path, common_name, days=TLS_IDENTITY_DAYS):
+    """用 openssl 命令生成自签名证书和私钥, 一起写入 PEM 文件 path; 失败时抛出 OSError"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    try:
+        result = subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+             '-days', str(days), '-subj', f"/CN={common_name}", '-keyout', temp_path, '-out', temp_path],
+            capture_output=True, text=True)
+    except FileNotFoundError:
+        raise OSError("找不到 openssl 命令, 无法生成本机证书") from None
+    if result.returncode != 0:
+        raise OSError(f"生成本机证书失败: {result.stderr.strip()}")
+    os.chmod(temp_path, 0o600)
+    os.replace(temp_path, path)
+
+def certificate_fingerprint(der):
+    return hashlib.sha256(der).hexdigest()
+
+def tls_server_name(ip, port):
+    """发起连接时的 server_hostname, 只用作会话缓存的键; 证书不按主机名校验"""
+    return f"{ip}.{port}"
+
+class TLSClientContext(ssl.SSLContext):
+    """按对端地址缓存TLS会话的客户端上下文: 重新连接同一对端时带上上次的会话票据, 对端接受时跳过完整握手"""
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions = collections.OrderedDict()   # server_hostname -> ssl.SSLSession
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if not server_side and session is None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def save_session(self, server_hostname, session):
+        if session is None:
+            return
+        self.sessions[server_hostname] = session
+        self.sessions.move_to_end(server_hostname)
+        if len(self.sessions) > TLS_SESSION_CACHE:
+            self.sessions.popitem(last=False)
+
+class TLSConfig:
+    """本机的TLS身份以及监听和发起连接用的上下文, 只允许 TLS 1.3
+
+    证书是自签名的, 上下文不做证书链和主机名校验; 身份由发起连接的一方按指纹核对。
+    入站连接不要求对端出示证书, 因此只有发起连接的一方能确认对端身份。
+    """
+    def __init__(self, identity_path, common_name):
+        if not os.path.exists(identity_path):
+            create_identity(identity_path, common_name)
+        self.identity_path = identity_path
+        self.server = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.client = TLSClientContext(ssl.PROTOCOL_TLS_CLIENT)
+        for context in (self.server, self.client):
+            context.minimum_version = ssl.TLSVersion.TLSv1_3
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            context.load_cert_chain(identity_path)
+        with open(identity_path, encoding='ascii') as f:
+            pem = f.read()
+        begin = pem.index("-----BEGIN CERTIFICATE-----")
+        end = pem.index("-----END CERTIFICATE-----") + len("-----END CERTIFICATE-----")
+        self.fingerprint = certificate_fingerprint(ssl.PEM_cert_to_DER_cert(pem[begin:end]))
+
+# 运行时指标: 默认关闭, 各处只在 metrics 不为 None 时计时和记录, 关闭时只多一次属性检查
+LATENCY_BUCKETS = tuple(0.01 * 2 ** i for i in range(21))   # 毫秒, 0.01 ~ 约10000
+SIZE_BUCKETS = tuple(2 ** i for i in range(13))             # 批次大小, 1 ~ 4096
+RATE_BUCKETS = tuple(0.25 * 2 ** i for i in range(16))      # MB/s, 0.25 ~ 8192
+METRICS_INTERVAL = 10.0                                     # JSON快照的默认写出间隔(秒)
+
+class Histogram:
+    """固定分桶的直方图, 记录一个值只需一次二分查找; 分位数取所在桶的上界"""
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'peak')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.peak:
+            self.peak = value
+
+    def quantile(self, q):
+        rank = max(1, q * self.count)
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[index], self.peak) if index < len(self.bounds) else self.peak
+        return self.peak
+
+    def summary(self):
+        return {'count': self.count, 'mean': round(self.total / self.count, 3) if self.count else 0.0,
+                'p50': round(self.quantile(0.5), 3), 'p90': round(self.quantile(0.9), 3),
+                'p99': round(self.quantile(0.99), 3), 'max': round(self.peak, 3)}
+
+class Metrics:
+    """计数器、直方图, 以及快照时调用的状态源(返回字典的函数, 结果并入快照)
+
+    记录可能来自网络线程、写线程和界面线程; 每个名称通常只由一个线程更新, 快照允许有少许偏差。
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.sources = []
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+    def snapshot(self):
+        snapshot = {'time': now_us(), 'uptime': round(time.monotonic() - self.started, 3),
+                    'counters': dict(self.counters),
+                    'histograms': {name: histogram.summary() for name, histogram in list(self.histograms.items())}}
+        for source in self.sources:
+            snapshot.update(source())
+        return snapshot
+
+# 定期把指标快照写入JSON文件; 先写临时文件再替换, 读取方不会读到写了一半的文件
+class MetricsReporter:
+    def __init__(self, snapshot, path, interval=METRICS_INTERVAL):
+        self.snapshot = snapshot
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pychat-metrics", daemon=True)
+        self._thread.start()
+
+    def write(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, default=str)
+        os.replace(temp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def close(self):
+        """停止定期写出, 并写出最后一份快照"""
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.write()
+        except OSError:
+            pass
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_snapshot(snapshot):
+    """把指标快照转换成多行文字, 用于诊断面板和命令行"""
+    lines = []
+    if 'uptime' in snapshot:
+        lines.append(f"指标已记录 {snapshot['uptime']:.0f} 秒")
+    else:
+        lines.append("未开启指标记录, 只显示会话计数器")
+    for info in snapshot.get('sessions', []):
+        lines.append(f"会话 #{info['session']} {info['ip']}:{info['port']} {info['state']}"
+                     f"  压缩 {info['compression'] or '无'}"
+                     f"  加密 {info['tls'] or '无'}{' (会话复用)' if info['resumed'] else ''}")
+        lines.append(f"    消息 入 {info['messages_in']} / 出 {info['messages_out']}"
+                     f"  帧 入 {info['frames_in']} / 出 {info['frames_out']}"
+                     f"  字节 入 {format_size(info['bytes_in'])} / 出 {format_size(info['bytes_out'])}")
+        lines.append(f"    发送队列 {info['queued']} (峰值 {info['queue_peak']})"
+                     f"  RTT {info['rtt'] if info['rtt'] is not None else '-'} ms"
+                     f"  最近收到数据 {info['idle']:.1f} 秒前")
+        latency = info.get('send_latency')
+        if latency:
+            lines.append(f"    发送延迟(ms) p50 {latency['p50']}  p90 {latency['p90']}"
+                         f"  p99 {latency['p99']}  最大 {latency['max']}  共 {latency['count']}")
+    for info in snapshot.get('transfers', []):
+        direction = "发送" if info['outgoing'] else "接收"
+        lines.append(f"{direction} {info['file_name']} {info['done'] * 100 // max(info['size'], 1)}%"
+                     f"  {info['throughput'] / (1024 * 1024):.1f} MB/s")
+    if 'db' in snapshot:
+        lines.append(f"写入队列 {snapshot['db']['pending']} 条待提交")
+        if snapshot['db']['last_error']:
+            lines.append(f"    最近的写入错误: {snapshot['db']['last_error']}")
+    for name, value in sorted(snapshot.get('counters', {}).items()):
+        lines.append(f"{name:24} {value}")
+    for name, summary in sorted(snapshot.get('histograms', {}).items()):
+        lines.append(f"{name:24} p50 {summary['p50']:<9} p90 {summary['p90']:<9} p99 {summary['p99']:<9}"
+                     f" 最大 {summary['max']:<9} 共 {summary['count']}")
+    return "\n".join(lines)
+
+# 对端连接: 接收的数据直接写入帧解码器的缓冲区
+class PeerProtocol(asyncio.BufferedProtocol):
+    def __init__(self, engine, outgoing, tag=None, role='chat'):
+        self.engine = engine
+        self.outgoing = outgoing
+        self.tag = tag
+        self.role = role    # 'chat' 为聊天连接, 'stream' 为文件传输的附加并行连接
+        self.ready = False  # 入站连接在收到 hello 之前尚未确定用途
+        self.link_id = next(engine.link_ids)
+        self.decoder = FrameDecoder()
+        self.transport = None
+        self.address = None
+        self.listen_port = None
+        self.incoming = {}  # 通道号 -> 正在接收的 IncomingFile
+        self.segments = {}  # 通道号 -> 正在接收的 SegmentSink
+        self.pending_acks = set()
+        self.session = None
+        self.codec = None   # 本端发往该连接时使用的压缩设置, 由 hello 协商
+        self.peer_id = None # 对端在 hello 中给出的稳定ID
+        self.tls = None     # TLS连接的 ssl.SSLObject, 明文连接为None
+        self.fingerprint = None     # 对端证书的SHA-256指纹; 入站连接的对端不出示证书
+        self.dialed = None          # 发起连接时: 开始连接的时间
+        self.connect_time = None    # 发起连接时: TCP连接和TLS握手共用的时间(毫秒)
+        self.redial = outgoing and role == 'chat'   # 意外断开后是否自动重连; 只由发起方重连, 避免双方各建一个会话
+        self.close_reason = None
+        self.last_received = time.monotonic()
+        self.bytes_in = self.bytes_out = 0
+        self.frames_in = self.frames_out = 0
+        self.write_lock = asyncio.Lock()    # sendfile 期间不能穿插其他写入
+        self.lost = engine.loop.create_future()     # 连接断开后完成
+        self._write_paused = False
+        self._drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.dialed is not None:
+            self.connect_time = (time.perf_counter() - self.dialed) * 1000
+        self.address = transport.get_extra_info('peername')[:2]
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.tls = transport.get_extra_info('ssl_object')
+        if self.tls is not None:
+            der = self.tls.getpeercert(binary_form=True)
+            self.fingerprint = certificate_fingerprint(der) if der else None
+        self.engine._link_made(self)
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.bytes_in += nbytes
+        self.last_received = time.monotonic()
+        self.decoder.buffer_updated(nbytes)
+        metrics = self.engine.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        try:
+            for frame in self.decoder.frames():
+                self.engine._frame_received(self, frame)
+            if metrics is not None:
+                metrics.observe('stage.network', (time.perf_counter() - start) * 1000)
+        except (ProtocolError, ValueError, KeyError) as e:
+            self.engine.emit('error', session=self.link_id, error=f"协议错误: {e}")
+            self.transport.close()
+        except OSError as e:
+            self.engine.emit('error', session=self.link_id, error=f"接收错误: {e}")
+            self.transport.close()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.lost.set_result(None)
+        self._write_paused = False
+        self._wake_writers(exc or ConnectionResetError("连接已断开"))
+        self.engine._link_lost(self, exc)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._wake_writers(None)
+
+    def _wake_writers(self, exc):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+
+    async def drain(self):
+        """发送缓冲区超过高水位时等待其回落"""
+        if self.transport.is_closing():
+            raise ConnectionResetError("连接已断开")
+        if not self._write_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+# 会话: 一条已完成握手的聊天连接, 拥有自己的发送队列、状态和计数器
+class Session:
+    def __init__(self, engine, link):
+        self.engine = engine
+        self.link = link
+        self.session_id = link.link_id
+        self.address = (link.address[0], link.listen_port or link.address[1])
+        self.outgoing = link.outgoing
+        self.state = 'connected'
+        self.queue = collections.deque()
+        self.queue_peak = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.send_latency = None    # 开启指标时: 帧从入队到写出的延迟直方图(毫秒)
+        self.rtt = None             # 心跳测得的平滑往返时间(毫秒)
+        self.rtt_last = None
+        self._enqueued = None       # 开启指标时: 队列中最早的帧的入队时间
+        self.connected_at = time.time()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()    # 发送队列中的帧都已写出
+        self._idle.set()
+        self._sender = engine.loop.create_task(self._send_loop())
+        link.session = self
+
+    def post(self, *frames):
+        """把完整的帧放入发送队列, 只能在事件循环中调用"""
+        if not self.queue and self.engine.metrics is not None:
+            self._enqueued = time.perf_counter()
+        self.queue.append(frames)
+        if len(self.queue) > self.queue_peak:
+            self.queue_peak = len(self.queue)
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def _send_loop(self):
+        while True:
+            while not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # 队列中积压的帧合并成一次写入
+            batch = []
+            enqueued, self._enqueued = self._enqueued, None
+            while self.queue:
+                batch.extend(self.queue.popleft())
+            try:
+                await self.engine.send_async(self.session_id, *batch)
+            except ConnectionError:
+                self._idle.set()
+                return
+            self.messages_out += len(batch)
+            metrics = self.engine.metrics
+            if metrics is not None and enqueued is not None:
+                latency = (time.perf_counter() - enqueued) * 1000
+                if self.send_latency is None:
+                    self.send_latency = Histogram()
+                self.send_latency.observe(latency)
+                metrics.observe('network.send_latency', latency)
+                metrics.observe('network.send_batch', len(batch), SIZE_BUCKETS)
+            if not self.queue:
+                self._idle.set()
+
+    async def wait_idle(self):
+        await self._idle.wait()
+
+    def add_rtt(self, rtt):
+        self.rtt_last = rtt
+        self.rtt = rtt if self.rtt is None else self.rtt + RTT_ALPHA * (rtt - self.rtt)
+        metrics = self.engine.metrics
+        if metrics is not None:
+            metrics.observe('network.rtt', rtt)
+
+    def close(self):
+        self.state = 'closed'
+        self._idle.set()
+        self._sender.cancel()
+
+    def info(self):
+        link = self.link
+        return {'session': self.session_id, 'ip': self.address[0], 'port': self.address[1],
+                'outgoing': self.outgoing, 'state': self.state, 'queued': len(self.queue),
+                'queue_peak': self.queue_peak,
+                'rtt': round(self.rtt, 3) if self.rtt is not None else None,
+                'rtt_last': round(self.rtt_last, 3) if self.rtt_last is not None else None,
+                'idle': round(time.monotonic() - link.last_received, 3),
+                'messages_in': self.messages_in, 'messages_out': self.messages_out,
+                'frames_in': link.frames_in, 'frames_out': link.frames_out,
+                'bytes_in': link.bytes_in, 'bytes_out': link.bytes_out,
+                'compression': link.codec.name if link.codec else None,
+                'tls': link.tls.version() if link.tls else None,
+                'resumed': bool(link.tls and link.tls.session_reused),
+                'send_latency': self.send_latency.summary() if self.send_latency else None}
+
+# 会话表: 按会话ID和对端地址(IP, 监听端口)索引
+class SessionRegistry:
+    def __init__(self):
+        self.by_id = {}
+        self.by_address = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
+
+    def add(self, session):
+        self.by_id[session.session_id] = session
+        self.by_address[session.address] = session
+
+    def remove(self, session):
+        self.by_id.pop(session.session_id, None)
+        if self.by_address.get(session.address) is session:
+            del self.by_address[session.address]
+
+    def get(self, session_id):
+        return self.by_id.get(session_id)
+
+    def find(self, ip, port):
+        return self.by_address.get((ip, port))
+
+# 网络引擎
+class NetworkEngine:
+    """在独立线程中运行一个asyncio事件循环, 持有监听socket和所有对端连接
+
+    *_async 协程只能在事件循环中调用, 其余公开方法都是线程安全的。
+    网络事件以 on_event(kind, data) 的形式在事件循环线程中回调, 由调用方转交到自己的线程。
+    """
+    def __init__(self, on_event, download_dir=DOWNLOAD_DIR, chunk_size=FILE_CHUNK_SIZE,
+                 segment_size=SEGMENT_SIZE, streams=TRANSFER_STREAMS, compression=COMPRESSION_PREFERENCE,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 reconnect_attempts=RECONNECT_ATTEMPTS, tls=None):
+        self.on_event = on_event
+        self.download_dir = download_dir
+        self.chunk_size = chunk_size
+        self.segment_size = segment_size
+        self.streams = streams
+        self.compression = tuple(compression)   # 本端支持的 (算法, 级别), 按偏好排序; 为空时不压缩
+        self.heartbeat_interval = heartbeat_interval    # 为0时不发送心跳, 也不检测半开连接
+        self.heartbeat_timeout = heartbeat_timeout
+        self.reconnect_attempts = reconnect_attempts    # 为0时不自动重连
+        self.tls = tls              # TLSConfig; 为None时使用明文TCP, 开启时监听和发起的连接都使用TLS
+        self.verify_peer = None     # 核对发起连接的对端证书的函数 (连接标记, 指纹) -> 错误信息或None; 在网络线程中调用
+        self.reconnecting = {}      # 对端地址 (IP, 监听端口) -> (连接标记, 等待重连的任务)
+        self.heartbeat = None
+        self.stopping = False
+        self.peer_id = None         # 本机的稳定ID, 在 hello 中告知对端
+        self.transfer_ids = itertools.count(1)
+        self.outgoing = {}          # 传输ID -> 正在发送的 Transfer
+        self.stream_tokens = {}     # 附加连接的凭据 -> 正在接收的 IncomingFile
+        self.digest_cache = collections.OrderedDict()   # (路径, 大小, 修改时间, 分段大小) -> 分段校验值
+        self.attachment_lookup = None   # 按内容标识查找本机已有文件的函数, 返回路径或None; 在网络线程中调用
+        self.verifying = set()      # 正在校验分段的任务
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.listen_port = None
+        self.links = {}
+        self.link_ids = itertools.count(1)
+        self.sessions = SessionRegistry()
+        self.metrics = None         # 开启时为 Metrics
+        self.metrics_server = None
+
+    def emit(self, kind, **data):
+        self.on_event(kind, data)
+
+    def start(self, port):
+        """启动事件循环线程并开始监听, 监听失败时抛出异常"""
+        self.loop = asyncio.new_event_loop()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.loop.run_forever, name="pychat-network", daemon=True)
+        self.thread.start()
+        try:
+            self.submit(self._listen(port)).result()
+        except Exception:
+            self.stop()
+            raise
+        self.listen_port = port
+
+    async def _listen(self, port):
+        self.server = await self.loop.create_server(
+            lambda: PeerProtocol(self, False), '0.0.0.0', port, reuse_address=True, backlog=128,
+            ssl=self.tls.server if self.tls else None, ssl_handshake_timeout=CONNECT_TIMEOUT if self.tls else None)
+        if self.heartbeat_interval:
+            self.heartbeat = self.loop.create_task(self._heartbeat())
+
+    def stop(self):
+        if self.loop is None or not self.thread.is_alive():
+            return
+        try:
+            self.submit(self._shutdown()).result(timeout=2)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=2)
+
+    async def _shutdown(self):
+        self.stopping = True
+        if self.heartbeat:
+            self.heartbeat.cancel()
+        for _, task in list(self.reconnecting.values()):
+            task.cancel()
+        if self.server:
+            self.server.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        links = list(self.links.values())
+        await asyncio.gather(*(self._close_link(link) for link in links))
+        # 等待连接断开的回调和分段校验完成, 未完成文件的清单随之落盘; TLS连接关闭前还要交换 close_notify
+        await asyncio.sleep(0)
+        lost = [link.lost for link in links if not link.lost.done()]
+        if lost:
+            await asyncio.wait(lost, timeout=1)
+        if self.verifying:
+            await asyncio.wait(self.verifying)
+
+    async def _close_link(self, link):
+        # 等待正在进行的 sendfile 完成后再关闭, 否则 sendfile 会一直挂起
+        async with link.write_lock:
+            link.transport.close()
+
+    def serve_metrics(self, port):
+        """在 127.0.0.1:port 上提供指标快照: 每个连接收到一行JSON后被关闭, 监听失败时抛出异常"""
+        self.submit(self._serve_metrics(port)).result()
+
+    async def _serve_metrics(self, port):
+        self.metrics_server = await asyncio.start_server(self._send_metrics, '127.0.0.1', port, reuse_address=True)
+
+    async def _send_metrics(self, reader, writer):
+        snapshot = self.metrics.snapshot() if self.metrics is not None else {'time': now_us()}
+        writer.write(json.dumps(snapshot, ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def submit(self, coro):
+        """把协程交给事件循环执行, 返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def connect(self, ip, port, tag=None, timeout=CONNECT_TIMEOUT):
+        return self.submit(self.connect_async(ip, port, tag, timeout))
+
+    async def connect_async(self, ip, port, tag=None, timeout=CONNECT_TIMEOUT):
+        """建立出站连接, 成功返回会话ID, 失败时发出 connect_failed 事件并返回None
+
+        已经和该地址建立了会话时直接返回现有会话。
+        """
+        session = self.sessions.find(ip, port)
+        if session is not None:
+            return session.session_id
+        # 手动连接取代正在等待的自动重连
+        pending = self.reconnecting.pop((ip, port), None)
+        if pending is not None:
+            pending[1].cancel()
+        try:
+            link = await self._dial(ip, port, tag, timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.emit('connect_failed', tag=tag, ip=ip, port=port, error=str(e) or "连接超时")
+            return None
+        return link.link_id
+
+    async def _dial(self, ip, port, tag, timeout, role='chat'):
+        options = {}
+        if self.tls:
+            options = {'ssl': self.tls.client, 'server_hostname': tls_server_name(ip, port)}
+        def protocol():
+            link = PeerProtocol(self, True, tag, role)
+            link.dialed = time.perf_counter()
+            return link
+        _, link = await asyncio.wait_for(self.loop.create_connection(protocol, ip, port, **options), timeout)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.observe('network.connect', link.connect_time)
+            if link.tls is not None:
+                metrics.count('tls.handshakes')
+                if link.tls.session_reused:
+                    metrics.count('tls.resumed')
+        return link
+
+    def _schedule_reconnect(self, address, tag):
+        if self.stopping or address in self.reconnecting:
+            return
+        task = self.loop.create_task(self._reconnect(address, tag))
+        task.add_done_callback(_ignore_result)
+        self.reconnecting[address] = (tag, task)
+
+    def cancel_reconnect(self, tag):
+        """取消标记为 tag 的连接等待中的自动重连, 返回是否有这样的重连"""
+        return self.submit(self._cancel_reconnect(tag)).result()
+
+    async def _cancel_reconnect(self, tag):
+        for address, (pending_tag, task) in list(self.reconnecting.items()):
+            if pending_tag == tag:
+                del self.reconnecting[address]
+                task.cancel()
+                return True
+        return False
+
+    async def _reconnect(self, address, tag):
+        """按带抖动的指数退避重新连接; 对端先连入, 或用户手动连接时停止"""
+        ip, port = address
+        error = None
+        try:
+            for attempt in range(1, self.reconnect_attempts + 1):
+                delay = backoff_delay(attempt)
+                self.emit('reconnecting', tag=tag, ip=ip, port=port, attempt=attempt, delay=delay)
+                await asyncio.sleep(delay)
+                if self.sessions.find(ip, port) is not None:
+                    return
+                try:
+                    await self._dial(ip, port, tag, CONNECT_TIMEOUT)
+                    return
+                except (OSError, asyncio.TimeoutError) as e:
+                    error = str(e) or "连接超时"
+            self.emit('connect_failed', tag=tag, ip=ip, port=port, error=f"自动重连失败: {error}")
+        finally:
+            if self.reconnecting.get(address, (None, None))[1] is asyncio.current_task():
+                del self.reconnecting[address]
+
+    async def _heartbeat(self):
+        """定期向每个会话发送 ping; 超过 heartbeat_timeout 没有收到任何数据的连接视为半开连接并中断
+
+        双方都发送心跳, 所以即使一方正在持续发送文件, 它也能从对端的 ping 得知连接仍然有效。
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for session in self.sessions:
+                link = session.link
+                if now - link.last_received > self.heartbeat_timeout:
+                    link.close_reason = "心跳超时"
+                    link.transport.abort()
+                else:
+                    self._post(link, {'type': 'ping', 'time': now})
+
+    def send(self, link_id, *buffers):
+        return self.submit(self.send_async(link_id, *buffers))
+
+    async def send_async(self, link_id, *buffers):
+        link = self.links.get(link_id)
+        if link is None:
+            raise ConnectionResetError("连接不存在")
+        async with link.write_lock:
+            for data in buffers:
+                link.transport.write(data)
+                link.bytes_out += len(data)
+            link.frames_out += len(buffers)
+            await link.drain()
+
+    def post(self, session_id, *frames):
+        """线程安全地把帧放入会话的发送队列, 不等待发送完成"""
+        self.loop.call_soon_threadsafe(self._post_frames, session_id, frames)
+
+    def send_message(self, session_id, message):
+        """线程安全地发送一条控制消息, 在事件循环中按会话协商的算法编码"""
+        self.loop.call_soon_threadsafe(self._post_message, session_id, message)
+
+    def broadcast(self, session_ids, message):
+        """线程安全地把同一条控制消息发给多个会话
+
+        消息按每种压缩算法只编码一次, 同一个帧对象放入各会话的发送队列; 每个会话由自己的
+        发送任务写出, 慢的对端只会积压自己的队列, 不影响其他会话。
+        """
+        self.loop.call_soon_threadsafe(self._broadcast, list(session_ids), message)
+
+    def _broadcast(self, session_ids, message):
+        frames = {}     # 压缩算法名称 -> 编码后的帧
+        for session_id in session_ids:
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue
+            codec = session.link.codec
+            key = codec.name if codec else None
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = encode_control(message, codec)
+            session.post(frame)
+
+    def _post_message(self, session_id, message):
+        session = self.sessions.get(session_id)
+        if session is None:
+            self.emit('error', session=session_id, error="发送失败: 会话已断开")
+        else:
+            session.post(encode_control(message, session.link.codec))
+
+    def flush(self, session_id, timeout=None):
+        """阻塞直到会话发送队列中已有的帧全部写出(或会话断开)"""
+        self.submit(self.flush_async(session_id)).result(timeout)
+
+    async def flush_async(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            await session.wait_idle()
+
+    def _post_frames(self, session_id, frames):
+        session = self.sessions.get(session_id)
+        if session is None:
+            self.emit('error', session=session_id, error="发送失败: 会话已断开")
+        else:
+            session.post(*frames)
+
+    def _post(self, link, message):
+        """在事件循环中异步发送一个控制帧, 连接断开时忽略"""
+        task = self.loop.create_task(self.send_async(link.link_id, encode_control(message, link.codec)))
+        task.add_done_callback(_ignore_result)
+
+    def send_file(self, link_id, file_path, extra=None):
+        return self.submit(self.send_file_async(link_id, file_path, extra))
+
+    async def send_file_async(self, link_id, file_path, extra=None):
+        """发送文件, 返回传输ID; extra 中的字段附加在文件提议中, 例如所属的群组
+
+        文件按 segment_size 分段, 每段附带校验值。接收端在 file_accept 中答复尚缺的分段,
+        中断后重新发送同一个文件时只传输未校验通过的分段。分段分摊到聊天连接和
+        最多 streams-1 条附加连接上并行发送, 每帧负载由 loop.sendfile 交给内核直接发送。
+        提议中附带内容标识, 接收端已有相同内容时直接答复不缺分段, 只需一次往返。
+        """
+        link = self.links.get(link_id)
+        if link is None:
+            raise ConnectionResetError("连接不存在")
+        size = os.path.getsize(file_path)
+        transfer = Transfer(next(self.transfer_ids), os.path.basename(file_path), size, True, file_path)
+        transfer.session_id = link_id
+        transfer.accepted = self.loop.create_future()
+        self.outgoing[transfer.transfer_id] = transfer
+        streams = []
+        try:
+            transfer.digests = await self._file_digests(file_path, size)
+            transfer.content_hash = content_hash(size, self.segment_size, transfer.digests)
+            await self.send_async(link_id, encode_control({
+                'type': 'file',
+                'transfer_id': transfer.transfer_id,
+                'file_id': file_identity(file_path, size),
+                'file_name': transfer.file_name,
+                'file_size': size,
+                'segment_size': self.segment_size,
+                'content_hash': transfer.content_hash,
+                **(extra or {})
+            }))
+            accept = await asyncio.wait_for(transfer.accepted, ACCEPT_TIMEOUT)
+            transfer.deduplicated = bool(accept.get('deduplicated'))
+            pending = accept['missing']
+            sending = sum(min(self.segment_size, size - i * self.segment_size) for i in pending)
+            transfer.done = transfer.skipped = size - sending
+            streams = await self._open_streams(link, transfer, accept['token'], len(pending))
+            links = [link] + streams
+            transfer.streams = len(links)
+            for _ in range(SEGMENT_RETRIES):
+                pending = await self._send_segments(transfer, links, pending)
+                if not pending:
+                    break
+                links = [l for l in links if not l.transport.is_closing()]
+                if not links:
+                    raise ConnectionResetError("连接已断开")
+            else:
+                raise OSError("分段校验失败")
+        except Exception as e:
+            self.emit('transfer_failed', session=link_id, error=str(e) or type(e).__name__, **transfer.info())
+            raise
+        finally:
+            del self.outgoing[transfer.transfer_id]
+            for stream in streams:
+                await self._close_link(stream)
+        self._transfer_finished(transfer)
+        self.emit('transfer_done', session=link_id, **transfer.info())
+        return transfer.transfer_id
+
+    async def _file_digests(self, path, size):
+        """文件各分段的校验值, 按路径、大小和修改时间缓存"""
+        key = (os.path.abspath(path), size, os.stat(path).st_mtime_ns, self.segment_size)
+        digests = self.digest_cache.get(key)
+        if digests is None:
+            digests = await self.loop.run_in_executor(None, file_digests, path, size, self.segment_size)
+            self.digest_cache[key] = digests
+            if len(self.digest_cache) > DIGEST_CACHE_SIZE:
+                self.digest_cache.popitem(last=False)
+        else:
+            self.digest_cache.move_to_end(key)
+        return digests
+
+    def _transfer_finished(self, transfer):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.count('transfer.completed')
+            metrics.count('transfer.bytes', transfer.done - transfer.skipped)
+            metrics.observe('transfer.throughput', transfer.throughput() / (1024 * 1024), RATE_BUCKETS)
+
+    async def _open_streams(self, link, transfer, token, segments):
+        """按需建立到对端监听端口的附加连接, 建立失败的连接直接放弃"""
+        count = min(self.streams, segments) - 1
+        if count <= 0 or not link.listen_port:
+            return []
+        results = await asyncio.gather(
+            *(self._open_stream(link.address[0], link.listen_port, transfer.transfer_id, token, link.codec)
+              for _ in range(count)),
+            return_exceptions=True)
+        return [stream for stream in results if isinstance(stream, PeerProtocol)]
+
+    async def _open_stream(self, ip, port, transfer_id, token, codec):
+        stream = await self._dial(ip, port, None, CONNECT_TIMEOUT, role='stream')
+        stream.codec = codec
+        await self.send_async(stream.link_id, encode_control({'type': 'stream', 'transfer_id': transfer_id, 'token': token}))
+        return stream
+
+    async def _send_segments(self, transfer, links, pending):
+        """把分段分配给各条连接并发发送, 返回未通过校验或未送达的分段"""
+        queue = collections.deque(pending)
+        failed = []
+
+        async def worker(link):
+            acks = []
+            with open(transfer.path, 'rb') as f:
+                while queue and not link.transport.is_closing():
+                    index = queue.popleft()
+                    try:
+                        acks.append((index, await self._send_segment(link, transfer, f, index)))
+                    except ConnectionError:
+                        queue.appendleft(index)
+                        break
+            # 分段流水线发送, 全部发出后再统一等待确认
+            for index, ack in acks:
+                if not await ack:
+                    failed.append(index)
+
+        workers = [self.loop.create_task(worker(link)) for link in links]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        return failed + list(queue)
+
+    async def _send_segment(self, link, transfer, f, index):
+        offset = index * self.segment_size
+        end = min(offset + self.segment_size, transfer.size)
+        digest = transfer.digests[index]
+        ack = self.loop.create_future()
+        transfer.acks[index] = ack
+        link.pending_acks.add(ack)
+        await self.send_async(link.link_id, encode_control({
+            'type': 'segment', 'transfer_id': transfer.transfer_id, 'index': index, 'digest': digest}))
+        chunk_size = self.chunk_size if link.tls is None else min(self.chunk_size, TLS_CHUNK_SIZE)
+        while offset < end:
+            count = min(chunk_size, end - offset)
+            if link.tls is not None or (link.codec is not None and transfer.compress):
+                # 压缩在线程池中进行; 数据不可压缩时该传输之后的数据块改回 sendfile。
+                # TLS连接上数据要在用户态加密, 不能使用 sendfile, 同样在线程池中读取
+                codec = link.codec if transfer.compress else None
+                flags, data = await self.loop.run_in_executor(None, read_compressed, f, codec, offset, count)
+                if not flags:
+                    transfer.compress = False
+                async with link.write_lock:
+                    if link.transport.is_closing():
+                        raise ConnectionResetError("连接已断开")
+                    link.transport.write(frame_header(FRAME_DATA, len(data), channel=transfer.transfer_id, flags=flags))
+                    link.transport.write(data)
+                    await link.drain()
+                sent = len(data)
+                transfer.saved += count - sent
+            else:
+                async with link.write_lock:
+                    if link.transport.is_closing():
+                        raise ConnectionResetError("连接已断开")
+                    link.transport.write(frame_header(FRAME_DATA, count, channel=transfer.transfer_id))
+                    try:
+                        sent = await self.loop.sendfile(link.transport, f, offset, count)
+                    except RuntimeError:
+                        if link.transport.is_closing():
+                            raise ConnectionResetError("连接已断开")
+                        raise
+                if sent != count:
+                    # 文件在发送过程中被截断, 帧已无法补齐
+                    link.transport.close()
+                    raise OSError("文件在发送过程中被修改")
+            offset += count
+            link.bytes_out += sent
+            link.frames_out += 1
+            transfer.done += count
+            if transfer.should_report():
+                self.emit('transfer_progress', session=transfer.session_id, **transfer.info())
+        return ack
+
+    def close(self, link_id):
+        return self.submit(self.close_async(link_id))
+
+    async def close_async(self, link_id):
+        link = self.links.get(link_id)
+        if link is not None:
+            link.redial = False
+            link.close_reason = "连接已关闭"
+            await self._close_link(link)
+
+    def _link_made(self, link):
+        self.links[link.link_id] = link
+        if link.outgoing:
+            link.listen_port = link.address[1]
+            if link.role == 'chat':
+                # 收到对端答复的 hello 后才算连接完成, 此时已知对端ID和压缩算法
+                self._post(link, self._hello())
+
+    def _hello(self):
+        return {'type': 'hello', 'listen_port': self.listen_port, 'peer_id': self.peer_id,
+                'compression': [[name, level] for name, level in self.compression]}
+
+    def _link_ready(self, link):
+        link.ready = True
+        session = Session(self, link)
+        self.sessions.add(session)
+        ip, port = session.address
+        self.emit('connected', session=session.session_id, ip=ip, port=port, outgoing=link.outgoing, tag=link.tag,
+                  peer_id=link.peer_id, tls=link.tls.version() if link.tls else None,
+                  resumed=bool(link.tls and link.tls.session_reused), connect_time=link.connect_time)
+
+    def _link_lost(self, link, exc):
+        self.links.pop(link.link_id, None)
+        if link.session is not None:
+            link.session.close()
+            self.sessions.remove(link.session)
+        for ack in link.pending_acks:
+            if not ack.done():
+                ack.set_result(False)
+        for incoming in set(link.incoming.values()):
+            incoming.links.discard(link)
+            if link.role == 'chat':
+                self.emit('transfer_failed', session=link.link_id, error="连接已断开", **incoming.transfer.info())
+            self._release(incoming)
+        link.incoming.clear()
+        if link.ready:
+            reconnect = link.redial and link.session is not None and self.reconnect_attempts > 0 and not self.stopping
+            self.emit('disconnected', session=link.link_id, error=str(exc) if exc else link.close_reason,
+                      reconnecting=reconnect)
+            if reconnect:
+                self._schedule_reconnect(link.session.address, link.tag)
+
+    def _frame_received(self, link, frame):
+        link.frames_in += 1
+        if frame.ftype == FRAME_CONTROL:
+            payload = frame.payload
+            if frame.flags & FLAG_CODEC_MASK:
+                payload = decompress_payload(frame.flags, payload, MAX_FRAME_SIZE)
+            self._control_received(link, decode_control(payload))
+        elif frame.ftype == FRAME_DATA:
+            sink = link.segments.get(frame.channel)
+            if sink is None:
+                raise ProtocolError(f"通道 {frame.channel} 上没有正在接收的分段")
+            transfer = sink.incoming.transfer
+            if frame.payload is not None:
+                if frame.flags & FLAG_CODEC_MASK:
+                    data = decompress_payload(frame.flags, frame.payload, sink.remaining())
+                    transfer.saved += len(data) - len(frame.payload)
+                    sink.write(data)
+                else:
+                    sink.write(frame.payload)
+            if not sink.remaining():
+                link.decoder.detach_sink(frame.channel)
+                del link.segments[frame.channel]
+                task = self.loop.create_task(self._verify_segment(link, sink))
+                self.verifying.add(task)
+                task.add_done_callback(self.verifying.discard)
+                task.add_done_callback(_ignore_result)
+            elif transfer.should_report():
+                self.emit('transfer_progress', session=transfer.session_id, **transfer.info())
+
+    def _control_received(self, link, message):
+        kind = message['type']
+        if kind == 'hello':
+            link.listen_port = message.get('listen_port')
+            link.peer_id = message.get('peer_id')
+            link.codec = negotiate_codec(self.compression, message.get('compression'))
+            if link.outgoing and link.tls is not None and not link.ready:
+                error = self.verify_peer(link.tag, link.fingerprint) if self.verify_peer else None
+                if error:
+                    link.redial = False
+                    self.emit('connect_failed', tag=link.tag, ip=link.address[0], port=link.address[1], error=error,
+                              fingerprint=link.fingerprint)
+                    link.transport.close()
+                    return
+                # TLS 1.3 的会话票据在握手之后才发出, 对端的 hello 到达时已经收到
+                self.tls.client.save_session(tls_server_name(*link.address), link.tls.session)
+            if not link.outgoing and not link.ready:
+                # 入站连接答复本端的能力, 双方各自选出发送时使用的压缩算法
+                self._post(link, self._hello())
+            if not link.ready:
+                self._link_ready(link)
+            return
+        if kind == 'stream':
+            self._attach_stream(link, message)
+            return
+        if kind == 'ping':
+            self._post(link, {'type': 'pong', 'time': message['time']})
+            return
+        if kind == 'pong':
+            if link.session is not None:
+                link.session.add_rtt((time.monotonic() - message['time']) * 1000)
+            return
+        if not link.ready and link.role == 'chat':
+            if link.tls is not None and link.outgoing:
+                raise ProtocolError("对端未发送 hello, 无法核对证书")
+            self._link_ready(link)
+        if kind == 'file':
+            self._receive_file(link, message)
+        elif kind == 'file_accept':
+            transfer = self.outgoing.get(message['transfer_id'])
+            if transfer is not None and not transfer.accepted.done():
+                transfer.accepted.set_result(message)
+        elif kind == 'segment':
+            incoming = link.incoming[message['transfer_id']]
+            sink = incoming.segment_sink(int(message['index']), message['digest'])
+            link.segments[message['transfer_id']] = sink
+            link.decoder.attach_sink(message['transfer_id'], sink)
+        elif kind == 'segment_ack':
+            transfer = self.outgoing.get(message['transfer_id'])
+            ack = transfer.acks.pop(message['index'], None) if transfer is not None else None
+            if ack is not None and not ack.done():
+                ack.set_result(bool(message['ok']))
+        else:
+            if link.session is not None:
+                link.session.messages_in += 1
+            self.emit('message', session=link.link_id, message=message)
+
+    def _receive_file(self, link, message):
+        """为对端发来的文件准备 .part 文件, 并答复尚缺的分段; 本机已有相同内容时不再接收"""
+        known = message.get('content_hash') and self.attachment_lookup and self.attachment_lookup(message['content_hash'])
+        if known:
+            transfer = Transfer(message['transfer_id'], message['file_name'], int(message['file_size']), False, known)
+            transfer.done = transfer.skipped = transfer.size
+            transfer.content_hash = message['content_hash']
+            transfer.deduplicated = True
+            transfer.session_id = link.link_id
+            self.emit('message', session=link.link_id, message=message, path=known, resumed=False)
+            self._post(link, {'type': 'file_accept', 'transfer_id': transfer.transfer_id,
+                              'token': None, 'missing': [], 'deduplicated': True})
+            if self.metrics is not None:
+                self.metrics.count('transfer.deduplicated')
+            self.emit('transfer_done', session=link.link_id, **transfer.info())
+            return
+        incoming = IncomingFile(self.download_dir, message, secrets.token_hex(16))
+        self.stream_tokens[incoming.token] = incoming
+        self._bind(link, incoming)
+        incoming.transfer.session_id = link.link_id
+        self.emit('message', session=link.link_id, message=message, path=incoming.transfer.path,
+                  resumed=incoming.resumed)
+        self._post(link, {'type': 'file_accept', 'transfer_id': incoming.transfer.transfer_id,
+                          'token': incoming.token, 'missing': incoming.missing()})
+        if incoming.complete():
+            self._finish_receive(incoming)
+
+    def _attach_stream(self, link, message):
+        incoming = self.stream_tokens.get(message.get('token'))
+        if incoming is None or incoming.transfer.transfer_id != message.get('transfer_id'):
+            raise ProtocolError("无效的传输凭据")
+        link.role = 'stream'
+        incoming.transfer.streams += 1
+        self._bind(link, incoming)
+
+    def _bind(self, link, incoming):
+        link.incoming[incoming.transfer.transfer_id] = incoming
+        incoming.links.add(link)
+
+    async def _verify_segment(self, link, sink):
+        incoming = sink.incoming
+        incoming.busy += 1
+        try:
+            ok = await self.loop.run_in_executor(None, incoming.verify, sink.index, sink.digest)
+        finally:
+            incoming.busy -= 1
+        self._post(link, {'type': 'segment_ack', 'transfer_id': incoming.transfer.transfer_id,
+                          'index': sink.index, 'ok': ok})
+        if incoming.complete():
+            if not incoming.busy:
+                self._finish_receive(incoming)
+        else:
+            self._release(incoming)
+
+    def _finish_receive(self, incoming):
+        if self.stream_tokens.pop(incoming.token, None) is None:
+            return
+        for link in incoming.links:
+            link.incoming.pop(incoming.transfer.transfer_id, None)
+        incoming.links.clear()
+        incoming.finalize()
+        self._transfer_finished(incoming.transfer)
+        self.emit('transfer_done', session=incoming.transfer.session_id, **incoming.transfer.info())
+
+    def _release(self, incoming):
+        """没有连接再为该文件传输数据时关闭映射, .part 文件和清单留待续传"""
+        if not incoming.links and not incoming.busy and self.stream_tokens.pop(incoming.token, None) is not None:
+            incoming.close()
+
+# 时间戳统一以整数的Unix纪元微秒存储
+def now_us():
+    return time.time_ns() // 1000
+
+def format_ts(ts, fmt):
+    return datetime.datetime.fromtimestamp(ts / 1_000_000).strftime(fmt)
+
+# 旧版本数据库中的ISO-8601本地时间文本转换为纪元微秒
+def iso_to_us(text):
+    if not text:
+        return 0
+    try:
+        return int(datetime.datetime.fromisoformat(text).timestamp() * 1_000_000)
+    except (TypeError, ValueError):
+        return 0
+
+# 数据库结构迁移, 第 N 个函数把结构从版本 N-1 升级到版本 N
+def _create_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS connections
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  ip TEXT,
+                  port INTEGER,
+                  last_active TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  connection_id INTEGER,
+                  sender TEXT,
+                  message TEXT,
+                  timestamp TEXT,
+                  file_path TEXT)''')
+
+def _use_integer_timestamps(conn):
+    """时间戳改为纪元微秒整数, 合并重复的 (ip, port) 联系人并加上唯一约束和索引"""
+    conn.create_function('iso_to_us', 1, iso_to_us, deterministic=True)
+    conn.execute('''CREATE TABLE connections_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  ip TEXT NOT NULL,
+                  port INTEGER NOT NULL,
+                  peer_id TEXT,
+                  last_active INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute('''INSERT INTO connections_new (id, name, ip, port, last_active)
+                    SELECT c.id, c.name, c.ip, c.port, g.last_active FROM connections c
+                    JOIN (SELECT MIN(id) AS id, MAX(iso_to_us(last_active)) AS last_active
+                          FROM connections GROUP BY ip, port) g ON g.id = c.id''')
+    conn.execute('''CREATE TABLE messages_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  connection_id INTEGER NOT NULL,
+                  sender TEXT NOT NULL,
+                  message TEXT,
+                  ts INTEGER NOT NULL,
+                  file_path TEXT)''')
+    # 旧版本在联系人查找失败时会保存 connection_id 为空的消息, 这些消息记到不存在的联系人 0 下保留
+    conn.execute('''INSERT INTO messages_new (id, connection_id, sender, message, ts, file_path)
+                    SELECT m.id,
+                           COALESCE((SELECT MIN(c2.id) FROM connections c1
+                                     JOIN connections c2 ON c2.ip = c1.ip AND c2.port = c1.port
+                                     WHERE c1.id = m.connection_id), m.connection_id, 0),
+                           COALESCE(m.sender, ''), m.message, iso_to_us(m.timestamp), m.file_path
+                    FROM messages m''')
+    conn.execute("DROP TABLE messages")
+    conn.execute("DROP TABLE connections")
+    conn.execute("ALTER TABLE connections_new RENAME TO connections")
+    conn.execute("ALTER TABLE messages_new RENAME TO messages")
+    conn.execute("CREATE UNIQUE INDEX idx_connections_address ON connections(ip, port)")
+    conn.execute("CREATE UNIQUE INDEX idx_connections_peer ON connections(peer_id)")
+    conn.execute("CREATE INDEX idx_connections_last_active ON connections(last_active)")
+    conn.execute("CREATE INDEX idx_messages_conversation ON messages(connection_id, ts)")
+
+def _add_message_search(conn):
+    """消息全文索引: 外部内容FTS5表由触发器与 messages 保持同步, 并为已有消息建立索引
+
+    trigram 分词可以对中文等不以空格分词的文本做子串匹配。
+    """
+    conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(message, content='messages', content_rowid='id', tokenize='trigram')")
+    conn.execute('''CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                    END''')
+    conn.execute('''CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                    END''')
+    conn.execute('''CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                        INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                        INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                    END''')
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def _add_settings(conn):
+    """本机设置, 例如稳定的对端ID和上次使用的监听端口"""
+    conn.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)")
+
+def _add_delivery(conn):
+    """可靠投递: 每个联系人双向的消息序号, 以及已落盘但对端尚未确认存储的发件箱"""
+    conn.execute("ALTER TABLE connections ADD COLUMN seq_out INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE connections ADD COLUMN seq_in INTEGER NOT NULL DEFAULT 0")
+    conn.execute('''CREATE TABLE outbox
+                 (connection_id INTEGER NOT NULL,
+                  seq INTEGER NOT NULL,
+                  payload TEXT NOT NULL,
+                  PRIMARY KEY (connection_id, seq)) WITHOUT ROWID''')
+
+def _add_attachments(conn):
+    """按内容标识索引的附件: 相同内容的文件只保存一份, 引用数按 messages.attachment 的索引统计"""
+    conn.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+    conn.execute('''CREATE TABLE attachments
+                 (hash TEXT PRIMARY KEY,
+                  path TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  mtime INTEGER NOT NULL) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX idx_messages_attachment ON messages(attachment) WHERE attachment IS NOT NULL")
+
+def _add_groups(conn):
+    """群组及其成员; 群组消息只在 messages 中保存一份, connection_id 为负的群组ID"""
+    conn.execute('''CREATE TABLE groups
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  uid TEXT NOT NULL UNIQUE,
+                  name TEXT,
+                  last_active INTEGER NOT NULL DEFAULT 0)''')
+    conn.execute('''CREATE TABLE group_members
+                 (group_id INTEGER NOT NULL,
+                  connection_id INTEGER NOT NULL,
+                  PRIMARY KEY (group_id, connection_id)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX idx_group_members_connection ON group_members(connection_id)")
+
+def _add_history_sync(conn):
+    """聊天记录同步: 消息记录作者一方的序号, 并记录联系人是否换了对端ID(重新安装)而尚未同步"""
+    conn.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+    conn.execute("CREATE INDEX idx_messages_seq ON messages(connection_id, sender, seq) WHERE seq IS NOT NULL")
+    conn.execute("ALTER TABLE connections ADD COLUMN peer_reset INTEGER NOT NULL DEFAULT 0")
+
+def _add_certificate_pins(conn):
+    """联系人的TLS证书指纹, 首次加密连接时记录"""
+    conn.execute("ALTER TABLE connections ADD COLUMN cert_fingerprint TEXT")
+
+SCHEMA_MIGRATIONS = (
+    _create_base_tables,
+    _use_integer_timestamps,
+    _add_message_search,
+    _add_settings,
+    _add_delivery,
+    _add_attachments,
+    _add_groups,
+    _add_history_sync,
+    _add_certificate_pins,
+)
+
+def _attachment_intact(path, size, mtime):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == size and stat.st_mtime_ns == mtime
+
+# 每个数据库连接打开时设置的参数: WAL模式下读写互不阻塞, 提交时不再每次fsync
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16384",         # 16 MB 页缓存
+    "PRAGMA mmap_size=268435456",       # 256 MB 内存映射读取
+    "PRAGMA temp_store=MEMORY",
+)
+DB_STATEMENT_CACHE = 128                # 每个连接缓存的预编译语句数
+DB_BATCH_SIZE = 256                     # 每个事务最多写入的消息数
+DB_FLUSH_INTERVAL = 0.05                # 消息在写入队列中最多停留的时间(秒)
+HISTORY_PAGE_SIZE = 50                  # 聊天记录每页加载的消息数
+SEARCH_LIMIT = 100                      # 搜索最多返回的结果数
+LATEST_PAGE_RETRIES = 3                 # 读取最新一页时遇到批次提交的重试次数, 仍冲突时等待写入队列
+SEARCH_RANK_WINDOW = 1000               # 只对最新的这么多条匹配消息按相关度排序
+EXPORT_CHUNK_SIZE = 2000                # 导出时每次从游标取出的行数
+EXPORT_FORMATS = ('txt', 'jsonl', 'csv')
+DB_DURABILITY = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}   # 写连接的 synchronous 级别
+
+# 延迟批量写入: 所有会话的消息先进入内存队列, 由写线程攒成批次后在一个事务中提交
+class WriteBehindQueue:
+    def __init__(self, write_batch, batch_size=DB_BATCH_SIZE, flush_interval=DB_FLUSH_INTERVAL):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.last_error = None
+        self.metrics = None
+        self.on_commit = None   # 每批提交成功后在写线程中调用 on_commit(batch)
+        self._items = collections.deque()
+        self._writing = ()      # 写线程正在提交的批次
+        self._cond = threading.Condition()
+        self._queued = 0        # 累计入队数
+        self._written = 0       # 累计已提交数
+        self._urgent = False    # 有线程在等待 flush, 不再等待批次攒满
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="pychat-db-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, item, urgent=False):
+        """放入一项; urgent 为真时不再等待批次攒满, 尽快提交"""
+        with self._cond:
+            self._items.append(item)
+            self._queued += 1
+            if urgent:
+                self._urgent = True
+            if urgent or len(self._items) == 1 or len(self._items) >= self.batch_size:
+                self._cond.notify_all()
+
+    def pending(self):
+        return self._queued - self._written
+
+    @property
+    def written(self):
+        return self._written
+
+    def snapshot(self):
+        """返回 (已提交数, 尚未提交的所有项); 已提交数变化前这些项都不在数据库中"""
+        with self._cond:
+            return self._written, list(self._writing) + list(self._items)
+
+    def flush(self, timeout=None):
+        """等待调用前入队的所有数据提交完成"""
+        with self._cond:
+            target = self._queued
+            if self._written >= target:
+                return True
+            self._urgent = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._items or self._closed)
+                if not self._items:
+                    return
+                # 批次未满时最多再等 flush_interval, 让突发的消息合并进同一个事务
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._items) < self.batch_size and not (self._urgent or self._closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._items.popleft() for _ in range(min(len(self._items), self.batch_size))]
+                self._writing = batch
+                if not self._items:
+                    self._urgent = False
+            metrics = self.metrics
+            start = time.perf_counter()
+            try:
+                self.write_batch(batch)
+            except sqlite3.Error as e:
+                self.last_error = e
+            else:
+                if self.on_commit is not None:
+                    self.on_commit(batch)
+            if metrics is not None:
+                metrics.observe('stage.db_write', (time.perf_counter() - start) * 1000)
+                metrics.observe('db.batch_size', len(batch), SIZE_BUCKETS)
+            with self._cond:
+                self._writing = ()
+                self._written += len(batch)
+                self._cond.notify_all()
+
+class ExportCancelled(Exception):
+    """导出被用户取消"""
+
+# 数据库管理类
+class ChatDatabase:
+    """聊天记录数据库
+
+    长期持有数据库连接: 所有写操作共用一个写连接并由锁串行化, 读操作使用每个线程
+    各自的读连接, 在WAL模式下可以与写入并发进行。相同的SQL文本由 sqlite3 的语句缓存复用。
+
+    save_message 只把消息放入 WriteBehindQueue 就返回, 写线程按 batch_size 条或
+    flush_interval 秒合并成一个事务提交。durability 为 'off'/'normal'/'full',
+    决定提交时的 synchronous 级别; 需要确保落盘时调用 flush()。读操作不等待写入队列,
+    只看到已提交的消息, 最新一页聊天记录另外补上队列中尚未提交的消息; 需要读到全部消息的
+    后台任务先调用 flush()。
+    """
+    def __init__(self, db_name="chat_history.db", batch_size=DB_BATCH_SIZE,
+                 flush_interval=DB_FLUSH_INTERVAL, durability='normal'):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.execute(f"PRAGMA synchronous={DB_DURABILITY[durability]}")
+        self.init_db()
+        self.writes = WriteBehindQueue(self._write_messages, batch_size, flush_interval)
+    
+    @property
+    def metrics(self):
+        """开启时为 Metrics, 写线程记录每个事务的耗时和批次大小"""
+        return self.writes.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.writes.metrics = metrics
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=10, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def _reader(self):
+        """当前线程的读连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+    
+    def flush(self, timeout=None):
+        """等待写入队列中的消息全部提交"""
+        return self.writes.flush(timeout)
+    
+    def close(self):
+        self.writes.close()
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+        with self._write_lock:
+            self._writer.close()
+    
+    def init_db(self):
+        """按 schema_version 表记录的版本依次执行尚未应用的迁移, 每个迁移在单独的事务中完成"""
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL)")
+            current = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+            for version, migration in enumerate(SCHEMA_MIGRATIONS, 1):
+                if version <= current:
+                    continue
+                conn.execute("BEGIN")
+                try:
+                    migration(conn)
+                    conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, now_us()))
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+    
+    def add_connection(self, name, ip, port):
+        """添加联系人, 同一 (ip, port) 已存在时更新名称并返回原有ID"""
+        with self._write_lock, self._writer as conn:
+            conn.execute("INSERT INTO connections (name, ip, port, last_active) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(ip, port) DO UPDATE SET name = excluded.name",
+                         (name, ip, port, now_us()))
+            return conn.execute("SELECT id FROM connections WHERE ip = ? AND port = ?", (ip, port)).fetchone()[0]
+    
+    def get_connections(self):
+        c = self._reader().execute("SELECT id, name, ip, port, last_active FROM connections ORDER BY last_active DESC")
+        return c.fetchall()
+    
+    def get_contacts(self, conn_id=None):
+        """联系人的 (ID, 名称, IP, 端口, 最后活动时间, 对端ID), 不排序; 指定 conn_id 时只查这一个"""
+        sql = "SELECT id, name, ip, port, last_active, peer_id FROM connections"
+        if conn_id is None:
+            return self._reader().execute(sql).fetchall()
+        return self._reader().execute(sql + " WHERE id = ?", (conn_id,)).fetchall()
+    
+    def find_connection(self, ip, port):
+        c = self._reader().execute(
+            "SELECT id, name, ip, port, last_active FROM connections WHERE ip = ? AND port = ?", (ip, port))
+        return c.fetchone()
+    
+    def get_connection_by_id(self, conn_id):
+        c = self._reader().execute("SELECT id, name, ip, port, last_active FROM connections WHERE id = ?", (conn_id,))
+        return c.fetchone()
+    
+    def match_peer(self, peer_id, ip, port):
+        """按对端ID查找联系人, 没有时取同一地址上尚未记录对端ID的联系人"""
+        c = self._reader().execute(
+            "SELECT id, name, ip, port, last_active FROM connections WHERE peer_id = ? "
+            "UNION ALL SELECT id, name, ip, port, last_active FROM connections "
+            "WHERE ip = ? AND port = ? AND peer_id IS NULL LIMIT 1", (peer_id, ip, port))
+        return c.fetchone()
+    
+    def update_peer(self, conn_id, peer_id, ip, port):
+        """记录联系人的对端ID, 并把地址就地更新为对端当前的地址, 返回地址是否改变
+
+        该对端ID原先记在其他联系人上时转移过来; 新地址已被其他联系人占用时保留原地址。
+        联系人原先记录的是另一个对端ID时记下 peer_reset, 同步时告知对端从已有的序号之后继续编号。
+        """
+        with self._write_lock, self._writer as conn:
+            before = conn.execute("SELECT ip, port FROM connections WHERE id = ?", (conn_id,)).fetchone()
+            # 对端换了ID说明它重新安装过
+            conn.execute("UPDATE connections SET peer_reset = 1 WHERE id = ? AND peer_id != ?", (conn_id, peer_id))
+            conn.execute("UPDATE connections SET peer_id = NULL WHERE peer_id = ? AND id != ?", (peer_id, conn_id))
+            conn.execute("UPDATE OR IGNORE connections SET ip = ?, port = ? WHERE id = ?", (ip, port, conn_id))
+            conn.execute("UPDATE connections SET peer_id = ? WHERE id = ?", (peer_id, conn_id))
+            after = conn.execute("SELECT ip, port FROM connections WHERE id = ?", (conn_id,)).fetchone()
+        return before != after
+    
+    def get_certificate(self, conn_id):
+        """联系人记录的证书指纹, 尚未记录时为None"""
+        row = self._reader().execute("SELECT cert_fingerprint FROM connections WHERE id = ?", (conn_id,)).fetchone()
+        return row[0] if row else None
+    
+    def pin_certificate(self, conn_id, fingerprint):
+        """联系人尚未记录证书指纹时记下 fingerprint; 经写入队列执行, 不等待提交"""
+        self.defer(self._pin_certificate, conn_id, fingerprint)
+    
+    @staticmethod
+    def _pin_certificate(conn, conn_id, fingerprint):
+        conn.execute("UPDATE connections SET cert_fingerprint = ? WHERE id = ? AND cert_fingerprint IS NULL",
+                     (fingerprint, conn_id))
+    
+    def forget_certificate(self, conn_id):
+        self.defer(self._forget_certificate, conn_id)
+    
+    @staticmethod
+    def _forget_certificate(conn, conn_id):
+        conn.execute("UPDATE connections SET cert_fingerprint = NULL WHERE id = ?", (conn_id,))
+    
+    def get_setting(self, key, default=None):
+        row = self._reader().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+    
+    def set_setting(self, key, value):
+        with self._write_lock, self._writer as conn:
+            conn.execute("INSERT INTO settings (key, value) VALUES (?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, str(value)))
+    
+    def save_message(self, connection_id, sender, message, file_path=None, seq=None, payload=None, attachment=None):
+        """把消息放入写入队列, 不等待落盘
+
+        带序号的消息与序号一起提交: 有 payload 的是发出的消息, 同时写入发件箱并尽快提交;
+        没有 payload 的是收到的消息, 同时记录该联系人已存储的最大接收序号。
+        attachment 为消息引用的附件内容标识。
+        """
+        item = (connection_id, sender, message, now_us(), file_path)
+        if seq is None and attachment is None:
+            self.writes.put(item)
+        else:
+            self.writes.put(item + (seq, payload, attachment), urgent=payload is not None)
+    
+    def defer(self, function, *args):
+        """把写操作 function(conn, *args) 放入写入队列, 在写线程中与之前保存的消息在同一个或之后的事务中执行"""
+        self.writes.put((None, function, args))
+    
+    def insert_messages(self, rows):
+        """不经过写入队列, 在当前线程中把一批 (connection_id, sender, message, ts, file_path) 写入一个事务, 用于批量导入"""
+        self._write_messages(list(rows))
+    
+    def _write_messages(self, batch):
+        """在写线程中把一批消息写入一个事务, 同一联系人的 last_active 和序号只更新一次; defer() 的写操作最后执行"""
+        last_active = {}
+        seq_out = {}
+        seq_in = {}
+        outbox = []
+        extended = False
+        deferred = [item for item in batch if item[0] is None]
+        if deferred:
+            batch = [item for item in batch if item[0] is not None]
+        for item in batch:
+            connection_id, ts = item[0], item[3]
+            last_active[connection_id] = max(ts, last_active.get(connection_id, ts))
+            if len(item) > 5:
+                extended = True
+                seq, payload = item[5], item[6]
+                if seq is None:
+                    pass
+                elif payload is None:
+                    seq_in[connection_id] = max(seq, seq_in.get(connection_id, seq))
+                else:
+                    seq_out[connection_id] = max(seq, seq_out.get(connection_id, seq))
+                    outbox.append((connection_id, seq, payload))
+        with self._write_lock, self._writer as conn:
+            if extended:
+                conn.executemany("INSERT INTO messages (connection_id, sender, message, ts, file_path, attachment, seq) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [item[:5] + ((item[7], item[5]) if len(item) > 5 else (None, None)) for item in batch])
+            else:
+                conn.executemany("INSERT INTO messages (connection_id, sender, message, ts, file_path) VALUES (?, ?, ?, ?, ?)",
+                                 batch)
+            conn.executemany("UPDATE connections SET last_active = ? WHERE id = ?",
+                             [(ts, connection_id) for connection_id, ts in last_active.items() if connection_id > 0])
+            conn.executemany("UPDATE groups SET last_active = ? WHERE id = ?",
+                             [(ts, -connection_id) for connection_id, ts in last_active.items() if connection_id < 0])
+            if outbox:
+                conn.executemany("INSERT OR REPLACE INTO outbox (connection_id, seq, payload) VALUES (?, ?, ?)", outbox)
+                conn.executemany("UPDATE connections SET seq_out = MAX(seq_out, ?) WHERE id = ?",
+                                 [(seq, connection_id) for connection_id, seq in seq_out.items()])
+            if seq_in:
+                conn.executemany("UPDATE connections SET seq_in = MAX(seq_in, ?) WHERE id = ?",
+                                 [(seq, connection_id) for connection_id, seq in seq_in.items()])
+            for _, function, args in deferred:
+                function(conn, *args)
+    
+    def get_sequences(self, connection_id):
+        """联系人已分配的最大发送序号和已存储的最大接收序号"""
+        c = self._reader().execute("SELECT seq_out, seq_in FROM connections WHERE id = ?", (connection_id,))
+        return c.fetchone() or (0, 0)
+    
+    def get_peer_reset(self, connection_id):
+        row = self._reader().execute("SELECT peer_reset FROM connections WHERE id = ?", (connection_id,)).fetchone()
+        return bool(row and row[0])
+    
+    def clear_peer_reset(self, connection_id):
+        with self._write_lock, self._writer as conn:
+            conn.execute("UPDATE connections SET peer_reset = 0 WHERE id = ?", (connection_id,))
+    
+    def renumber_outgoing(self, connection_id, after, upto, delta):
+        """把序号在 (after, upto] 中的发出消息(发件箱中尚未确认的)序号加上 delta, 发件箱中的消息JSON同时改写
+
+        经写入队列执行, 之前保存而尚未落盘的消息也会改写; 提交后 on_commit 收到的批次中带有这个写操作。
+        """
+        self.defer(self._renumber_outgoing, connection_id, after, upto, delta)
+    
+    @staticmethod
+    def _renumber_outgoing(conn, connection_id, after, upto, delta):
+        # 先换成负数再改回, 避免更新过程中与尚未更新的行主键冲突; 同一事务中稍后分配的序号已在 upto + delta 之后
+        conn.execute("UPDATE outbox SET seq = -(seq + ?) WHERE connection_id = ? AND seq > ? AND seq <= ?",
+                     (delta, connection_id, after, upto))
+        conn.execute("UPDATE outbox SET seq = -seq, payload = json_set(payload, '$.seq', -seq) "
+                     "WHERE connection_id = ? AND seq < 0", (connection_id,))
+        conn.execute("UPDATE messages SET seq = seq + ? WHERE connection_id = ? AND sender = '我' AND seq > ? AND seq <= ?",
+                     (delta, connection_id, after, upto))
+        conn.execute("UPDATE connections SET seq_out = MAX(seq_out, ?) WHERE id = ?", (upto + delta, connection_id))
+    
+    def range_digest(self, connection_id, sender, low, high):
+        """一方发出的、序号在 (low, high] 中的消息的校验值, 两端内容一致时相同"""
+        digest = hashlib.blake2b(digest_size=16)
+        c = self._reader().execute(
+            "SELECT DISTINCT seq, message FROM messages WHERE connection_id = ? AND sender = ? AND seq > ? AND seq <= ? "
+            "ORDER BY seq", (connection_id, sender, low, high))
+        for seq, message in c:
+            digest.update(f"{seq}\0{message}\0".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def iter_range(self, connection_id, sender, low, high, chunk_size=EXPORT_CHUNK_SIZE):
+        """逐块读取一方发出的、序号在 (low, high] 中的消息, 每行为 (seq, ts, message)"""
+        c = self._reader().execute(
+            "SELECT seq, ts, message FROM messages WHERE connection_id = ? AND sender = ? AND seq > ? AND seq <= ? "
+            "ORDER BY seq", (connection_id, sender, low, high))
+        while True:
+            chunk = c.fetchmany(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    
+    def merge_messages(self, connection_id, sender, rows):
+        """合并同步收到的消息, 本机已有的序号跳过; 同时推进相应方向的序号, 返回新增的条数"""
+        with self._write_lock, self._writer as conn:
+            added = conn.executemany(
+                "INSERT INTO messages (connection_id, sender, message, ts, seq) SELECT ?, ?, ?, ?, ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM messages WHERE connection_id = ? AND sender = ? AND seq = ?)",
+                [(connection_id, sender, message, ts, seq, connection_id, sender, seq) for seq, ts, message in rows]).rowcount
+            column = 'seq_out' if sender == "我" else 'seq_in'
+            conn.execute(f"UPDATE connections SET {column} = MAX({column}, ?) WHERE id = ?",
+                         (max(row[0] for row in rows), connection_id))
+        return added
+    
+    def get_outbox(self, connection_id):
+        """发件箱中尚未被对端确认的 (序号, 消息JSON), 按序号排列"""
+        c = self._reader().execute("SELECT seq, payload FROM outbox WHERE connection_id = ? ORDER BY seq",
+                                   (connection_id,))
+        return c.fetchall()
+    
+    def acknowledge(self, connection_id, seq):
+        """对端确认已存储到 seq 为止的消息, 从发件箱中移除; 经写入队列执行, 不等待提交"""
+        self.defer(self._acknowledge, connection_id, seq)
+    
+    @staticmethod
+    def _acknowledge(conn, connection_id, seq):
+        conn.execute("DELETE FROM outbox WHERE connection_id = ? AND seq <= ?", (connection_id, seq))
+    
+    def add_group(self, uid, name):
+        """添加群组, 同一 uid 已存在时返回原有ID"""
+        with self._write_lock, self._writer as conn:
+            conn.execute("INSERT INTO groups (uid, name, last_active) VALUES (?, ?, ?) ON CONFLICT(uid) DO NOTHING",
+                         (uid, name, now_us()))
+            return conn.execute("SELECT id FROM groups WHERE uid = ?", (uid,)).fetchone()[0]
+    
+    def add_group_members(self, group_id, connection_ids):
+        with self._write_lock, self._writer as conn:
+            self._merge_group_members(conn, group_id, connection_ids)
+    
+    def merge_group_members(self, group_id, connection_ids):
+        """把成员加入群组; 经写入队列执行, 不等待提交, 提交后 on_commit 收到的批次中带有这个写操作"""
+        self.defer(self._merge_group_members, group_id, list(connection_ids))
+    
+    @staticmethod
+    def _merge_group_members(conn, group_id, connection_ids):
+        conn.executemany("INSERT OR IGNORE INTO group_members (group_id, connection_id) VALUES (?, ?)",
+                         [(group_id, connection_id) for connection_id in connection_ids])
+    
+    def get_groups(self, group_id=None):
+        """所有群组: (ID, uid, 名称, 最后活动时间, 成员数), 最近活动的在前; 指定 group_id 时只查这一个"""
+        where, params = ("WHERE g.id = ? ", (group_id,)) if group_id is not None else ("", ())
+        c = self._reader().execute(
+            "SELECT g.id, g.uid, g.name, g.last_active, COUNT(m.connection_id) FROM groups g "
+            f"LEFT JOIN group_members m ON m.group_id = g.id {where}GROUP BY g.id ORDER BY g.last_active DESC", params)
+        return c.fetchall()
+    
+    def get_group(self, group_id):
+        c = self._reader().execute("SELECT id, uid, name, last_active FROM groups WHERE id = ?", (group_id,))
+        return c.fetchone()
+    
+    def find_group(self, uid):
+        row = self._reader().execute("SELECT id FROM groups WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else None
+    
+    def get_group_members(self, group_id):
+        """群组成员: (联系人ID, 名称, IP, 端口, 对端ID)"""
+        c = self._reader().execute(
+            "SELECT c.id, c.name, c.ip, c.port, c.peer_id FROM group_members m "
+            "JOIN connections c ON c.id = m.connection_id WHERE m.group_id = ?", (group_id,))
+        return c.fetchall()
+    
+    def get_contact_groups(self, connection_id):
+        c = self._reader().execute("SELECT group_id FROM group_members WHERE connection_id = ?", (connection_id,))
+        return [row[0] for row in c]
+    
+    def find_attachment(self, content_hash):
+        """内容标识对应的本机文件路径; 文件已被删除或修改时返回None"""
+        row = self._reader().execute("SELECT path, size, mtime FROM attachments WHERE hash = ?",
+                                     (content_hash,)).fetchone()
+        return row[0] if row and _attachment_intact(*row) else None
+    
+    def add_attachment(self, content_hash, path, conversations=(), received=False):
+        """在写线程中记录文件的内容标识, 不等待提交
+
+        conversations 中的每个会话(联系人ID, 群组为负)里最近一条引用 path 而还没有内容标识的发出消息
+        补上内容标识: 发出文件时内容标识在保存消息之后才算出。已有完好的相同内容时保留原记录;
+        received 为真时 path 是刚收到的文件, 这时删除它, 引用它的消息改为引用已有的文件, 相同内容只保存一份。
+        """
+        self.defer(self._add_attachment, content_hash, path, tuple(conversations), received)
+    
+    def _add_attachment(self, conn, content_hash, path, conversations, received):
+        conn.executemany("UPDATE messages SET attachment = ? WHERE id = "
+                         "(SELECT id FROM messages WHERE connection_id = ? AND sender = '我' AND file_path = ? "
+                         "AND attachment IS NULL ORDER BY ts DESC, id DESC LIMIT 1)",
+                         [(content_hash, conversation, path) for conversation in conversations])
+        row = conn.execute("SELECT path, size, mtime FROM attachments WHERE hash = ?", (content_hash,)).fetchone()
+        if row and _attachment_intact(*row):
+            if received and row[0] != path:
+                conn.execute("UPDATE messages SET file_path = ? WHERE attachment = ? AND file_path = ?",
+                             (row[0], content_hash, path))
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        conn.execute("INSERT INTO attachments (hash, path, size, mtime) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT(hash) DO UPDATE SET path = excluded.path, size = excluded.size, mtime = excluded.mtime",
+                     (content_hash, path, stat.st_size, stat.st_mtime_ns))
+    
+    def get_messages(self, connection_id):
+        c = self._reader().execute(
+            "SELECT sender, message, ts, file_path FROM messages WHERE connection_id = ? ORDER BY ts, id", (connection_id,))
+        return c.fetchall()
+    
+    def get_messages_before(self, connection_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+        """按 (ts, id) 键集分页: 返回消息 before_id 之前最多 limit 条消息, 按时间正序排列
+
+        before_id 为 None 时返回最新的一页, 之后接着写入队列中该联系人尚未提交的消息(id 为 None)。
+        每行为 (id, sender, message, ts, file_path)。
+        """
+        if before_id is None:
+            return self._latest_messages(connection_id, limit)
+        c = self._reader().execute(
+            "SELECT id, sender, message, ts, file_path FROM messages WHERE connection_id = ? "
+            "AND (ts, id) < (SELECT ts, id FROM messages WHERE id = ?) "
+            "ORDER BY ts DESC, id DESC LIMIT ?", (connection_id, before_id, limit))
+        rows = c.fetchall()
+        rows.reverse()
+        return rows
+    
+    def _latest_messages(self, connection_id, limit):
+        sql = ("SELECT id, sender, message, ts, file_path FROM messages WHERE connection_id = ? "
+               "ORDER BY ts DESC, id DESC LIMIT ?")
+        for _ in range(LATEST_PAGE_RETRIES):
+            written, items = self.writes.snapshot()
+            rows = self._reader().execute(sql, (connection_id, limit)).fetchall()
+            # 读取期间有批次提交时, 同一条消息可能既在结果中又在快照中, 重新读取
+            if self.writes.written == written:
+                break
+        else:
+            self.writes.flush()
+            items = []
+            rows = self._reader().execute(sql, (connection_id, limit)).fetchall()
+        rows.reverse()
+        rows += [(None,) + item[1:5] for item in items if item[0] == connection_id]
+        return rows
+    
+    def get_messages_after(self, connection_id, after_id, limit=HISTORY_PAGE_SIZE):
+        """返回消息 after_id 之后最多 limit 条消息, 按时间正序排列"""
+        c = self._reader().execute(
+            "SELECT id, sender, message, ts, file_path FROM messages WHERE connection_id = ? "
+            "AND (ts, id) > (SELECT ts, id FROM messages WHERE id = ?) "
+            "ORDER BY ts, id LIMIT ?", (connection_id, after_id, limit))
+        return c.fetchall()
+    
+    def get_messages_around(self, connection_id, message_id, limit=HISTORY_PAGE_SIZE):
+        """返回以消息 message_id 为中心的一页消息, 用于从搜索结果跳转"""
+        before = self.get_messages_before(connection_id, message_id, limit // 2)
+        c = self._reader().execute(
+            "SELECT id, sender, message, ts, file_path FROM messages WHERE connection_id = ? "
+            "AND (ts, id) >= (SELECT ts, id FROM messages WHERE id = ?) "
+            "ORDER BY ts, id LIMIT ?", (connection_id, message_id, limit - len(before)))
+        return before + c.fetchall()
+    
+    def search(self, query, connection_id=None, since=None, until=None, limit=SEARCH_LIMIT):
+        """全文搜索聊天记录, 可按联系人和时间范围(纪元微秒)过滤
+
+        在最新的 SEARCH_RANK_WINDOW 条匹配中按 bm25 相关度排序, 摘要只为返回的行生成,
+        这样常见词的查询也不必对全部匹配排序。每行为 (id, connection_id, sender, ts, snippet)。
+        查询按空白拆成多个词, 全部出现才算匹配; 少于3个字符的词无法使用
+        trigram 索引, 此时退回按时间倒序的子串扫描。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        filters, params = [], []
+        if connection_id is not None:
+            filters.append("m.connection_id = ?")
+            params.append(connection_id)
+        if since is not None:
+            filters.append("m.ts >= ?")
+            params.append(since)
+        if until is not None:
+            filters.append("m.ts < ?")
+            params.append(until)
+        if all(len(term) >= 3 for term in terms):
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            where = " AND ".join(["messages_fts MATCH ?"] + filters)
+            sql = ("SELECT id, connection_id, sender, ts FROM ("
+                   "SELECT m.id, m.connection_id, m.sender, m.ts, bm25(messages_fts) AS score "
+                   "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                   f"WHERE {where} ORDER BY messages_fts.rowid DESC LIMIT ?) ORDER BY score LIMIT ?")
+            reader = self._reader()
+            rows = reader.execute(sql, [match] + params + [SEARCH_RANK_WINDOW, limit]).fetchall()
+            if not rows:
+                return []
+            ids = [row[0] for row in rows]
+            snippets = dict(reader.execute(
+                "SELECT rowid, snippet(messages_fts, 0, '[', ']', '…', 16) FROM messages_fts "
+                f"WHERE messages_fts MATCH ? AND rowid IN ({', '.join('?' * len(ids))})", [match] + ids))
+            return [row + (snippets.get(row[0], ''),) for row in rows]
+        like = [term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') for term in terms]
+        where = " AND ".join(["m.message LIKE ? ESCAPE '\\'"] * len(like) + filters)
+        # 限定联系人时沿 (connection_id, ts) 索引倒序扫描, 否则沿主键倒序扫描, 都在凑够 limit 行后停止
+        order = "m.ts DESC, m.id DESC" if connection_id is not None else "m.id DESC"
+        sql = (f"SELECT m.id, m.connection_id, m.sender, m.ts, m.message FROM messages m "
+               f"WHERE {where} ORDER BY {order} LIMIT ?")
+        return self._reader().execute(sql, [f"%{term}%" for term in like] + params + [limit]).fetchall()
+    
+    def count_messages(self, connection_id=None):
+        if connection_id is None:
+            return self._reader().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return self._reader().execute(
+            "SELECT COUNT(*) FROM messages WHERE connection_id = ?", (connection_id,)).fetchone()[0]
+    
+    def iter_messages(self, connection_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+        """按联系人和时间顺序逐块读取消息, 内存占用与记录总数无关
+
+        每次生成一块行列表, 每行为 (connection_id, name, ip, port, sender, message, ts, file_path),
+        群组消息的 name 为群组名称, ip 和 port 为None。使用独立的连接, 整个遍历在同一个读事务中看到一致的快照。
+        """
+        conn = self._connect()
+        try:
+            sql = ("SELECT m.connection_id, COALESCE(c.name, g.name), c.ip, c.port, m.sender, m.message, m.ts, m.file_path "
+                   "FROM messages m LEFT JOIN connections c ON c.id = m.connection_id "
+                   "LEFT JOIN groups g ON g.id = -m.connection_id ")
+            if connection_id is None:
+                cursor = conn.execute(sql + "ORDER BY m.connection_id, m.ts, m.id")
+            else:
+                cursor = conn.execute(sql + "WHERE m.connection_id = ? ORDER BY m.ts, m.id", (connection_id,))
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            conn.close()
+    
+    def export_chat(self, connection_id, file_path, fmt=None, compress=None, progress=None, cancel=None):
+        """把一个联系人(connection_id 为 None 时为全部联系人)的聊天记录流式写入文件
+
+        fmt 为 'txt'/'jsonl'/'csv', compress 为是否gzip压缩, 未指定时按文件扩展名判断。
+        progress(done, total) 在每块写完后调用; cancel 是 threading.Event, 置位后
+        删除未完成的文件并抛出 ExportCancelled。返回导出的消息条数。
+        """
+        name = file_path.lower()
+        if compress is None:
+            compress = name.endswith('.gz')
+        if name.endswith('.gz'):
+            name = name[:-3]
+        if fmt is None:
+            fmt = os.path.splitext(name)[1].lstrip('.')
+            if fmt not in EXPORT_FORMATS:
+                fmt = 'txt'
+        self.writes.flush()
+        total = self.count_messages(connection_id)
+        done = 0
+        if compress:
+            f = gzip.open(file_path, 'wt', encoding='utf-8', newline='')
+        else:
+            f = open(file_path, 'w', encoding='utf-8', newline='')
+        try:
+            with f:
+                if fmt == 'csv':
+                    writer = csv.writer(f)
+                    writer.writerow(["contact", "ip", "port", "sender", "time", "message", "file"])
+                elif fmt == 'txt':
+                    f.write("聊天记录导出\n")
+                    f.write("=" * 50 + "\n")
+                current = None
+                for chunk in self.iter_messages(connection_id):
+                    if cancel is not None and cancel.is_set():
+                        raise ExportCancelled()
+                    for conn_id, contact, ip, port, sender, message, ts, path in chunk:
+                        if fmt == 'jsonl':
+                            f.write(json.dumps({'contact': contact, 'ip': ip, 'port': port, 'sender': sender,
+                                                'ts': ts, 'message': message, 'file': path},
+                                               ensure_ascii=False) + "\n")
+                        elif fmt == 'csv':
+                            writer.writerow([contact, ip, port, sender, format_ts(ts, "%Y-%m-%d %H:%M:%S"),
+                                             message, path or ""])
+                        else:
+                            # 导出全部联系人时每个联系人前加一行标题
+                            if connection_id is None and conn_id != current:
+                                current = conn_id
+                                f.write(f"\n[{contact} ({ip}:{port})]\n" if ip else f"\n[{contact} (群组)]\n")
+                            time_str = format_ts(ts, "%Y-%m-%d %H:%M:%S")
+                            if path:
+                                f.write(f"[{time_str}] {sender}: [文件] {os.path.basename(path)}\n")
+                            else:
+                                f.write(f"[{time_str}] {sender}: {message}\n")
+                    done += len(chunk)
+                    if progress is not None:
+                        progress(done, total)
+        except BaseException:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            raise
+        return done
+
+# 在本机随机寻找一个可用的监听端口
+def find_available_port():
+    for _ in range(10):
+        try:
+            port = random.randint(10000, 20000)
+            test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            test_socket.bind(('', port))
+            test_socket.close()
+            return port
+        except:
+            continue
+    return 9090
+
+# 局域网发现: 在组播组上通告本机的对端ID和监听端口, 收集其他对端的通告
+DISCOVERY_GROUP = '239.255.80.67'
+DISCOVERY_PORT = 48600
+DISCOVERY_TICK = 1.0                # 检查过期对端和周期通告的间隔(秒)
+ANNOUNCE_INTERVAL = 30.0            # 周期通告的基本间隔(秒), 通告中的TTL为本机周期的3倍
+ANNOUNCE_MIN_GAP = 2.0              # 本机两次通告之间的最小间隔, 查询再多也不会更频繁
+DISCOVERY_RATE = 10.0               # 整个局域网期望的通告总速率(包/秒): 对端越多, 各自的周期和答复查询的等待越长
+DISCOVERY_MAX_PACKET = 1024
+DISCOVERY_MAX_TTL = 3600.0
+
+class DiscoveredPeer:
+    __slots__ = ('peer_id', 'name', 'ip', 'port', 'expires')
+
+    def __init__(self, peer_id, name, ip, port, expires):
+        self.peer_id = peer_id
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.expires = expires
+
+    def info(self):
+        return {'peer_id': self.peer_id, 'name': self.name, 'ip': self.ip, 'port': self.port}
+
+# 发现的对端: 对端ID -> DiscoveredPeer, 超过通告中的TTL没有再收到通告时过期
+class PeerTable:
+    def __init__(self):
+        self.peers = {}
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __iter__(self):
+        return iter(list(self.peers.values()))
+
+    def update(self, peer_id, name, ip, port, ttl, now):
+        """记录一次通告, 返回 'new' (新对端)、'moved' (地址改变) 或 None"""
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            self.peers[peer_id] = DiscoveredPeer(peer_id, name, ip, port, now + ttl)
+            return 'new'
+        peer.name = name
+        peer.expires = now + ttl
+        if (peer.ip, peer.port) != (ip, port):
+            peer.ip, peer.port = ip, port
+            return 'moved'
+        return None
+
+    def remove(self, peer_id):
+        return self.peers.pop(peer_id, None)
+
+    def expire(self, now):
+        expired = [peer for peer in self.peers.values() if peer.expires <= now]
+        for peer in expired:
+            del self.peers[peer.peer_id]
+        return expired
+
+class Discovery(asyncio.DatagramProtocol):
+    """局域网发现, 运行在网络引擎的事件循环中
+
+    启动时发送一次查询和一次通告, 之后按周期通告; 周期随已知对端数增长, 使整个局域网的
+    通告总速率不超过 DISCOVERY_RATE。收到查询后随机等待一段时间再通告, 期间的多个查询合并成一次答复。
+    对端的新增、地址变化和过期以 peer_discovered / peer_expired 事件发出。没有组播路由时退回到子网广播。
+    """
+    def __init__(self, engine, peer_id, name, group=DISCOVERY_GROUP, port=DISCOVERY_PORT,
+                 announce_interval=ANNOUNCE_INTERVAL):
+        self.engine = engine
+        self.peer_id = peer_id
+        self.name = name
+        self.group = group
+        self.port = port
+        self.announce_interval = announce_interval
+        self.target = (group, port)
+        self.table = PeerTable()
+        self.transport = None
+        self.task = None
+        self.last_announce = None
+        self.reply_pending = False
+
+    def start(self):
+        """在事件循环中建立套接字并开始通告, 套接字无法建立时抛出 OSError"""
+        self.engine.submit(self._start()).result()
+
+    def stop(self):
+        if self.transport is not None and self.engine.thread.is_alive():
+            self.engine.submit(self._stop()).result(timeout=2)
+
+    async def _start(self):
+        sock = self._open_socket()
+        self.transport, _ = await self.engine.loop.create_datagram_endpoint(lambda: self, sock=sock)
+        self.task = self.engine.loop.create_task(self._run())
+
+    async def _stop(self):
+        # 通知其他对端立即移除本机, 不必等待TTL过期
+        self._send('bye')
+        self.task.cancel()
+        self.transport.close()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            # 同一台机器上的多个实例共用发现端口, 组播和广播包会交给每个实例
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', self.port))
+            try:
+                membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0'))
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            except OSError:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                self.target = ('255.255.255.255', self.port)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def interval(self):
+        return max(self.announce_interval, len(self.table) / DISCOVERY_RATE)
+
+    async def _run(self):
+        self._send('query')
+        self._announce()
+        next_announce = time.monotonic() + self.interval() * random.uniform(0.5, 1.5)
+        while True:
+            await asyncio.sleep(DISCOVERY_TICK)
+            now = time.monotonic()
+            for peer in self.table.expire(now):
+                self.engine.emit('peer_expired', **peer.info())
+            if now >= next_announce:
+                self._announce()
+                next_announce = now + self.interval() * random.uniform(0.5, 1.5)
+
+    def _announce(self):
+        now = time.monotonic()
+        if self.last_announce is not None and now - self.last_announce < ANNOUNCE_MIN_GAP:
+            return
+        self.last_announce = now
+        self._send('announce', name=self.name, port=self.engine.listen_port, ttl=3 * self.interval())
+
+    def _reply(self):
+        self.reply_pending = False
+        self._announce()
+
+    def _send(self, kind, **fields):
+        packet = json.dumps({'pychat': PROTOCOL_VERSION, 'type': kind, 'id': self.peer_id, **fields})
+        try:
+            self.transport.sendto(packet.encode('utf-8'), self.target)
+        except OSError:
+            pass
+
+    def datagram_received(self, data, addr):
+        if len(data) > DISCOVERY_MAX_PACKET:
+            return
+        try:
+            message = json.loads(data)
+            kind, peer_id = message['type'], str(message['id'])
+        except (ValueError, KeyError, TypeError):
+            return
+        if peer_id == self.peer_id:
+            return
+        if kind == 'query':
+            if not self.reply_pending:
+                self.reply_pending = True
+                delay = random.uniform(0, max(1.0, len(self.table) / DISCOVERY_RATE))
+                self.engine.loop.call_later(delay, self._reply)
+        elif kind == 'announce':
+            port, ttl = message.get('port'), message.get('ttl')
+            if not isinstance(port, int) or not 0 < port < 65536 or not isinstance(ttl, (int, float)):
+                return
+            ttl = min(max(ttl, DISCOVERY_TICK), DISCOVERY_MAX_TTL)
+            name = str(message.get('name', ''))[:64]
+            change = self.table.update(peer_id, name, addr[0], port, ttl, time.monotonic())
+            if change is not None:
+                self.engine.emit('peer_discovered', change=change, **self.table.peers[peer_id].info())
+        elif kind == 'bye':
+            peer = self.table.remove(peer_id)
+            if peer is not None:
+                self.engine.emit('peer_expired', **peer.info())
+
+    def error_received(self, exc):
+        pass
+
+# 可靠投递: 每个联系人一个发件箱窗口
+OUTBOX_WINDOW = 64                  # 最多这么多条已发送未确认的消息, 不必逐条等待确认
+
+class Outbox:
+    """一个联系人已落盘、尚未被对端确认存储的消息
+
+    序号按联系人连续分配。连接期间最多 window 条已发送未确认, 收到累积确认后从头部移除
+    并继续发送后续消息; 重新连接后从第一条未确认的消息重发, 对端按序号丢弃已存储的重复消息。
+    对端只接受紧接着的下一个序号, 发现缺口时回复 resend, 从缺少的序号开始重发。
+    """
+    def __init__(self, last_seq, rows, window=OUTBOX_WINDOW):
+        self.last_seq = last_seq    # 已分配的最大序号, 包括尚未落盘的
+        self.pending = collections.deque((seq, json.loads(payload)) for seq, payload in rows)
+        self.acked = self.pending[0][0] - 1 if self.pending else last_seq
+        self.sent = self.acked      # 本次连接中已发送的最大序号
+        self.window = window
+
+    def __len__(self):
+        return len(self.pending)
+
+    def next_seq(self):
+        self.last_seq += 1
+        return self.last_seq
+
+    def add(self, seq, message):
+        """加入一条已落盘的消息"""
+        if seq > (self.pending[-1][0] if self.pending else self.acked):
+            self.pending.append((seq, message))
+
+    def acknowledge(self, seq):
+        """处理累积确认, 返回是否确认了新的消息"""
+        if seq <= self.acked:
+            return False
+        while self.pending and self.pending[0][0] <= seq:
+            self.pending.popleft()
+        self.acked = seq
+        self.sent = max(self.sent, seq)
+        return True
+
+    def restart(self):
+        self.sent = self.acked
+
+    def rewind(self, seq):
+        """对端缺少序号 seq 的消息时, 下次从它开始重发"""
+        self.sent = max(min(self.sent, seq - 1), self.acked)
+
+    def sendable(self):
+        """窗口内尚未发送的消息, 取出后记为已发送"""
+        messages = []
+        for index in range(self.sent - self.acked, len(self.pending)):
+            seq, message = self.pending[index]
+            if seq - self.acked > self.window:
+                break
+            messages.append(message)
+            self.sent = seq
+        return messages
+
+# 聊天记录同步: 连接后交换高水位, 只传输缺少的区间; 区间校验值不一致时逐级细分找出差异
+SYNC_BATCH = 1000                   # 每个同步帧最多携带的消息数, 帧负载按协商的算法压缩
+SYNC_FANOUT = 16                    # 校验值不一致的区间每次细分成的份数
+SYNC_LEAF = 256                     # 不超过这么多个序号的区间不再细分, 两端直接交换其中的消息
+
+def sync_sender(direction):
+    """同步消息中的方向是相对发送方而言的: 'mine' 是发送方写的消息, 在接收方记为对方发出"""
+    return "对方" if direction == 'mine' else "我"
+
+def sync_direction(sender):
+    return 'mine' if sender == "我" else 'yours'
+
+def split_range(low, high, parts=SYNC_FANOUT):
+    step = max(1, -(-(high - low) // parts))
+    return [(start, min(start + step, high)) for start in range(low, high, step)]
+
+class HistorySync:
+    """在单独的线程中计算区间校验值、读取和合并同步的消息, 不阻塞事件线程
+
+    每个任务按联系人和会话执行; 会话断开后尚未发送的批次直接放弃, 下次连接时再按高水位补齐。
+    合并完成后发出 synced 事件, 由事件线程更新内存中的序号。
+    """
+    def __init__(self, db, engine):
+        self.db = db
+        self.engine = engine
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pychat-sync")
+
+    def submit(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                self.engine.emit('error', error=f"聊天记录同步失败: {e}")
+        self.executor.submit(run)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _send(self, session_id, message):
+        if self.engine.sessions.get(session_id) is None:
+            return False
+        self.engine.send_message(session_id, message)
+        return True
+
+    def push(self, conn_id, session_id, sender, low, high):
+        """把一方发出的、序号在 (low, high] 中的消息成批发给对端; 每批写出后再读下一批, 内存占用有界"""
+        sent = 0
+        for chunk in self.db.iter_range(conn_id, sender, low, high, SYNC_BATCH):
+            if not self._send(session_id, {'type': 'sync_batch', 'dir': sync_direction(sender), 'rows': chunk}):
+                return
+            sent += len(chunk)
+            self.engine.flush(session_id)
+        metrics = self.engine.metrics
+        if metrics is not None and sent:
+            metrics.count('sync.rows_sent', sent)
+
+    def digests(self, conn_id, session_id, ranges):
+        """发送区间的校验值: ranges 为 [(本机的发送者, low, high)]"""
+        digests = [[sync_direction(sender), low, high, self.db.range_digest(conn_id, sender, low, high)]
+                   for sender, low, high in ranges]
+        if digests:
+            self._send(session_id, {'type': 'sync_digests', 'ranges': digests})
+
+    def compare(self, conn_id, session_id, ranges):
+        """与对端的区间校验值比较: 不一致的小区间双方互相发送其中的消息, 大区间细分后再比较"""
+        finer, pull = [], []
+        for direction, low, high, digest in ranges:
+            sender = sync_sender(direction)
+            if self.db.range_digest(conn_id, sender, low, high) == digest:
+                continue
+            if high - low <= SYNC_LEAF:
+                self.push(conn_id, session_id, sender, low, high)
+                pull.append([sync_direction(sender), low, high])
+            else:
+                finer.extend((sender, sub_low, sub_high) for sub_low, sub_high in split_range(low, high))
+        if pull:
+            self._send(session_id, {'type': 'sync_pull', 'ranges': pull})
+        self.digests(conn_id, session_id, finer)
+
+    def pull(self, conn_id, session_id, ranges):
+        for direction, low, high in ranges:
+            self.push(conn_id, session_id, sync_sender(direction), low, high)
+
+    def merge(self, conn_id, direction, rows):
+        sender = sync_sender(direction)
+        added = self.db.merge_messages(conn_id, sender, rows)
+        metrics = self.engine.metrics
+        if metrics is not None:
+            metrics.count('sync.rows_merged', added)
+        self.engine.emit('synced', contact=conn_id, sender=sender, seq=max(row[0] for row in rows), added=added)
+
+# 联系人缓存: 启动时读取一次, 之后只按变化更新单个条目
+class Contact:
+    """联系人或群组; 群组的 id 为负的群组ID, 没有地址, members 为成员数"""
+    __slots__ = ('id', 'name', 'ip', 'port', 'last_active', 'peer_id', 'members', 'active_text', 'search_text')
+
+    def __init__(self, contact_id, name, ip, port, last_active, peer_id=None, members=None):
+        self.id = contact_id
+        self.ip = ip
+        self.port = port
+        self.peer_id = peer_id
+        self.members = members
+        self.rename(name)
+        self.set_active(last_active)
+
+    def rename(self, name):
+        self.name = name
+        address = f" {self.ip}:{self.port}" if self.ip else ""
+        self.search_text = f"{name}{address}".casefold()
+
+    def set_active(self, last_active):
+        # 显示用的时间文字随 last_active 一起缓存, 列表重绘时不再格式化
+        self.last_active = last_active
+        self.active_text = format_ts(last_active, "%m-%d %H:%M")
+
+    @property
+    def key(self):
+        return (-self.last_active, self.id)
+
+class ContactStore:
+    """ChatDatabase 前面的联系人和群组缓存
+
+    按ID、(IP, 监听端口)和对端ID建立哈希索引; order 按最后活动时间从新到旧排列, 变化时用二分查找
+    只移动变化的条目。只能在处理事件的线程中使用。设置 observer 后, 顺序变化前后回调
+    inserting(row)/inserted()、moving(old_row, new_row)/moved(), 内容变化后回调 changed(row),
+    界面的列表模型据此只更新变化的行。
+    """
+    def __init__(self, db):
+        self.db = db
+        self.observer = None
+        self.by_id = {}
+        self.by_address = {}
+        self.by_peer = {}
+        self.order = []     # Contact, 最近活动的在前
+        self.keys = []      # 与 order 对应的排序键
+        contacts = [Contact(*row) for row in db.get_contacts()]
+        contacts += [Contact(-group_id, name, None, None, last_active, members=members)
+                     for group_id, _, name, last_active, members in db.get_groups()]
+        contacts.sort(key=lambda contact: contact.key)
+        for contact in contacts:
+            self.by_id[contact.id] = contact
+            self._index(contact)
+        self.order = contacts
+        self.keys = [contact.key for contact in contacts]
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def get(self, contact_id):
+        return self.by_id.get(contact_id)
+
+    def find(self, ip, port):
+        return self.by_address.get((ip, port))
+
+    def match_peer(self, peer_id, ip, port):
+        """按对端ID查找联系人, 没有时取同一地址上尚未记录对端ID的联系人"""
+        contact = self.by_peer.get(peer_id)
+        if contact is None:
+            contact = self.by_address.get((ip, port))
+            if contact is not None and contact.peer_id is not None:
+                contact = None
+        return contact
+
+    def row(self, contact_id):
+        contact = self.by_id.get(contact_id)
+        return None if contact is None else bisect.bisect_left(self.keys, contact.key)
+
+    def search(self, text, limit=None):
+        """名称或地址包含 text (不区分大小写) 的联系人和群组, 按最后活动时间排列"""
+        text = text.casefold()
+        matches = []
+        for contact in self.order:
+            if text in contact.search_text:
+                matches.append(contact)
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def _notify(self, name, *args):
+        if self.observer is not None:
+            getattr(self.observer, name)(*args)
+
+    def _index(self, contact):
+        if contact.ip is not None:
+            self.by_address[(contact.ip, contact.port)] = contact
+        if contact.peer_id is not None:
+            previous = self.by_peer.get(contact.peer_id)
+            if previous is not None and previous is not contact:
+                # 对端ID在数据库中已经转移到这个联系人
+                previous.peer_id = None
+            self.by_peer[contact.peer_id] = contact
+
+    def _unindex(self, contact):
+        if self.by_address.get((contact.ip, contact.port)) is contact:
+            del self.by_address[(contact.ip, contact.port)]
+        if self.by_peer.get(contact.peer_id) is contact:
+            del self.by_peer[contact.peer_id]
+
+    def refresh(self, contact_id):
+        """从数据库重新读取一个联系人(负数为群组), 新出现的插入到相应位置; 返回该联系人"""
+        if contact_id > 0:
+            rows = self.db.get_contacts(contact_id)
+            fresh = Contact(*rows[0]) if rows else None
+        else:
+            rows = self.db.get_groups(-contact_id)
+            fresh = Contact(contact_id, rows[0][2], None, None, rows[0][3], members=rows[0][4]) if rows else None
+        if fresh is None:
+            return None
+        contact = self.by_id.get(contact_id)
+        if contact is None:
+            row = bisect.bisect_left(self.keys, fresh.key)
+            self._notify('inserting', row)
+            self.by_id[fresh.id] = fresh
+            self._index(fresh)
+            self.order.insert(row, fresh)
+            self.keys.insert(row, fresh.key)
+            self._notify('inserted')
+            return fresh
+        self._unindex(contact)
+        contact.ip, contact.port, contact.peer_id, contact.members = fresh.ip, fresh.port, fresh.peer_id, fresh.members
+        contact.rename(fresh.name)
+        self._index(contact)
+        self._reorder(contact, max(contact.last_active, fresh.last_active))
+        return contact
+
+    def touch(self, contact_id, last_active):
+        """联系人有了新消息: 更新最后活动时间并移到相应位置"""
+        contact = self.by_id.get(contact_id)
+        if contact is None:
+            self.refresh(contact_id)
+        elif last_active > contact.last_active:
+            self._reorder(contact, last_active)
+
+    def _reorder(self, contact, last_active):
+        old_row = bisect.bisect_left(self.keys, contact.key)
+        key = (-last_active, contact.id)
+        new_row = bisect.bisect_left(self.keys, key)
+        if new_row > old_row:
+            new_row -= 1
+        if new_row == old_row:
+            contact.set_active(last_active)
+            self.keys[old_row] = key
+            self._notify('changed', old_row)
+            return
+        self._notify('moving', old_row, new_row)
+        del self.order[old_row]
+        del self.keys[old_row]
+        contact.set_active(last_active)
+        self.order.insert(new_row, contact)
+        self.keys.insert(new_row, key)
+        self._notify('moved')
+        self._notify('changed', new_row)
+
+# 无界面的聊天核心
+class ChatCore:
+    """网络引擎、聊天记录数据库以及会话与联系人之间的绑定
+
+    网络事件在网络线程中产生并原样交给 on_event(kind, data); 调用方在自己的线程中
+    调用 handle_event(kind, data) 更新会话绑定、保存收到的消息, 然后再更新界面或输出。
+    群组会话的ID为负的群组ID, 与联系人共用聊天记录的分页、搜索和导出。
+    会话绑定和投递状态只应在这一个线程中读写。
+
+    文本消息按联系人编号: 消息和发件箱记录在同一个事务中落盘后才发出, 对端把消息和接收序号
+    在同一个事务中存储后回复累积确认 ack, 收到确认后才从发件箱移除。对端不在线时消息留在发件箱,
+    连接后按序重发; 对端按序号丢弃已经存储过的消息, 因此用户看到的每条消息恰好一次。
+
+    连接建立后双方先交换 sync: 各自已确认发出的和已存储收到的最大序号。对端缺少的区间成批补发,
+    发起连接的一方再比较双方共有区间的校验值, 找出中间缺失或不一致的部分; 对端重新安装过时,
+    本机尚未确认的消息重新编号到对端已有的序号之后, 并回复 sync_reset。收到对端的 sync 之前不发送发件箱中的消息。
+
+    开启TLS时, 发起连接的一方在对端的 hello 到达时核对证书指纹: 首次连接时记下, 之后不一致时断开并发出
+    带 fingerprint 的 connect_failed; 重新连接同一地址时复用缓存的TLS会话。
+    """
+    def __init__(self, on_event, db_name="chat_history.db", download_dir=DOWNLOAD_DIR, metrics=False, tls=None,
+                 **engine_options):
+        self.db = ChatDatabase(db_name)
+        self.contacts = ContactStore(self.db)
+        self.engine = NetworkEngine(on_event, download_dir=download_dir, **engine_options)
+        self.session_contacts = {}   # 会话ID -> 联系人ID
+        self.contact_sessions = {}   # 联系人ID -> 会话ID
+        self.interrupted_files = {}  # 联系人ID -> 中断后待续传的文件路径
+        self.file_contacts = {}      # (会话ID, 发出的文件路径) -> 联系人ID, 断开后仍能找到中断的文件属于谁
+        self.outboxes = {}           # 联系人ID -> Outbox, 首次用到时从数据库加载
+        self.received = {}           # 联系人ID -> 已接受的最大接收序号(可能尚未落盘)
+        self.resend_requested = {}   # 联系人ID -> 已请求对端重发的序号, 收到该消息前不再重复请求
+        self.stored = {}             # 联系人ID -> 已落盘的最大接收序号, 即回复给对端的确认
+        self.syncing = set()         # 已连接但尚未收到对端 sync 的联系人, 暂不发送发件箱
+        self.renumbering = {}        # 联系人ID -> (会话ID, 对端的 sync), 发件箱重新编号提交后再继续处理
+        self.group_ids = {}          # 群组 uid -> 群组ID, 收到已知群组的消息时不必访问数据库
+        self.sending_files = {}      # 发出的文件路径 -> 等待其内容标识的会话(联系人ID, 群组为负)
+        self.pins = {}               # 联系人ID -> 证书指纹(已忘记时为空串), 网络线程核对证书时使用, 写入尚未提交时也是最新的
+        self.listen_port = None
+        self.discovery = None
+        self.metrics = None
+        self.tls = None
+        # 为None时沿用保存的设置; 本机证书与数据库放在一起, 在 start() 中加载
+        self.tls_enabled = self.db.get_setting('tls') == '1' if tls is None else tls
+        self.identity_path = os.path.splitext(os.path.abspath(db_name))[0] + "_identity.pem"
+        self.metrics_reporter = None
+        # 每个安装固定不变的对端ID, 对端据此在本机换了地址或端口后仍能认出联系人
+        self.peer_id = self.db.get_setting('peer_id')
+        if self.peer_id is None:
+            self.peer_id = secrets.token_hex(8)
+            self.db.set_setting('peer_id', self.peer_id)
+        self.engine.peer_id = self.peer_id
+        self.db.writes.on_commit = self._committed
+        self.engine.attachment_lookup = self.db.find_attachment
+        self.engine.verify_peer = self._verify_peer
+        self.sync = HistorySync(self.db, self.engine)
+        if metrics:
+            self.enable_metrics()
+    
+    def start(self, port=None):
+        """开始监听并返回监听端口; 未指定端口时沿用上次的端口, 被占用时随机选择; 监听失败时抛出异常
+
+        开启TLS时先加载本机证书, 没有时生成; 无法生成时抛出 OSError。
+        """
+        if self.tls_enabled and self.tls is None:
+            self.tls = self.engine.tls = TLSConfig(self.identity_path, f"pychat-{self.peer_id}")
+        if port is None:
+            saved = self.db.get_setting('listen_port')
+            if saved is not None:
+                try:
+                    return self._listen(int(saved))
+                except OSError:
+                    pass
+            port = find_available_port()
+        return self._listen(port)
+    
+    def _listen(self, port):
+        self.engine.start(port)
+        self.listen_port = port
+        self.db.set_setting('listen_port', port)
+        return port
+    
+    def start_discovery(self, **options):
+        """开始局域网发现, 需要在 start() 之后调用; 套接字无法建立时抛出 OSError"""
+        self.discovery = Discovery(self.engine, self.peer_id, socket.gethostname(), **options)
+        self.discovery.start()
+    
+    def discovered_peers(self):
+        return [peer.info() for peer in self.discovery.table] if self.discovery else []
+    
+    def stop(self):
+        if self.discovery is not None:
+            self.discovery.stop()
+        self.sync.close()
+        self.engine.stop()
+        self.db.flush()
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.close()
+        self.db.close()
+    
+    def enable_metrics(self):
+        """开始记录运行时指标并返回 Metrics, 已开启时返回现有的"""
+        if self.metrics is None:
+            self.metrics = Metrics()
+            self.metrics.sources.append(self.status)
+            self.engine.metrics = self.db.metrics = self.metrics
+        return self.metrics
+    
+    def disable_metrics(self):
+        """停止记录指标, 已记录的数据随之丢弃; 定期写出的快照文件也停止更新"""
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.close()
+            self.metrics_reporter = None
+        self.metrics = self.engine.metrics = self.db.metrics = None
+        for session in self.engine.sessions:
+            session.send_latency = None
+    
+    def status(self):
+        """不开启指标也能取得的运行状态: 各会话的计数器、进行中的传输和写入队列"""
+        transfers = [transfer.info() for transfer in list(self.engine.outgoing.values())]
+        transfers += [incoming.transfer.info() for incoming in list(self.engine.stream_tokens.values())]
+        last_error = self.db.writes.last_error
+        return {'sessions': [session.info() for session in self.engine.sessions],
+                'transfers': transfers,
+                'outbox': {conn_id: len(outbox) for conn_id, outbox in list(self.outboxes.items()) if outbox},
+                'db': {'pending': self.db.writes.pending(), 'last_error': str(last_error) if last_error else None}}
+    
+    def snapshot(self):
+        """指标快照; 未开启指标时只包含 status() 的内容"""
+        if self.metrics is None:
+            return {'time': now_us(), **self.status()}
+        return self.metrics.snapshot()
+    
+    def write_metrics(self, path, interval=METRICS_INTERVAL):
+        """开启指标, 并每隔 interval 秒把快照写入JSON文件 path"""
+        self.enable_metrics()
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.close()
+        self.metrics_reporter = MetricsReporter(self.snapshot, path, interval)
+    
+    def serve_metrics(self, port):
+        """开启指标, 并在 127.0.0.1:port 上提供快照; 需要在 start() 之后调用"""
+        self.enable_metrics()
+        self.engine.serve_metrics(port)
+    
+    def set_tls_enabled(self, enabled):
+        """保存是否使用TLS, 下次启动时生效; 双方都开启时才能互相连接"""
+        self.db.set_setting('tls', int(bool(enabled)))
+    
+    def _verify_peer(self, conn_id, fingerprint):
+        # 网络线程中调用: 首次加密连接联系人时记住证书指纹, 之后指纹不同时拒绝连接;
+        # 指纹缓存在内存中, 写入交给写线程, 网络线程不等待提交
+        if conn_id is None:
+            return None
+        pinned = self.pins.get(conn_id)
+        if pinned is None:
+            pinned = self.db.get_certificate(conn_id) or ""
+        if not pinned:
+            self.pins[conn_id] = fingerprint
+            self.db.pin_certificate(conn_id, fingerprint)
+        elif pinned != fingerprint:
+            return f"对端证书与首次连接时记录的不一致 (记录 {pinned[:16]}…, 收到 {fingerprint[:16]}…)"
+        return None
+    
+    def forget_certificate(self, conn_id):
+        """忘记联系人的证书指纹, 下次连接时信任对端出示的证书, 用于对端重新安装后"""
+        self.pins[conn_id] = ""
+        self.db.forget_certificate(conn_id)
+    
+    def add_contact(self, name, ip, port, peer_id=None):
+        """添加联系人并返回其ID, 同一地址已存在时只更新名称; 给出 peer_id 时同时记录对端ID"""
+        conn_id = self.db.add_connection(name, ip, int(port))
+        if peer_id:
+            self.db.update_peer(conn_id, peer_id, ip, int(port))
+        self.contacts.refresh(conn_id)
+        return conn_id
+    
+    def connect(self, conn_id):
+        """连接到联系人; 已有会话时返回会话ID, 否则发起连接并返回None, 结果通过 connected/connect_failed 事件返回"""
+        session_id = self.contact_sessions.get(conn_id)
+        if session_id is not None:
+            return session_id
+        contact = self.contacts.get(conn_id)
+        if contact is None or contact.ip is None:
+            raise KeyError(f"联系人不存在: {conn_id}")
+        self.engine.connect(contact.ip, contact.port, tag=conn_id)
+        return None
+    
+    def session_for(self, conn_id):
+        session_id = self.contact_sessions.get(conn_id)
+        if session_id is None:
+            raise ConnectionError("没有活动连接，请先连接")
+        return session_id
+    
+    def send_text(self, conn_id, text):
+        """发送文本消息并返回其序号; 不在线时消息留在发件箱, 连接后发送"""
+        seq = self.outbox(conn_id).next_seq()
+        message = {'type': 'text', 'content': text, 'seq': seq}
+        self.db.save_message(conn_id, "我", text, seq=seq, payload=json.dumps(message, ensure_ascii=False))
+        return seq
+    
+    def outbox(self, conn_id):
+        outbox = self.outboxes.get(conn_id)
+        if outbox is None:
+            seq_out, _ = self.db.get_sequences(conn_id)
+            outbox = self.outboxes[conn_id] = Outbox(seq_out, self.db.get_outbox(conn_id))
+        return outbox
+    
+    def _committed(self, batch):
+        # 写线程中调用: 把刚落盘的发出消息和接收序号转交到事件线程, 在那里发送消息和确认, 并更新联系人的最后活动时间
+        sent, stored, active, renumbered, groups = [], {}, {}, [], set()
+        for item in batch:
+            if item[0] is None:
+                if item[1] is ChatDatabase._renumber_outgoing:
+                    renumbered.append(item[2][0])
+                elif item[1] is ChatDatabase._merge_group_members:
+                    groups.add(item[2][0])
+                continue
+            active[item[0]] = max(item[3], active.get(item[0], item[3]))
+            if len(item) > 5 and item[5] is not None:
+                conn_id, seq, payload = item[0], item[5], item[6]
+                if payload is None:
+                    stored[conn_id] = max(seq, stored.get(conn_id, seq))
+                else:
+                    sent.append((conn_id, seq, payload))
+        if active or renumbered or groups:
+            self.engine.emit('committed', sent=sent, stored=stored, active=active, renumbered=renumbered, groups=groups)
+    
+    def _pump(self, conn_id):
+        """在窗口允许的范围内发送发件箱中的消息"""
+        session_id = self.contact_sessions.get(conn_id)
+        if session_id is None or conn_id in self.syncing:
+            return
+        for message in self.outbox(conn_id).sendable():
+            self.engine.send_message(session_id, message)
+    
+    def _send_ack(self, conn_id):
+        session_id = self.contact_sessions.get(conn_id)
+        if session_id is not None and self._stored(conn_id):
+            self.engine.send_message(session_id, {'type': 'ack', 'seq': self._stored(conn_id)})
+    
+    def _stored(self, conn_id):
+        if conn_id not in self.stored:
+            self.stored[conn_id] = self.db.get_sequences(conn_id)[1]
+        return self.stored[conn_id]
+    
+    def _received(self, conn_id):
+        if conn_id not in self.received:
+            self.received[conn_id] = self._stored(conn_id)
+        return self.received[conn_id]
+    
+    def send_file(self, conn_id, file_path):
+        """发送文件, 文件内容在网络线程中发送, 进度通过 transfer_* 事件返回"""
+        session_id = self.session_for(conn_id)
+        future = self.engine.send_file(session_id, file_path)
+        self.file_contacts[(session_id, file_path)] = conn_id
+        self.db.save_message(conn_id, "我", f"[文件] {os.path.basename(file_path)}", file_path)
+        self.sending_files.setdefault(file_path, set()).add(conn_id)
+        return future
+    
+    def create_group(self, name, conn_ids):
+        """创建群组并把成员名单发给在线的成员, 返回群组ID"""
+        uid = secrets.token_hex(8)
+        group_id = self.group_ids[uid] = self.db.add_group(uid, name)
+        self.db.add_group_members(group_id, conn_ids)
+        self.contacts.refresh(-group_id)
+        self._send_roster(group_id, [self.contact_sessions[conn_id] for conn_id in conn_ids
+                                     if conn_id in self.contact_sessions])
+        return group_id
+    
+    def group_sessions(self, group_id):
+        """在线成员的会话ID和成员总数"""
+        members = self.db.get_group_members(group_id)
+        return [self.contact_sessions[row[0]] for row in members if row[0] in self.contact_sessions], len(members)
+    
+    def send_group_text(self, group_id, text):
+        """把文本消息发给群组中在线的成员, 消息只编码一次; 返回 (送达的成员数, 成员总数)
+
+        群组消息不经过各联系人的发件箱, 不在线的成员收不到。
+        """
+        _, uid, name, _ = self.db.get_group(group_id)
+        sessions, total = self.group_sessions(group_id)
+        self.engine.broadcast(sessions, {'type': 'group_text', 'group': uid, 'name': name, 'content': text})
+        self.db.save_message(-group_id, "我", text)
+        return len(sessions), total
+    
+    def send_group_file(self, group_id, file_path):
+        """把文件发给群组中在线的成员, 各分段的校验值只计算一次; 返回 (送达的成员数, 成员总数)"""
+        _, uid, name, _ = self.db.get_group(group_id)
+        sessions, total = self.group_sessions(group_id)
+        for session_id in sessions:
+            self.engine.send_file(session_id, file_path, {'group': uid, 'group_name': name})
+        self.db.save_message(-group_id, "我", f"[文件] {os.path.basename(file_path)}", file_path)
+        if sessions:
+            self.sending_files.setdefault(file_path, set()).add(-group_id)
+        return len(sessions), total
+    
+    def _send_roster(self, group_id, sessions):
+        _, uid, name, _ = self.db.get_group(group_id)
+        members = [{'peer_id': peer_id, 'name': member_name, 'ip': ip, 'port': port}
+                   for _, member_name, ip, port, peer_id in self.db.get_group_members(group_id)]
+        self.engine.broadcast(sessions, {'type': 'group', 'group': uid, 'name': name, 'members': members})
+    
+    def _join_group(self, conn_id, uid, name, members=None):
+        """记录对端告知的群组并返回群组ID
+
+        只在收到名单 members 或第一次遇到这个群组时合并成员: 发送者和名单中的成员都加入本地群组,
+        不认识的成员新建为联系人。成员经写入队列写入, 提交后刷新联系人列表中的群组。
+        """
+        group_id = self.group_ids.get(uid)
+        if group_id is None:
+            group_id = self.db.find_group(uid)
+            if group_id is None:
+                group_id = self.db.add_group(uid, name)
+                self.contacts.refresh(-group_id)
+            self.group_ids[uid] = group_id
+        elif members is None:
+            return group_id
+        member_ids = [conn_id]
+        for member in members or ():
+            peer_id = member.get('peer_id')
+            if peer_id and peer_id == self.peer_id:
+                continue
+            ip, port = member['ip'], int(member['port'])
+            contact = self.contacts.match_peer(peer_id, ip, port) if peer_id else self.contacts.find(ip, port)
+            if contact is None:
+                member_id = self.add_contact(member['name'], ip, port, peer_id)
+            else:
+                member_id = contact.id
+            member_ids.append(member_id)
+        self.db.merge_group_members(group_id, member_ids)
+        return group_id
+    
+    def handle_event(self, kind, data):
+        """处理一个网络事件并返回 data, 其中补充了 'contact' (联系人ID, 未绑定时为None)
+
+        connected 事件另外补充 'created' (是否新建了联系人)、'updated' (联系人地址是否按对端ID更新)
+        和 'resumed_files' (重新开始发送的中断文件); peer_discovered 事件补充 'updated';
+        disconnected 事件补充 'unbound' (该会话是否仍是联系人的当前会话);
+        重复收到的文本消息补充 'duplicate', 序号不连续的补充 'out_of_order', 都不保存, 调用方也不应再显示;
+        对端的确认 ack 补充 'delivered' (已确认的最大序号);
+        群组消息和群组名单补充 'conversation' (负的群组ID) 和 'sender' (发送者名称)。
+        """
+        session_id = data.get('session')
+        if kind == 'connected':
+            conn_id = data['tag']
+            data['created'] = False
+            # 与本机相同的ID说明两端共用同一个数据库(例如同一目录下运行的两个实例), 不能用来识别联系人
+            peer_id = data['peer_id'] if data['peer_id'] != self.peer_id else None
+            if conn_id is None:
+                # 入站会话按对端ID查找联系人, 对端没有给出ID时按 (IP, 监听端口) 查找
+                if peer_id:
+                    contact = self.contacts.match_peer(peer_id, data['ip'], data['port'])
+                else:
+                    contact = self.contacts.find(data['ip'], data['port'])
+                if contact:
+                    conn_id = contact.id
+                else:
+                    conn_id = self.add_contact(f"{data['ip']}:{data['port']}", data['ip'], data['port'])
+                    data['created'] = True
+            # 接收序号的缓存跨连接保持有效; 新的连接上可以重新请求重发
+            self.resend_requested.pop(conn_id, None)
+            data['updated'] = bool(peer_id) and self.db.update_peer(conn_id, peer_id, data['ip'], data['port'])
+            if peer_id:
+                self.contacts.refresh(conn_id)
+            self.session_contacts[session_id] = conn_id
+            self.contact_sessions[conn_id] = session_id
+            data['contact'] = conn_id
+            data['resumed_files'] = self.resume_files(session_id, conn_id)
+            # 先告诉对端已经存储到哪里, 对端不必重发这些消息; 收到对端的 sync 后再从第一条未确认的消息开始发送
+            self._send_ack(conn_id)
+            self.syncing.add(conn_id)
+            self.engine.send_message(session_id, {'type': 'sync', 'sent': self.outbox(conn_id).acked,
+                                                  'received': self._stored(conn_id),
+                                                  'reset': self.db.get_peer_reset(conn_id)})
+            for group_id in self.db.get_contact_groups(conn_id):
+                self._send_roster(group_id, [session_id])
+            return data
+        if kind == 'disconnected':
+            conn_id = self.session_contacts.pop(session_id, None)
+            self.syncing.discard(conn_id)
+            data['contact'] = conn_id
+            data['unbound'] = self.contact_sessions.get(conn_id) == session_id
+            if data['unbound']:
+                del self.contact_sessions[conn_id]
+            return data
+        if kind in ('reconnecting', 'connect_failed'):
+            data['contact'] = data['tag']
+            return data
+        if kind == 'synced':
+            conn_id = data['contact']
+            if data['sender'] == "我":
+                outbox = self.outbox(conn_id)
+                if not outbox and data['seq'] > outbox.last_seq:
+                    outbox.last_seq = outbox.acked = outbox.sent = data['seq']
+            else:
+                self.stored[conn_id] = max(data['seq'], self._stored(conn_id))
+                self.received[conn_id] = max(data['seq'], self._received(conn_id))
+            return data
+        if kind == 'committed':
+            for conn_id, seq, payload in data['sent']:
+                self.outbox(conn_id).add(seq, json.loads(payload))
+            for conn_id, seq in data['stored'].items():
+                self.stored[conn_id] = max(seq, self._stored(conn_id))
+                self._send_ack(conn_id)
+            for conn_id in data['renumbered']:
+                # 重新编号已提交: 发件箱从数据库重新加载, 已分配而尚未落盘的序号继续保留, 然后继续处理对端的 sync
+                last_seq = self.outboxes.pop(conn_id).last_seq
+                outbox = self.outbox(conn_id)
+                outbox.last_seq = max(outbox.last_seq, last_seq)
+                session_id, message = self.renumbering.pop(conn_id)
+                if self.contact_sessions.get(conn_id) == session_id:
+                    self._start_sync(conn_id, session_id, message)
+            for conn_id in {conn_id for conn_id, _, _ in data['sent']}:
+                self._pump(conn_id)
+            for conn_id, ts in data['active'].items():
+                self.contacts.touch(conn_id, ts)
+            for group_id in data['groups']:
+                self.contacts.refresh(-group_id)
+            return data
+        if kind == 'peer_discovered':
+            # 已知联系人的地址随通告就地更新, 例如对端重启后换了端口
+            contact = self.contacts.match_peer(data['peer_id'], data['ip'], data['port'])
+            data['contact'] = contact.id if contact else None
+            data['updated'] = bool(contact) and self.db.update_peer(contact.id, data['peer_id'], data['ip'], data['port'])
+            if contact:
+                self.contacts.refresh(contact.id)
+            # 正在按旧地址自动重连的联系人改为立即连接新地址
+            if data['updated'] and self.engine.cancel_reconnect(data['contact']):
+                self.connect(data['contact'])
+            return data
+        if kind == 'transfer_failed' and data['outgoing']:
+            # 连接断开时 disconnected 先于发出文件的 transfer_failed 到达, 联系人按发送时记录的会话和路径查找;
+            # 重新连接到该联系人后从最后一个已校验的分段继续发送
+            conn_id = data['contact'] = self.file_contacts.pop((session_id, data['path']), None)
+            if conn_id is not None:
+                pending = self.interrupted_files.setdefault(conn_id, [])
+                if data['path'] not in pending:
+                    pending.append(data['path'])
+            return data
+        if kind == 'transfer_done' and data['outgoing']:
+            self.file_contacts.pop((session_id, data['path']), None)
+        conn_id = data['contact'] = self.session_contacts.get(session_id)
+        if conn_id is None:
+            return data
+        if kind == 'message':
+            message = data['message']
+            if message['type'] == 'text':
+                seq = message.get('seq')
+                if seq is None:
+                    self.db.save_message(conn_id, "对方", message['content'])
+                elif seq <= self._received(conn_id):
+                    # 重连后对端重发的消息: 已经存储过, 只需再次确认
+                    data['duplicate'] = True
+                    self._send_ack(conn_id)
+                elif seq > self._received(conn_id) + 1:
+                    # 中间有消息缺失: 丢弃, 请对端从缺少的序号重发, 否则缺少的消息之后会被当作重复消息丢弃
+                    data['out_of_order'] = True
+                    expected = self._received(conn_id) + 1
+                    if self.resend_requested.get(conn_id) != expected:
+                        self.resend_requested[conn_id] = expected
+                        self.engine.send_message(session_id, {'type': 'resend', 'seq': expected})
+                else:
+                    self.received[conn_id] = seq
+                    self.resend_requested.pop(conn_id, None)
+                    self.db.save_message(conn_id, "对方", message['content'], seq=seq)
+            elif message['type'] == 'sync':
+                self._start_sync(conn_id, session_id, data['message'])
+            elif message['type'] == 'sync_reset':
+                self.db.clear_peer_reset(conn_id)
+            elif message['type'] == 'sync_digests':
+                self.sync.submit(self.sync.compare, conn_id, session_id, message['ranges'])
+            elif message['type'] == 'sync_pull':
+                self.sync.submit(self.sync.pull, conn_id, session_id, message['ranges'])
+            elif message['type'] == 'sync_batch' and message['rows']:
+                self.sync.submit(self.sync.merge, conn_id, message['dir'], message['rows'])
+            elif message['type'] == 'resend':
+                self.outbox(conn_id).rewind(int(message['seq']))
+                self._pump(conn_id)
+            elif message['type'] == 'ack':
+                outbox = self.outbox(conn_id)
+                if outbox.acknowledge(int(message['seq'])):
+                    self.db.acknowledge(conn_id, outbox.acked)
+                    self._pump(conn_id)
+                data['delivered'] = outbox.acked
+            elif message['type'] in ('group', 'group_text') or message['type'] == 'file' and 'group' in message:
+                group_id = self._join_group(conn_id, message['group'], message.get('name') or message.get('group_name'),
+                                            message.get('members'))
+                data['conversation'] = -group_id
+                data['sender'] = self.contacts.get(conn_id).name
+                if message['type'] == 'group_text':
+                    self.db.save_message(-group_id, data['sender'], message['content'])
+                elif message['type'] == 'file' and not data.get('resumed'):
+                    self.db.save_message(-group_id, data['sender'], f"[文件] {message['file_name']}", data.get('path'),
+                                         attachment=message.get('content_hash'))
+            elif message['type'] == 'file' and not data.get('resumed'):
+                self.db.save_message(conn_id, "对方", f"[文件] {message['file_name']}", data.get('path'),
+                                     attachment=message.get('content_hash'))
+        elif kind == 'transfer_done' and data['content_hash'] and data['outgoing']:
+            # 发出的文件记入附件索引, 发送时保存的消息补上内容标识
+            self.db.add_attachment(data['content_hash'], data['path'], self.sending_files.pop(data['path'], ()))
+        elif kind == 'transfer_done' and data['content_hash'] and not data['deduplicated']:
+            # 收到的文件记入附件索引, 以后收到相同内容时不再传输; 同时收完的相同内容只保留先记录的一份
+            self.db.add_attachment(data['content_hash'], data['path'], received=True)
+        return data
+    
+    def _start_sync(self, conn_id, session_id, message):
+        """处理对端的 sync: 补发对端缺少的消息, 必要时重新编号, 然后开始发送发件箱"""
+        if conn_id in self.renumbering:
+            # 上次的重新编号尚未提交, 提交后按最新的 sync 处理
+            self.renumbering[conn_id] = (session_id, message)
+            return
+        peer_sent, peer_received = int(message['sent']), int(message['received'])
+        # 对端已确认发出的消息由历史同步补发, 之后的消息从 peer_sent 的下一个序号接着接收
+        self.received[conn_id] = max(self._received(conn_id), peer_sent)
+        outbox = self.outbox(conn_id)
+        if message.get('reset') and peer_received > outbox.acked:
+            # 本机重新安装过, 对端已有本机以前发出的消息: 尚未确认的消息改用之后的序号, 以前的消息随后由对端补发。
+            # 重新编号经写入队列执行, 之后分配的序号直接接在后面; 提交后重新加载发件箱, 再继续处理这个 sync
+            delta = peer_received - outbox.acked
+            self.db.renumber_outgoing(conn_id, outbox.acked, outbox.last_seq, delta)
+            outbox.last_seq += delta
+            self.renumbering[conn_id] = (session_id, message)
+            self.engine.send_message(session_id, {'type': 'sync_reset'})
+            return
+        stored = self._stored(conn_id)
+        if peer_received < outbox.acked:
+            self.sync.submit(self.sync.push, conn_id, session_id, "我", peer_received, outbox.acked)
+        if peer_sent < stored:
+            self.sync.submit(self.sync.push, conn_id, session_id, "对方", peer_sent, stored)
+        if self.engine.sessions.get(session_id) is not None and self.engine.sessions.get(session_id).outgoing:
+            # 发起连接的一方检查双方共有的区间是否一致
+            ranges = [(sender, 0, high) for sender, high in (("我", min(outbox.acked, peer_received)),
+                                                             ("对方", min(stored, peer_sent))) if high > 0]
+            self.sync.submit(self.sync.digests, conn_id, session_id, ranges)
+        self.syncing.discard(conn_id)
+        outbox.restart()
+        self._pump(conn_id)
+    
+    def resume_files(self, session_id, conn_id):
+        resumed = []
+        for file_path in self.interrupted_files.pop(conn_id, []):
+            if os.path.exists(file_path):
+                self.engine.send_file(session_id, file_path)
+                self.file_contacts[(session_id, file_path)] = conn_id
+                resumed.append(file_path)
+        return resumed
+
+# 命令行/守护进程模式: 所有网络事件和标准输入的命令都经同一个队列在主线程中处理
+def describe_event(core, kind, data):
+    """把事件转换成一行可读的文字, 不需要输出的事件返回None"""
+    name = None
+    if data.get('contact') is not None:
+        contact = core.contacts.get(data['contact'])
+        name = f"{contact.name}#{contact.id}" if contact else str(data['contact'])
+    if kind == 'connected':
+        secure = f", {data['tls']}{', 会话复用' if data['resumed'] else ''}" if data['tls'] else ""
+        return f"已连接: {name} ({data['ip']}:{data['port']}{secure})"
+    if kind == 'connect_failed' and data.get('fingerprint'):
+        return f"连接失败: {data['ip']}:{data['port']} ({data['error']}), 确认对端重新安装过后用 /trust {data['contact']} 信任新证书"
+    if kind == 'connect_failed':
+        return f"连接失败: {data['ip']}:{data['port']} ({data['error']})"
+    if kind == 'disconnected':
+        reason = f" ({data['error']})" if data['error'] else ""
+        return f"连接已断开: {name}{reason}" + (", 正在自动重连" if data['reconnecting'] else "")
+    if kind == 'peer_discovered':
+        line = f"发现对端: {data['name']} {data['ip']}:{data['port']}"
+        return line + (f", 已更新联系人 {name} 的地址" if data['updated'] else "")
+    if kind == 'peer_expired':
+        return f"对端离开: {data['name']} {data['ip']}:{data['port']}"
+    if kind == 'reconnecting':
+        return f"{data['delay']:.1f} 秒后第 {data['attempt']} 次重连 {data['ip']}:{data['port']}"
+    if kind == 'message':
+        message = data['message']
+        if message['type'] == 'text' and not (data.get('duplicate') or data.get('out_of_order')):
+            return f"[{format_ts(now_us(), '%H:%M:%S')}] {name}: {message['content']}"
+        if message['type'] == 'group_text':
+            return f"[{format_ts(now_us(), '%H:%M:%S')}] [{message['name']}#{data['conversation']}] {name}: {message['content']}"
+        if message['type'] == 'file':
+            return f"[{format_ts(now_us(), '%H:%M:%S')}] {name}: [文件] {message['file_name']} -> {data.get('path')}"
+        return None
+    if kind == 'transfer_done' and data['deduplicated']:
+        return f"传输完成: {data['file_name']} (接收端已有相同内容, 未传输数据)"
+    if kind == 'transfer_done':
+        return f"传输完成: {data['file_name']} ({data['throughput'] / (1024 * 1024):.1f} MB/s, 压缩比 {data['compression_ratio']:.1f}:1)"
+    if kind == 'transfer_failed':
+        return f"传输中断: {data['file_name']} ({data['error']})"
+    if kind == 'synced' and data['added']:
+        return f"已从 {name} 同步 {data['added']} 条聊天记录"
+    if kind == 'error':
+        return f"错误: {data['error']}"
+    return None
+
+CLI_HELP = """命令:
+  /connect IP 端口     连接到对端并设为当前联系人
+  /to 联系人ID         切换当前联系人
+  /contacts            列出联系人
+  /peers               列出局域网中发现的对端
+  /trust 联系人ID       忘记联系人的证书指纹, 下次连接时信任对端的新证书
+  /groups              列出群组, 群组ID为负数, 可以用 /to 切换
+  /group 名称 联系人ID...  创建群组并切换到该群组
+  /file 路径           向当前联系人发送文件
+  /stats               显示会话计数器和性能指标
+  /quit                退出
+  其他输入作为文本消息发送给当前联系人"""
+
+def run_cli(args):
+    events = queue.Queue()
+    core = ChatCore(lambda kind, data: events.put((kind, data)), db_name=args.db, download_dir=args.download_dir,
+                    metrics=args.metrics, heartbeat_interval=args.heartbeat_interval,
+                    heartbeat_timeout=args.heartbeat_timeout,
+                    reconnect_attempts=0 if args.command == 'send' else RECONNECT_ATTEMPTS, tls=args.tls)
+    if args.tls is not None:
+        core.set_tls_enabled(args.tls)
+    try:
+        port = core.start(args.port)
+        if args.metrics_port:
+            core.serve_metrics(args.metrics_port)
+    except OSError as e:
+        print(f"监听失败: {e}", file=sys.stderr)
+        core.stop()
+        return 1
+    if args.metrics_file:
+        core.write_metrics(args.metrics_file, args.metrics_interval)
+    if args.discovery and args.command != 'send':
+        try:
+            core.start_discovery()
+        except OSError as e:
+            print(f"局域网发现不可用: {e}", file=sys.stderr)
+    print(f"正在监听 {get_local_ip()}:{port}", flush=True)
+    if core.tls is not None:
+        print(f"TLS已开启, 本机证书指纹 {core.tls.fingerprint}", flush=True)
+
+    def output(kind, data):
+        if kind == 'committed':
+            return
+        if args.json:
+            print(json.dumps({'event': kind, **data}, ensure_ascii=False, default=str), flush=True)
+        else:
+            line = describe_event(core, kind, data)
+            if line:
+                print(line, flush=True)
+
+    current = None
+    pending = []        # 连接建立后要发送的 (种类, 内容)
+    waiting = set()     # send 命令等待完成的文件传输
+    delivering = [0]    # send 命令等待对端确认的文本消息序号
+    if args.command in ('connect', 'send'):
+        current = core.add_contact(f"{args.ip}:{args.peer_port}", args.ip, args.peer_port)
+        core.connect(current)
+        if args.command == 'send':
+            pending = [('file', path) for path in args.file] + ([('text', args.message)] if args.message else [])
+    if args.command != 'send':
+        def read_input():
+            for line in sys.stdin:
+                events.put(('input', line.rstrip('\n')))
+            events.put(('eof', None))
+        threading.Thread(target=read_input, name="pychat-stdin", daemon=True).start()
+
+    def flush_pending():
+        for what, content in pending:
+            if what == 'text':
+                delivering[0] = core.send_text(current, content)
+            else:
+                waiting.add(os.path.basename(content))
+                core.send_file(current, content)
+        pending.clear()
+
+    status = 0
+    try:
+        while True:
+            kind, data = events.get()
+            if kind == 'eof':
+                if args.command == 'listen':
+                    continue
+                break
+            if kind == 'input':
+                line = data.strip()
+                if not line:
+                    continue
+                try:
+                    if line == '/quit':
+                        break
+                    elif line == '/help':
+                        print(CLI_HELP)
+                    elif line == '/stats':
+                        print(format_snapshot(core.snapshot()))
+                    elif line == '/contacts':
+                        for contact in core.contacts:
+                            if contact.ip is not None:
+                                online = " *" if contact.id in core.contact_sessions else ""
+                                print(f"{contact.id}: {contact.name} {contact.ip}:{contact.port}{online}")
+                    elif line == '/groups':
+                        for contact in core.contacts:
+                            if contact.ip is None:
+                                print(f"{contact.id}: {contact.name} ({contact.members} 人)")
+                    elif line.startswith('/group '):
+                        name, *members = line.split()[1:]
+                        current = -core.create_group(name, [int(conn_id) for conn_id in members])
+                    elif line == '/peers':
+                        for peer in core.discovered_peers():
+                            print(f"{peer['name']} {peer['ip']}:{peer['port']} ({peer['peer_id']})")
+                    elif line.startswith('/connect '):
+                        ip, peer_port = line.split()[1:3]
+                        current = core.add_contact(f"{ip}:{peer_port}", ip, int(peer_port))
+                        core.connect(current)
+                    elif line.startswith('/trust '):
+                        core.forget_certificate(int(line.split()[1]))
+                    elif line.startswith('/to '):
+                        current = int(line.split()[1])
+                    elif line.startswith('/file ') and current is not None and current < 0:
+                        sent, total = core.send_group_file(-current, line[6:].strip())
+                        print(f"已发给 {sent}/{total} 位在线成员", file=sys.stderr)
+                    elif line.startswith('/file '):
+                        core.send_file(current, line[6:].strip())
+                    elif current is None:
+                        print("请先用 /connect 或 /to 选择联系人", file=sys.stderr)
+                    elif current < 0:
+                        sent, total = core.send_group_text(-current, line)
+                        if sent < total:
+                            print(f"已发给 {sent}/{total} 位在线成员", file=sys.stderr)
+                    else:
+                        core.send_text(current, line)
+                        if current not in core.contact_sessions:
+                            print("对方不在线, 消息将在连接后发送", file=sys.stderr)
+                except (ConnectionError, KeyError, ValueError, IndexError) as e:
+                    print(f"错误: {e}", file=sys.stderr)
+                continue
+            data = core.handle_event(kind, data)
+            output(kind, data)
+            if args.command == 'listen' and kind == 'connected' and current is None:
+                current = data['contact']
+            if args.command != 'send':
+                continue
+            # send 命令: 连接后发送, 文本被对端确认且文件传输结束后退出
+            if kind == 'connect_failed':
+                status = 1
+                break
+            if kind == 'connected' and data['contact'] == current:
+                flush_pending()
+            elif kind in ('transfer_done', 'transfer_failed') and data['outgoing']:
+                waiting.discard(data['file_name'])
+                if kind == 'transfer_failed':
+                    status = 1
+            if (current in core.contact_sessions and not pending and not waiting
+                    and core.outbox(current).acked >= delivering[0]):
+                core.engine.flush(core.contact_sessions[current], timeout=CONNECT_TIMEOUT)
+                break
+            if kind == 'disconnected' and data['contact'] == current:
+                status = 1
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        core.stop()
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pychat_core", description="PyChat 无界面客户端")
+    parser.add_argument('--port', type=int, help="本机监听端口, 默认沿用上次的端口")
+    parser.add_argument('--db', default="chat_history.db", help="聊天记录数据库文件")
+    parser.add_argument('--download-dir', default=DOWNLOAD_DIR, help="接收文件的保存目录")
+    parser.add_argument('--json', action='store_true', help="以JSON行输出事件")
+    parser.add_argument('--no-discovery', dest='discovery', action='store_false', help="不参与局域网发现")
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL, help="心跳间隔(秒), 0 表示关闭")
+    parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_TIMEOUT,
+                        help="多久没有收到对端数据时断开连接(秒)")
+    parser.add_argument('--tls', action=argparse.BooleanOptionalAction,
+                        help="所有连接使用TLS并记住联系人的证书指纹, 默认沿用上次的设置; 双方都开启时才能互相连接")
+    parser.add_argument('--metrics', action='store_true', help="记录运行时指标, 可用 /stats 查看")
+    parser.add_argument('--metrics-file', help="定期把指标快照写入该JSON文件")
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL, help="快照文件的写出间隔(秒)")
+    parser.add_argument('--metrics-port', type=int, help="在 127.0.0.1 的该端口上提供指标快照")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('listen', help="监听并输出收到的消息, 标准输入可以输入命令")
+    connect = commands.add_parser('connect', help="连接到对端, 标准输入的每一行作为消息发送")
+    connect.add_argument('ip')
+    connect.add_argument('peer_port', type=int)
+    send = commands.add_parser('send', help="连接到对端, 发送消息或文件后退出")
+    send.add_argument('ip')
+    send.add_argument('peer_port', type=int)
+    send.add_argument('message', nargs='?', help="文本消息")
+    send.add_argument('--file', action='append', default=[], help="要发送的文件, 可以重复指定")
+    return run_cli(parser.parse_args(argv))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import os
+import queue
+import sys
+import threading
+import time
+
+import pytest
+
+# 测试直接导入仓库根目录下的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pychat_core import ChatCore, find_available_port  # noqa: E402
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.01)
+
+
+class Node:
+    """在本机回环地址上运行的一个 ChatCore, 事件在单独的线程中依次交给 handle_event"""
+    def __init__(self, directory, name, port=None):
+        self.directory = directory
+        self.name = name
+        self.port = port or find_available_port()
+        self.events = []
+        self._queue = queue.Queue()
+        self.core = ChatCore(lambda kind, data: self._queue.put((kind, data)),
+                             db_name=str(directory / f"{name}.db"), download_dir=str(directory / f"{name}_files"))
+        self.core.start(self.port)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running or not self._queue.empty():
+            try:
+                kind, data = self._queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            self.events.append((kind, self.core.handle_event(kind, data)))
+
+    def call(self, function, *args):
+        """在事件线程之外调用核心的方法前先让已到达的事件处理完"""
+        wait_for(self._queue.empty)
+        return function(*args)
+
+    def count(self, kind, **match):
+        return sum(1 for k, data in list(self.events)
+                   if k == kind and all(data.get(key) == value for key, value in match.items()))
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.core.stop()
+
+
+class FakeCore:
+    """不启动网络的 ChatCore: 发往对端的消息记录在 sent 中, 写线程的事件在 drain() 时处理"""
+    def __init__(self, db_name):
+        self.events = queue.Queue()
+        self.core = ChatCore(lambda kind, data: self.events.put((kind, data)), db_name=db_name)
+        self.sent = []
+        self.core.engine.send_message = lambda session_id, message: self.sent.append(message)
+        self.conn_id = self.core.add_contact("b", "127.0.0.1", 9)
+
+    def bind(self, session_id):
+        self.core.handle_event('connected', {'session': session_id, 'tag': self.conn_id, 'peer_id': None,
+                                             'ip': "127.0.0.1", 'port': 9})
+        self.core.syncing.discard(self.conn_id)
+        self.sent.clear()
+
+    def receive(self, session_id, message):
+        return self.core.handle_event('message', {'session': session_id, 'message': message})
+
+    def drain(self):
+        self.core.db.flush()
+        while not self.events.empty():
+            self.core.handle_event(*self.events.get())
+
+    def stored(self):
+        return [row[2] for row in self.core.db.get_messages_before(self.conn_id)]
+
+
+@pytest.fixture
+def peer(tmp_path):
+    peer = FakeCore(str(tmp_path / "chat.db"))
+    yield peer
+    peer.core.stop()
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    """按名称创建节点; 同名的节点停止后再次创建时沿用原来的数据库和端口"""
+    running = []
+    ports = {}
+
+    def make(name):
+        node = Node(tmp_path, name, ports.get(name))
+        ports[name] = node.port
+        running.append(node)
+        return node
+
+    yield make
+    for node in running:
+        if node._thread.is_alive():
+            node.stop()
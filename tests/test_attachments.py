@@ -0,0 +1,77 @@
+import os
+
+from conftest import wait_for
+from pychat_core import SEGMENT_SIZE, ChatDatabase
+
+
+def attachment_rows(db):
+    db.flush()
+    return db._reader().execute("SELECT sender, file_path, attachment FROM messages "
+                                "WHERE file_path IS NOT NULL ORDER BY id").fetchall()
+
+
+def test_sent_files_reference_their_attachment(nodes, tmp_path):
+    a, b = nodes('a'), nodes('b')
+    path = tmp_path / "report.bin"
+    path.write_bytes(os.urandom(200_000))
+    contact = a.call(a.core.add_contact, 'b', '127.0.0.1', b.port)
+    a.call(a.core.connect, contact)
+    wait_for(lambda: contact in a.core.contact_sessions and b.core.contact_sessions)
+    for sent in (1, 2):
+        a.call(a.core.send_file, contact, str(path))
+        wait_for(lambda: a.count('transfer_done', outgoing=True) == sent and b.count('transfer_done') == sent)
+    a.stop()
+    b.stop()
+
+    sent = attachment_rows(ChatDatabase(str(tmp_path / "a.db")))
+    assert len(sent) == 2
+    content_hash = sent[0][2]
+    assert content_hash and all(row == ("我", str(path), content_hash) for row in sent)
+    received = attachment_rows(ChatDatabase(str(tmp_path / "b.db")))
+    # 第二次发送时接收端已有相同内容, 两条消息引用同一个文件
+    assert [row[2] for row in received] == [content_hash] * 2
+    assert received[0][1] == received[1][1]
+    assert [entry.name for entry in os.scandir(tmp_path / "b_files") if entry.is_file()] == ["report.bin"]
+
+
+def test_duplicate_received_content_is_kept_once(tmp_path):
+    db = ChatDatabase(str(tmp_path / "chat.db"))
+    first, second = tmp_path / "x.bin", tmp_path / "x (1).bin"
+    for path in (first, second):
+        path.write_bytes(b"same content")
+        db.save_message(1, "对方", "[文件] x.bin", str(path), attachment="h1")
+    # 两个传输在接收端还没有索引这份内容时开始, 先后收完
+    db.add_attachment("h1", str(first), received=True)
+    db.add_attachment("h1", str(second), received=True)
+    assert [row[1] for row in attachment_rows(db)] == [str(first)] * 2
+    assert first.exists() and not second.exists()
+    assert db.find_attachment("h1") == str(first)
+    db.close()
+
+
+def test_interrupted_file_resumes_after_reconnect(nodes, tmp_path):
+    a, b = nodes('a'), nodes('b')
+    path = tmp_path / "large.bin"
+    path.write_bytes(os.urandom(3 * SEGMENT_SIZE))
+    contact = a.call(a.core.add_contact, 'b', '127.0.0.1', b.port)
+    a.call(a.core.connect, contact)
+    wait_for(lambda: contact in a.core.contact_sessions and b.core.contact_sessions)
+
+    # 第一个进度事件时(网络线程中)断开到对端的所有连接, 之后自动重连
+    engine = a.core.engine
+    emit = engine.emit
+    interrupted = []
+
+    def interrupt(kind, **data):
+        if kind == 'transfer_progress' and data['outgoing'] and not interrupted:
+            interrupted.append(data['done'])
+            for link in list(engine.links.values()):
+                link.transport.abort()
+        emit(kind, **data)
+
+    engine.emit = interrupt
+    a.call(a.core.send_file, contact, str(path))
+    wait_for(lambda: a.count('transfer_failed', outgoing=True, contact=contact) == 1)
+    wait_for(lambda: a.count('transfer_done', outgoing=True) == 1, timeout=30)
+    assert [data['resumed_files'] for kind, data in a.events if kind == 'connected'][1:] == [[str(path)]]
+    assert (tmp_path / "b_files" / "large.bin").read_bytes() == path.read_bytes()
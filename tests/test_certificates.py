@@ -0,0 +1,18 @@
+from pychat_core import ChatCore
+
+
+def test_certificate_pinning(tmp_path):
+    core = ChatCore(lambda kind, data: None, db_name=str(tmp_path / "chat.db"))
+    contact = core.add_contact("b", "127.0.0.1", 9)
+    assert core._verify_peer(contact, "aa") is None
+    # 指纹在提交之前就已生效
+    assert core._verify_peer(contact, "bb") is not None
+    core.db.flush()
+    assert core.db.get_certificate(contact) == "aa"
+    core.forget_certificate(contact)
+    assert core._verify_peer(contact, "bb") is None
+    core.stop()
+    core = ChatCore(lambda kind, data: None, db_name=str(tmp_path / "chat.db"))
+    assert core._verify_peer(contact, "aa") is not None
+    assert core._verify_peer(contact, "bb") is None
+    core.stop()
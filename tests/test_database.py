@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from pychat_core import ChatDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    # 较长的合并间隔让消息停留在写入队列中
+    db = ChatDatabase(str(tmp_path / "chat.db"), flush_interval=5.0)
+    yield db
+    db.close()
+
+
+def test_latest_page_includes_unflushed_messages(db):
+    conn_id = db.add_connection("a", "10.0.0.1", 9000)
+    for i in range(3):
+        db.save_message(conn_id, "我", f"m{i}")
+    db.flush()
+    db.save_message(conn_id, "对方", "pending")
+    db.save_message(conn_id + 1, "对方", "other contact")
+    rows = db.get_messages_before(conn_id)
+    assert [row[2] for row in rows] == ["m0", "m1", "m2", "pending"]
+    assert rows[-1][0] is None and all(row[0] is not None for row in rows[:-1])
+    assert db.writes.pending() == 2
+    db.flush()
+    assert [row[0] is not None for row in db.get_messages_before(conn_id)] == [True] * 4
+
+
+def test_upgrade_keeps_messages_without_contact(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE connections (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, ip TEXT, port INTEGER, last_active TEXT)")
+    conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, connection_id INTEGER, sender TEXT, message TEXT, timestamp TEXT, file_path TEXT)")
+    conn.execute("INSERT INTO connections (name, ip, port, last_active) VALUES ('a', '10.0.0.1', 9000, '2020-01-01T00:00:00')")
+    conn.execute("INSERT INTO messages (connection_id, sender, message, timestamp) VALUES (1, '我', 'kept', '2020-01-01T00:00:00')")
+    conn.execute("INSERT INTO messages (connection_id, sender, message, timestamp) VALUES (NULL, '我', 'orphan', '2020-01-01T00:00:01')")
+    conn.commit()
+    conn.close()
+    db = ChatDatabase(path)
+    try:
+        assert [row[2] for row in db.get_messages_before(1)] == ["kept"]
+        assert [row[2] for row in db.get_messages_before(0)] == ["orphan"]
+    finally:
+        db.close()
@@ -0,0 +1,118 @@
+from pychat_core import Outbox
+
+
+def text(seq):
+    return {'type': 'text', 'content': f"m{seq}", 'seq': seq}
+
+
+def test_outbox_window_and_cumulative_ack():
+    outbox = Outbox(0, [], window=2)
+    for _ in range(3):
+        seq = outbox.next_seq()
+        outbox.add(seq, text(seq))
+    assert outbox.sendable() == [text(1), text(2)]
+    assert outbox.sendable() == []
+    assert outbox.acknowledge(1)
+    assert outbox.sendable() == [text(3)]
+    assert not outbox.acknowledge(1)
+    assert outbox.acknowledge(3)
+    assert len(outbox) == 0
+
+
+def test_outbox_ignores_duplicate_add():
+    outbox = Outbox(0, [])
+    outbox.add(1, text(1))
+    outbox.add(1, text(1))
+    assert len(outbox) == 1
+
+
+def test_outbox_restart_resends_unacknowledged():
+    outbox = Outbox(3, [(2, '{"type": "text", "content": "m2", "seq": 2}'),
+                        (3, '{"type": "text", "content": "m3", "seq": 3}')])
+    assert outbox.acked == 1
+    assert outbox.sendable() == [text(2), text(3)]
+    outbox.restart()
+    assert outbox.sendable() == [text(2), text(3)]
+
+
+def test_outbox_rewind():
+    outbox = Outbox(0, [])
+    for seq in range(1, 6):
+        outbox.next_seq()
+        outbox.add(seq, text(seq))
+    outbox.sendable()
+    outbox.acknowledge(1)
+    outbox.rewind(3)
+    assert outbox.sendable() == [text(3), text(4), text(5)]
+    # 不会退回到已确认的消息之前
+    outbox.rewind(1)
+    assert outbox.sendable() == [text(2), text(3), text(4), text(5)]
+
+
+def test_receiver_drops_gap_and_requests_resend(peer):
+    peer.bind(1)
+    assert not peer.receive(1, text(1)).get('out_of_order')
+    data = peer.receive(1, text(3))
+    assert data['out_of_order']
+    assert peer.sent == [{'type': 'resend', 'seq': 2}]
+    # 同一个缺口只请求一次
+    assert peer.receive(1, text(4))['out_of_order']
+    assert peer.sent == [{'type': 'resend', 'seq': 2}]
+    for seq in (2, 3, 4):
+        data = peer.receive(1, text(seq))
+        assert not data.get('out_of_order') and not data.get('duplicate')
+    peer.drain()
+    assert peer.stored() == ["m1", "m2", "m3", "m4"]
+    assert peer.sent[-1] == {'type': 'ack', 'seq': 4}
+
+
+def test_receiver_acknowledges_duplicates(peer):
+    peer.bind(1)
+    peer.receive(1, text(1))
+    peer.drain()
+    peer.sent.clear()
+    assert peer.receive(1, text(1))['duplicate']
+    assert peer.sent == [{'type': 'ack', 'seq': 1}]
+    peer.drain()
+    assert peer.stored() == ["m1"]
+
+
+def test_receiver_after_reconnect(peer):
+    peer.bind(1)
+    for seq in (1, 2):
+        peer.receive(1, text(seq))
+    peer.drain()
+    peer.core.handle_event('disconnected', {'session': 1})
+    peer.bind(2)
+    # 重连后对端从第一条未确认的消息重发
+    assert peer.receive(2, text(2))['duplicate']
+    assert peer.receive(2, text(4))['out_of_order']
+    assert peer.sent[-1] == {'type': 'resend', 'seq': 3}
+    peer.receive(2, text(3))
+    peer.drain()
+    assert peer.stored() == ["m1", "m2", "m3"]
+
+
+def test_sender_resends_from_requested_seq(peer):
+    peer.bind(1)
+    for i in range(3):
+        peer.core.send_text(peer.conn_id, f"m{i + 1}")
+    peer.drain()
+    assert [message['seq'] for message in peer.sent] == [1, 2, 3]
+    peer.sent.clear()
+    peer.receive(1, {'type': 'ack', 'seq': 1})
+    peer.receive(1, {'type': 'resend', 'seq': 2})
+    assert [message['seq'] for message in peer.sent] == [2, 3]
+
+
+def test_reset_renumbers_queued_messages(peer):
+    peer.bind(1)
+    for i in range(2):
+        peer.core.send_text(peer.conn_id, f"m{i + 1}")
+    # 本机重新安装过, 对端已有以前发出的5条消息; 这时发出的消息可能还在写入队列中
+    peer.receive(1, {'type': 'sync', 'sent': 0, 'received': 5, 'reset': True})
+    assert peer.sent == [{'type': 'sync_reset'}]
+    assert peer.core.send_text(peer.conn_id, "m3") == 8
+    peer.drain()
+    assert [(message['seq'], message['content']) for message in peer.sent[1:]] == [(6, "m1"), (7, "m2"), (8, "m3")]
+    assert [seq for seq, _ in peer.core.db.get_outbox(peer.conn_id)] == [6, 7, 8]
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from pychat_core import (
+    COMPRESSION_CODECS, FRAME_CONTROL, FRAME_DATA, FRAME_HEADER, PROTOCOL_MAGIC, PROTOCOL_VERSION,
+    FrameCodec, FrameDecoder, ProtocolError, decode_control, decompress_payload, encode_control, frame_header,
+)
+
+
+def collect(decoder):
+    return [(frame.ftype, frame.flags, frame.channel, bytes(frame.payload)) for frame in decoder.frames()]
+
+
+def test_control_round_trip():
+    message = {'type': 'text', 'message': '你好'}
+    decoder = FrameDecoder()
+    decoder.feed(encode_control(message))
+    [(ftype, flags, channel, payload)] = collect(decoder)
+    assert (ftype, flags, channel) == (FRAME_CONTROL, 0, 0)
+    assert decode_control(payload) == message
+
+
+def test_several_frames_in_one_read():
+    data = b''.join(frame_header(FRAME_DATA, len(body), channel=i) + body
+                    for i, body in enumerate((b'a', b'', b'ccc')))
+    decoder = FrameDecoder()
+    decoder.feed(data)
+    assert collect(decoder) == [(FRAME_DATA, 0, 0, b'a'), (FRAME_DATA, 0, 1, b''), (FRAME_DATA, 0, 2, b'ccc')]
+
+
+@pytest.mark.parametrize('split', [1, FRAME_HEADER.size - 1, FRAME_HEADER.size, FRAME_HEADER.size + 3])
+def test_frame_split_across_reads(split):
+    body = os.urandom(100)
+    data = frame_header(FRAME_DATA, len(body), channel=7) + body
+    decoder = FrameDecoder()
+    decoder.feed(data[:split])
+    assert collect(decoder) == []
+    decoder.feed(data[split:])
+    assert collect(decoder) == [(FRAME_DATA, 0, 7, body)]
+
+
+def test_byte_by_byte_with_small_buffer():
+    # 缓冲区比帧小时需要扩容, 逐字节输入也要得到相同的帧
+    bodies = [os.urandom(n) for n in (10, 300, 0, 5000)]
+    data = b''.join(frame_header(FRAME_DATA, len(body), channel=1) + body for body in bodies)
+    decoder = FrameDecoder(capacity=64)
+    received = []
+    for i in range(len(data)):
+        decoder.feed(data[i:i + 1])
+        received += [payload for _, _, _, payload in collect(decoder)]
+    assert received == bodies
+
+
+def test_bad_magic():
+    decoder = FrameDecoder()
+    decoder.feed(FRAME_HEADER.pack(b'XX', PROTOCOL_VERSION, FRAME_CONTROL, 0, 0, 0))
+    with pytest.raises(ProtocolError):
+        collect(decoder)
+
+
+def test_bad_version():
+    decoder = FrameDecoder()
+    decoder.feed(FRAME_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION + 1, FRAME_CONTROL, 0, 0, 0))
+    with pytest.raises(ProtocolError):
+        collect(decoder)
+
+
+def test_oversized_length():
+    # 只收到帧头就拒绝, 不等待也不为负载分配内存
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(frame_header(FRAME_DATA, 1025))
+    with pytest.raises(ProtocolError):
+        collect(decoder)
+
+
+@pytest.mark.parametrize('name', sorted(COMPRESSION_CODECS))
+def test_codec_flag_round_trip(name):
+    codec = FrameCodec(name, 6)
+    message = {'type': 'text', 'message': 'hello ' * 500}
+    decoder = FrameDecoder()
+    decoder.feed(encode_control(message, codec))
+    [(ftype, flags, _, payload)] = collect(decoder)
+    assert ftype == FRAME_CONTROL
+    assert flags == COMPRESSION_CODECS[name][0]
+    assert decode_control(decompress_payload(flags, payload, 1 << 20)) == message
+
+
+def test_small_or_incompressible_payload_is_sent_raw():
+    codec = FrameCodec('zlib', 6)
+    assert codec.compress(b'short') == (0, b'short')
+    noise = os.urandom(4096)
+    assert codec.compress(noise) == (0, noise)
+
+
+def test_decompress_rejects_unknown_flag_and_bombs():
+    with pytest.raises(ProtocolError):
+        decompress_payload(0, b'', 100)
+    flag, payload = FrameCodec('zlib', 6).compress(b'\0' * 10000)
+    with pytest.raises(ProtocolError):
+        decompress_payload(flag, payload, 100)
+    with pytest.raises(ProtocolError):
+        decompress_payload(flag, payload[:-4], 10000)
@@ -0,0 +1,33 @@
+import pytest
+
+
+def roster(uid, *members):
+    return {'type': 'group', 'group': uid, 'name': "g",
+            'members': [{'peer_id': None, 'name': name, 'ip': "127.0.0.2", 'port': port} for name, port in members]}
+
+
+def group_text(uid, content):
+    return {'type': 'group_text', 'group': uid, 'name': "g", 'content': content}
+
+
+def test_roster_members_are_merged_after_commit(peer):
+    peer.bind(1)
+    group_id = -peer.receive(1, roster("u1", ("c", 9001), ("d", 9002)))['conversation']
+    # 成员经写入队列写入, 提交后联系人列表中的群组才更新成员数
+    assert peer.core.db.find_group("u1") == group_id
+    peer.drain()
+    assert peer.core.contacts.get(-group_id).members == 3
+    assert {row[1] for row in peer.core.db.get_group_members(group_id)} == {"b", "c", "d"}
+
+
+def test_known_group_text_skips_membership_writes(peer):
+    peer.bind(1)
+    group_id = -peer.receive(1, group_text("u1", "hello"))['conversation']
+    peer.drain()
+    # 第一次遇到的群组记下发送者; 之后的消息只保存消息本身
+    assert [row[0] for row in peer.core.db.get_group_members(group_id)] == [peer.conn_id]
+    peer.core.db.merge_group_members = lambda *args: pytest.fail("不应写入成员")
+    for i in range(3):
+        assert peer.receive(1, group_text("u1", f"m{i}"))['conversation'] == -group_id
+    peer.drain()
+    assert [row[2] for row in peer.core.db.get_messages_before(-group_id)] == ["hello", "m0", "m1", "m2"]